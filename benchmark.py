@@ -0,0 +1,534 @@
+import argparse
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+from chroma_key import configure_threads, create_keyer, mask_mismatch, MASK_SCALES, THREADING
+from change_detector import ChangeDetector
+from frame_source import Frame, FrameSource, FRAME_SOURCES
+from metrics import process_rss
+from pipeline import FramePipeline
+
+FRAME_SIZES = {
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '1440p': (2560, 1440),
+    '4k': (3840, 2160),
+}
+
+HSV_LOWER = np.array([50, 100, 100], dtype=np.uint8)
+HSV_UPPER = np.array([70, 255, 255], dtype=np.uint8)
+
+# The window size the process and display suites render for, the default overlay size
+VIEW_SIZE = (640, 480)
+
+# Capture backend name under which the synthetic frame source is registered
+SYNTHETIC_BACKEND = 'synthetic'
+
+# Capture backend name under which the win32 capture over fake_win32 is registered
+FAKE_WIN32_BACKEND = 'fake-win32'
+
+STAGES = ('keying', 'scaling', 'change', 'chroma', 'codec', 'process', 'display', 'overlays', 'memory')
+
+# Frame sizes the scaling suite measures keying with 1 to N workers at
+SCALING_SIZES = ('1080p', '1440p', '4k')
+
+# Numbers of overlays of one window the overlays suite renders for
+OVERLAY_COUNTS = (1, 2, 4)
+
+# Frames the memory suite renders after its warm-up, and how often the captured window changes size
+MEMORY_FRAMES = 600
+MEMORY_RESIZE_EVERY = 100
+
+def synthetic_frame(width, height, coverage=0.7, seed=0):
+    """
+    Creates a BGRA test frame: a textured character on a flat #00FF00 background.
+
+    Args:
+        width (int): The frame width.
+        height (int): The frame height.
+        coverage (float): The fraction of the frame covered by the green background.
+        seed (int): Seed for the texture of the character.
+
+    Returns:
+        ndarray: A (height, width, 4) uint8 BGRA frame.
+    """
+    frame = np.empty((height, width, 4), dtype=np.uint8)
+    frame[:] = (0, 255, 0, 255)
+
+    # An ellipse covering (1 - coverage) of the frame, filled with noisy skin and hair tones
+    ys, xs = np.ogrid[:height, :width]
+    radius = np.sqrt((1.0 - coverage) / np.pi)
+    inside = ((xs / width - 0.5) / radius) ** 2 + ((ys / height - 0.5) / radius) ** 2 < 1
+    rng = np.random.default_rng(seed)
+    texture = rng.integers(0, 64, size=(height, width, 3), dtype=np.uint8)
+    character = np.empty((height, width, 3), dtype=np.uint8)
+    character[:] = (150, 170, 220)
+    character[: height // 3] = (40, 50, 90)
+    character += texture
+    frame[inside, :3] = character[inside]
+    return frame
+
+def time_call(function, repeat):
+    """
+    Runs `function` once to warm up and then `repeat` times.
+
+    Returns:
+        float: The average duration of a call in milliseconds.
+    """
+    function()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+def measure(function, repeat, alloc_repeat=5):
+    """
+    Times `function` and measures the memory it allocates per call.
+
+    Calls are timed individually and summarized by their median, which keeps the occasional
+    scheduler hiccup out of the comparison with a baseline. Allocations are traced with tracemalloc
+    in a separate pass, so tracing does not slow down the timed calls. Only Python and NumPy
+    allocations (including arrays returned by OpenCV) are traced, memory Qt allocates for images is not.
+
+    Returns:
+        dict: 'ms' and 'fps' per call, 'alloc_kb' the memory allocated and held at the peak of a
+        call on average, and 'rss_mb' the resident memory of the process afterwards.
+    """
+    function()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    ms = float(np.median(durations)) * 1000
+    tracemalloc.start()
+    try:
+        allocated = 0
+        for _ in range(alloc_repeat):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            function()
+            allocated += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    rss = process_rss()
+    return {
+        'ms': round(ms, 3),
+        'fps': round(1000 / ms, 1),
+        'alloc_kb': round(allocated / alloc_repeat / 1024, 1),
+        'rss_mb': None if rss is None else round(rss / (1 << 20), 1),
+    }
+
+def result_key(result):
+    return (result['suite'], result['size'], result['coverage'], result['variant'])
+
+def print_results(results):
+    print(f"{'suite':>8} {'size':>6} {'green':>6} {'variant':>14} {'ms':>8} {'fps':>8} {'alloc KB':>9} {'RSS MB':>7}")
+    for result in results:
+        rss = '-' if result['rss_mb'] is None else f"{result['rss_mb']:.1f}"
+        print(f"{result['suite']:>8} {result['size']:>6} {result['coverage']:>6.0%} {result['variant']:>14} "
+              f"{result['ms']:>8.2f} {result['fps']:>8.1f} {result['alloc_kb']:>9.1f} {rss:>7}")
+
+def bench_keying(sizes, coverages, repeat, results=None):
+    """
+    Times every keyer and mask scale and reports the mismatch against the full-resolution HSV mask.
+    """
+    print(f"{'size':>6} {'green':>6} {'keyer':>10} {'ms':>8} {'fps':>8} {'mismatch %':>11}")
+    for size in sizes:
+        width, height = FRAME_SIZES[size]
+        for coverage in coverages:
+            frame = synthetic_frame(width, height, coverage)
+            reference = create_keyer('hsv').alpha(frame, HSV_LOWER, HSV_UPPER).copy()
+            for method in ('hsv', 'lut'):
+                for mask_scale in MASK_SCALES:
+                    keyer = create_keyer(method, mask_scale)
+                    out = np.empty((height, width), dtype=np.uint8)
+                    measured = measure(lambda: keyer.alpha(frame, HSV_LOWER, HSV_UPPER, out=out), repeat)
+                    mismatch = mask_mismatch(out, reference)
+                    name = f"{method}/{mask_scale}"
+                    print(f"{size:>6} {coverage:>6.0%} {name:>10} {measured['ms']:>8.2f} {measured['fps']:>8.1f} {mismatch:>11.4f}")
+                    if results is not None:
+                        results.append(dict(suite='keying', size=size, coverage=coverage, variant=name, **measured))
+
+def bench_scaling(sizes, workers, repeat, results):
+    """
+    Times the fused pipeline keying whole frames with 1 to `workers` threads, split into row stripes
+    or left to OpenCV, and reports the speed-up over one thread and the parallel efficiency.
+    """
+    print(f"{'size':>6} {'threading':>9} {'workers':>7} {'ms':>8} {'fps':>8} {'speed-up':>8} {'efficiency':>10}")
+    for size in sizes:
+        width, height = FRAME_SIZES[size]
+        frame = Frame(synthetic_frame(width, height), width, height, width * 4, 'BGRA', 0)
+        for threading in THREADING:
+            single = None
+            for count in range(1, workers + 1):
+                configure_threads(count, threading)
+                pipeline = FramePipeline(create_keyer('hsv', 1, count, threading))
+                measured = measure(lambda: pipeline.process(frame, HSV_LOWER, HSV_UPPER), repeat)
+                pipeline.release()
+                single = single or measured['ms']
+                speedup = single / measured['ms']
+                print(f"{size:>6} {threading:>9} {count:>7} {measured['ms']:>8.2f} {measured['fps']:>8.1f} "
+                      f"{speedup:>7.2f}x {speedup / count:>10.0%}")
+                results.append(dict(suite='scaling', size=size, coverage=0.7, variant=f"{threading}/{count}",
+                                    speedup=round(speedup, 2), **measured))
+    configure_threads()
+
+def bench_change_detection(sizes, repeat, results=None):
+    """
+    Times the fused pipeline with and without change detection for an idle and a blinking character.
+    """
+    print(f"{'size':>6} {'scene':>8} {'detect':>7} {'ms':>8} {'skipped':>8} {'dirty tiles':>12}")
+    for size in sizes:
+        width, height = FRAME_SIZES[size]
+        idle = synthetic_frame(width, height)
+        blink = idle.copy()
+        blink[height * 2 // 5:height * 2 // 5 + height // 40, width * 9 // 20:width * 11 // 20, :3] = (40, 50, 90)
+        for scene, frames in (('idle', [idle, idle]), ('blink', [idle, blink])):
+            for detect in (False, True):
+                detector = ChangeDetector() if detect else None
+                pipeline = FramePipeline(create_keyer('hsv'), change_detector=detector)
+                sequence = [Frame(data, width, height, width * 4, 'BGRA', 0) for data in frames]
+                pipeline.process(sequence[0], HSV_LOWER, HSV_UPPER)
+                ticks = iter(range(1, 1 << 30))
+                measured = measure(lambda: pipeline.process(sequence[next(ticks) % 2], HSV_LOWER, HSV_UPPER), repeat)
+                skipped = f"{detector.skipped_frames / detector.frames:.0%}" if detect else '-'
+                dirty = f"{detector.dirty_tiles / detector.frames:.1f}" if detect else '-'
+                print(f"{size:>6} {scene:>8} {str(detect):>7} {measured['ms']:>8.2f} {skipped:>8} {dirty:>12}")
+                if results is not None:
+                    variant = f"{scene}/{'detect' if detect else 'full'}"
+                    results.append(dict(suite='change', size=size, coverage=0.7, variant=variant, **measured))
+
+def bench_codec(sizes, coverages, repeat, results):
+    """
+    Times frame_codec on frames keyed by utils.apply_chroma_key and reports the compression ratio
+    and the encode and decode rates in MB of raw frames per second: for keyframes, and for delta
+    frames of a blinking character.
+    """
+    import cv2
+    from frame_codec import FrameDecoder, FrameEncoder
+    from utils import apply_chroma_key
+    print(f"{'size':>6} {'green':>6} {'variant':>7} {'ratio':>7} {'enc MB/s':>9} {'dec MB/s':>9}")
+    for size in sizes:
+        width, height = FRAME_SIZES[size]
+        for coverage in coverages:
+            idle = synthetic_frame(width, height, coverage)
+            blink = idle.copy()
+            blink[height * 2 // 5:height * 2 // 5 + height // 40, width * 9 // 20:width * 11 // 20, :3] = (40, 50, 90)
+            idle, blink = (apply_chroma_key(cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR), HSV_LOWER, HSV_UPPER)
+                           for frame in (idle, blink))
+            encoder = FrameEncoder(keyframe_interval=0)
+            keyframe = encoder.encode(idle, keyframe=True)
+            # Decoding the two deltas in turn is valid, each is encoded against the frame of the other
+            deltas = [encoder.encode(blink), encoder.encode(idle)]
+            for variant, encoded in (('key', [keyframe]), ('blink', deltas)):
+                frames = [idle] if variant == 'key' else [blink, idle]
+                ticks = iter(range(1 << 30))
+                encode = measure(lambda: encoder.encode(frames[next(ticks) % len(frames)], keyframe=variant == 'key'),
+                                 repeat)
+                decoder = FrameDecoder()
+                decoder.decode(keyframe)
+                decode = measure(lambda: decoder.decode(encoded[next(ticks) % len(encoded)]), repeat)
+                decoder.release()
+                ratio = idle.nbytes * len(encoded) / sum(len(data) for data in encoded)
+                megabytes = idle.nbytes / (1 << 20)
+                print(f"{size:>6} {coverage:>6.0%} {variant:>7} {ratio:>7.1f} {megabytes * encode['fps']:>9.0f} "
+                      f"{megabytes * decode['fps']:>9.0f}")
+                for step, measured in (('encode', encode), ('decode', decode)):
+                    results.append(dict(suite='codec', size=size, coverage=coverage, variant=f"{variant}/{step}",
+                                        ratio=round(ratio, 2), **measured))
+            encoder.release()
+
+class SyntheticFrameSource(FrameSource):
+    """
+    A frame source that delivers the given frames round robin instead of capturing a window.
+
+    With `copy`, every grab copies the frame into a reused buffer, as the real backends copy the
+    pixels out of the window, so the capture has a realistic cost.
+    """
+    def __init__(self, window_title, frames=(), copy=False):
+        super().__init__(window_title)
+        self.frames = frames
+        self.copy = copy
+        self._buffer = None
+        self._index = 0
+
+    def grab(self):
+        data = self.frames[self._index % len(self.frames)]
+        self._index += 1
+        if self.copy:
+            if self._buffer is None or self._buffer.shape != data.shape:
+                self._buffer = np.empty_like(data)
+            np.copyto(self._buffer, data)
+            data = self._buffer
+        height, width = data.shape[:2]
+        return self._make_frame(data, width, height, width * 4)
+
+def benchmark_config(app, mode='fused', change_detection=False):
+    """
+    Loads config.yaml for the suites that go through the application code, capturing from the
+    synthetic frame source on the GUI thread at a fixed pace.
+    """
+    from config_loader import load_config, overlay_configs
+    config = overlay_configs(load_config('config.yaml', app))[0]
+    config['window_settings']['capture_backend'] = SYNTHETIC_BACKEND
+    config['window_settings']['capture_region'] = 'auto'
+    config['window_settings']['size'] = {'width': VIEW_SIZE[0], 'height': VIEW_SIZE[1]}
+    config['pipeline_settings'].update(mode=mode, threaded=False, change_detection=change_detection, processes=0)
+    config['pacing_settings']['mode'] = 'fixed'
+    config['metrics_settings']['hud'] = False
+    return config
+
+def use_synthetic_frames(frames, copy=False):
+    """
+    Makes the synthetic backend deliver the given frames, replacing any source opened before.
+    """
+    from utils import close_frame_sources
+    close_frame_sources()
+    FRAME_SOURCES[SYNTHETIC_BACKEND] = functools.partial(SyntheticFrameSource, frames=frames, copy=copy)
+
+def bench_apply_chroma_key(sizes, coverages, repeat, results):
+    """
+    Times the reference keyer, utils.apply_chroma_key, on BGR frames as the legacy path passes them.
+    """
+    from utils import apply_chroma_key
+    for size in sizes:
+        width, height = FRAME_SIZES[size]
+        for coverage in coverages:
+            image = np.ascontiguousarray(synthetic_frame(width, height, coverage)[..., :3])
+            measured = measure(lambda: apply_chroma_key(image, HSV_LOWER, HSV_UPPER), repeat)
+            results.append(dict(suite='chroma', size=size, coverage=coverage, variant='apply', **measured))
+
+def bench_capture_and_process(app, sizes, coverages, repeat, results):
+    """
+    Times utils.capture_and_process_target_window on synthetic captures, for the fused and legacy paths.
+    """
+    from config_loader import CompiledConfig
+    from utils import capture_and_process_target_window
+    for size in sizes:
+        width, height = FRAME_SIZES[size]
+        for coverage in coverages:
+            use_synthetic_frames([synthetic_frame(width, height, coverage)])
+            for mode in ('fused', 'legacy'):
+                settings = CompiledConfig(benchmark_config(app, mode))
+                pipeline = FramePipeline(create_keyer()) if mode == 'fused' else None
+                measured = measure(lambda: capture_and_process_target_window(settings, pipeline, VIEW_SIZE), repeat)
+                results.append(dict(suite='process', size=size, coverage=coverage, variant=mode, **measured))
+
+def bench_display(app, sizes, coverages, repeat, results):
+    """
+    Times TransparentWindow.updateImage, from the synthetic capture to the painted window.
+
+    Every frame differs from the previous one in a small patch, so the change detection variant
+    measures re-keying and repainting only the changed part.
+    """
+    from transparent_window import TransparentWindow
+    for size in sizes:
+        width, height = FRAME_SIZES[size]
+        for coverage in coverages:
+            frame = synthetic_frame(width, height, coverage)
+            blink = frame.copy()
+            blink[height * 2 // 5:height * 2 // 5 + height // 40, width * 9 // 20:width * 11 // 20, :3] = (40, 50, 90)
+            use_synthetic_frames([frame, blink])
+            for mode, change_detection in (('fused', False), ('fused', True), ('legacy', False)):
+                window = TransparentWindow(app, benchmark_config(app, mode, change_detection))
+                window.timer.stop()
+
+                def update():
+                    window.updateImage()
+                    window.view.repaint()
+
+                measured = measure(update, repeat)
+                window.timer.stop()
+                window.visibilityTimer.stop()
+                window.close()
+                window.deleteLater()
+                variant = f"{mode}/detect" if change_detection else mode
+                results.append(dict(suite='display', size=size, coverage=coverage, variant=variant, **measured))
+
+def bench_overlays(app, sizes, coverages, repeat, results):
+    """
+    Times rendering and displaying a frame for several identical overlays of the same window, each
+    capturing on its own as separate run.py processes would, and served by one CaptureGroup that
+    captures and keys once.
+    """
+    from transparent_window import TransparentWindow
+    from capture_worker import CaptureGroup
+    for size in sizes:
+        width, height = FRAME_SIZES[size]
+        for coverage in coverages:
+            use_synthetic_frames([synthetic_frame(width, height, coverage)], copy=True)
+            config = benchmark_config(app)
+            # Always due, so every group tick serves every overlay
+            config['update_interval'] = 0
+            for count in OVERLAY_COUNTS:
+                for grouped in (False, True):
+                    group = CaptureGroup() if grouped else None
+                    windows = [TransparentWindow(app, config, capture_group=group, overlay=index if grouped else None)
+                               for index in range(count)]
+                    for window in windows:
+                        window.timer.stop()
+
+                    def update():
+                        if grouped:
+                            group.tick()
+                        else:
+                            for window in windows:
+                                window.updateImage()
+
+                    measured = measure(update, repeat)
+                    for window in windows:
+                        window.timer.stop()
+                        window.visibilityTimer.stop()
+                        window.close()
+                        window.deleteLater()
+                    variant = f"{count}x {'group' if grouped else 'separate'}"
+                    results.append(dict(suite='overlays', size=size, coverage=coverage, variant=variant, **measured))
+
+def bench_memory(app, sizes, repeat, results):
+    """
+    Renders a long run of frames from the win32 capture (over fake_win32) to the painted window and
+    reports whether memory stays flat: the resident memory growth after a warm-up, the hit rate of
+    the buffer pool and the buffers and GDI objects still held afterwards.
+
+    The captured window alternates between two sizes, so buffers of both are allocated and reused
+    along the way.
+    """
+    from transparent_window import TransparentWindow
+    from frame_source import Win32FrameSource
+    from fake_win32 import FakeWin32
+    from buffer_pool import BUFFER_POOL
+    from capture_image import live_gdi_handles
+    from capture_worker import release_frame
+    from utils import close_frame_sources
+    print(f"{'size':>6} {'frames':>7} {'RSS +MB':>8} {'hit rate':>9} {'live bufs':>10} {'GDI':>5} {'leaked':>7}")
+    for size in sizes:
+        width, height = FRAME_SIZES[size]
+        api = FakeWin32()
+        target = api.add_window('Memory', width, height)
+        target.pixels = synthetic_frame(width, height)
+        close_frame_sources()
+        FRAME_SOURCES[FAKE_WIN32_BACKEND] = functools.partial(Win32FrameSource, api=api)
+        config = benchmark_config(app)
+        config['window_settings'].update(title='Memory', capture_backend=FAKE_WIN32_BACKEND)
+        window = TransparentWindow(app, config)
+        window.timer.stop()
+
+        def update():
+            window.updateImage()
+            window.view.repaint()
+
+        results.append(dict(suite='memory', size=size, coverage=0.7, variant='win32', **measure(update, repeat)))
+        for _ in range(MEMORY_FRAMES // 4):
+            update()
+        rss = process_rss()
+        hits, misses = BUFFER_POOL.hits, BUFFER_POOL.misses
+        for index in range(MEMORY_FRAMES):
+            if index % MEMORY_RESIZE_EVERY == 0:
+                resized = (index // MEMORY_RESIZE_EVERY) % 2
+                target.width, target.height = (width * 3 // 4, height * 3 // 4) if resized else (width, height)
+            update()
+        growth = None if rss is None else (process_rss() - rss) / (1 << 20)
+        requests = BUFFER_POOL.hits - hits + BUFFER_POOL.misses - misses
+        hit_rate = (BUFFER_POOL.hits - hits) / requests if requests else 0.0
+        window.visibilityTimer.stop()
+        window.close()
+        window.deleteLater()
+        # Give back what the window holds, so that only leaks remain live
+        window.pipeline.release()
+        release_frame(window.shownFrame)
+        window.shownFrame = None
+        close_frame_sources()
+        stats = BUFFER_POOL.stats()
+        print(f"{size:>6} {MEMORY_FRAMES:>7} {'-' if growth is None else f'{growth:+.1f}':>8} {hit_rate:>9.1%} "
+              f"{stats['live_buffers']:>10} {live_gdi_handles():>5} {stats['leaked']:>7}")
+
+def save_baseline(results, path, args):
+    """
+    Stores the results, and the options they were measured with, as a JSON baseline.
+    """
+    baseline = {
+        'options': {'sizes': args.sizes, 'coverages': args.coverages, 'repeat': args.repeat, 'stages': args.stages},
+        'results': results,
+    }
+    with open(path, 'w') as file:
+        json.dump(baseline, file, indent=1)
+    print(f"Baseline saved to {path}")
+
+def compare_baseline(results, path, threshold):
+    """
+    Compares the results with a stored baseline and reports every measurement whose frame rate
+    dropped by more than `threshold` (a fraction, e.g. 0.15).
+
+    Returns:
+        int: The number of regressions.
+    """
+    with open(path, 'r') as file:
+        baseline = {result_key(result): result for result in json.load(file)['results']}
+    regressions = 0
+    print(f"{'suite':>8} {'size':>6} {'green':>6} {'variant':>14} {'base fps':>9} {'fps':>8} {'change':>8}")
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+        change = result['fps'] / base['fps'] - 1
+        regressed = change < -threshold
+        regressions += regressed
+        print(f"{result['suite']:>8} {result['size']:>6} {result['coverage']:>6.0%} {result['variant']:>14} "
+              f"{base['fps']:>9.1f} {result['fps']:>8.1f} {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+    print(f"{regressions} regression(s) beyond {threshold:.0%}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chroma key stages on synthetic frames.")
+    parser.add_argument('--sizes', nargs='+', default=['720p', '1080p', '1440p', '4k'], choices=FRAME_SIZES)
+    parser.add_argument('--coverages', nargs='+', type=float, default=[0.5, 0.7, 0.9],
+                        help="Fractions of the frame covered by the green background.")
+    parser.add_argument('--repeat', type=int, default=20, help="Timed iterations per measurement.")
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Most keying threads the scaling suite measures, one per core by default.")
+    parser.add_argument('--save-baseline', metavar='PATH', help="Store the results as a baseline.")
+    parser.add_argument('--compare', metavar='PATH', help="Compare the results with a stored baseline.")
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help="Relative frame rate drop reported as a regression by --compare.")
+    args = parser.parse_args()
+
+    results = []
+    if 'keying' in args.stages:
+        bench_keying(args.sizes, args.coverages, args.repeat, results)
+    if 'scaling' in args.stages:
+        sizes = [size for size in args.sizes if size in SCALING_SIZES] or list(SCALING_SIZES)
+        bench_scaling(sizes, args.workers, args.repeat, results)
+    if 'change' in args.stages:
+        bench_change_detection(args.sizes, args.repeat, results)
+    if 'chroma' in args.stages:
+        bench_apply_chroma_key(args.sizes, args.coverages, args.repeat, results)
+    if 'codec' in args.stages:
+        bench_codec(args.sizes, args.coverages, args.repeat, results)
+    if {'process', 'display', 'overlays', 'memory'} & set(args.stages):
+        # The application code needs a QApplication, run it without a display
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from PyQt5.QtWidgets import QApplication
+        app = QApplication.instance() or QApplication(sys.argv[:1])
+        if 'process' in args.stages:
+            bench_capture_and_process(app, args.sizes, args.coverages, args.repeat, results)
+        if 'display' in args.stages:
+            bench_display(app, args.sizes, args.coverages, args.repeat, results)
+        if 'overlays' in args.stages:
+            bench_overlays(app, args.sizes, args.coverages, args.repeat, results)
+        if 'memory' in args.stages:
+            bench_memory(app, args.sizes, args.repeat, results)
+
+    print_results(results)
+    if args.save_baseline:
+        save_baseline(results, args.save_baseline, args)
+    if args.compare and compare_baseline(results, args.compare, args.threshold):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
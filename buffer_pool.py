@@ -0,0 +1,194 @@
+import threading
+import time
+import weakref
+from collections import OrderedDict
+import numpy as np
+from metrics import METRICS
+
+class BufferPool:
+    """
+    Reuses NumPy buffers across frames instead of allocating new ones on every tick.
+
+    Buffers are keyed by shape and dtype. `acquire` hands out a cached buffer of the key if there is
+    one and allocates a new one otherwise, `release` gives it back to the pool. The pool holds at most
+    `budget` bytes, counting buffers handed out and cached: when a new buffer would exceed it, cached
+    buffers of the least recently used keys are evicted first. When a buffer has to be allocated, e.g.
+    because the frame size changed, cached buffers of keys not acquired for `idle_after` seconds are
+    evicted as well, so the memory of a previous frame size is returned without waiting for the budget
+    to fill up.
+
+    Buffers that are handed out are only referenced weakly: a buffer dropped without being released
+    is freed as usual and counted as leaked.
+
+    Attributes:
+        budget (int): The bytes the pool may hold. When every cached buffer is in use, buffers are still
+            allocated beyond it and counted as pool_over_budget.
+        idle_after (float): Seconds after which the cached buffers of an unused key are evicted.
+        hits (int): Number of acquires served from the cache.
+        misses (int): Number of acquires that allocated a buffer.
+        evictions (int): Number of cached buffers evicted.
+        leaked (int): Number of buffers dropped without being released.
+    """
+    def __init__(self, budget_mb=512, idle_after=2.0):
+        """
+        Initializes an empty pool.
+
+        Args:
+            budget_mb (int): The memory budget in MB.
+            idle_after (float): Seconds after which the cached buffers of an unused key are evicted.
+        """
+        self.budget = budget_mb << 20
+        self.idle_after = idle_after
+        # A weak reference callback may run during an allocation while the lock is held
+        self._lock = threading.RLock()
+        self._free = OrderedDict()
+        self._last_used = {}
+        self._live = {}
+        self._live_bytes = 0
+        self._cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.leaked = 0
+
+    def acquire(self, shape, dtype=np.uint8):
+        """
+        Returns a buffer of the given shape and dtype. Its content is undefined.
+
+        Args:
+            shape (tuple): The shape of the buffer.
+            dtype (dtype): The element type of the buffer.
+
+        Returns:
+            ndarray: The buffer, to be given back with `release` once it is no longer used.
+        """
+        key = (tuple(shape), np.dtype(dtype))
+        with self._lock:
+            now = time.monotonic()
+            self._last_used[key] = now
+            free = self._free.get(key)
+            if free:
+                buffer = free.pop()
+                if not free:
+                    del self._free[key]
+                self._cached_bytes -= buffer.nbytes
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._evict_idle(now)
+                buffer = np.empty(key[0], dtype=key[1])
+                self._trim(buffer.nbytes)
+                if self._live_bytes + self._cached_bytes + buffer.nbytes > self.budget:
+                    METRICS.count('pool_over_budget')
+            ident = id(buffer)
+            self._live[ident] = [weakref.ref(buffer, lambda ref: self._forget(ident, ref)), key, 1]
+            self._live_bytes += buffer.nbytes
+        return buffer
+
+    def retain(self, buffer):
+        """
+        Adds a user to a buffer that is handed out, it returns to the pool once every user released it.
+        """
+        with self._lock:
+            entry = self._entry(buffer)
+            if entry is not None:
+                entry[2] += 1
+
+    def release(self, buffer):
+        """
+        Gives a buffer back to the pool. Buffers that were not acquired from the pool are ignored.
+        """
+        with self._lock:
+            entry = self._entry(buffer)
+            if entry is None:
+                return
+            entry[2] -= 1
+            if entry[2] > 0:
+                return
+            del self._live[id(buffer)]
+            key = entry[1]
+            self._live_bytes -= buffer.nbytes
+            self._free.setdefault(key, []).append(buffer)
+            self._free.move_to_end(key)
+            self._cached_bytes += buffer.nbytes
+            self._trim(0)
+
+    def clear(self):
+        """
+        Evicts every cached buffer. Buffers that are handed out are not affected.
+        """
+        with self._lock:
+            self.evictions += sum(len(free) for free in self._free.values())
+            self._free.clear()
+            self._cached_bytes = 0
+
+    def stats(self):
+        """
+        Returns:
+            dict: The number and MB of buffers handed out ('live') and cached, the hits, misses and hit
+            rate of `acquire`, and the evicted and leaked buffers.
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'live_buffers': len(self._live),
+                'live_mb': round(self._live_bytes / (1 << 20), 1),
+                'cached_buffers': sum(len(free) for free in self._free.values()),
+                'cached_mb': round(self._cached_bytes / (1 << 20), 1),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / requests, 3) if requests else None,
+                'evictions': self.evictions,
+                'leaked': self.leaked,
+            }
+
+    def _entry(self, buffer):
+        entry = self._live.get(id(buffer))
+        if entry is None or entry[0]() is not buffer:
+            return None
+        return entry
+
+    def _forget(self, ident, ref):
+        """
+        Called when a buffer that is handed out was garbage collected without being released.
+        """
+        with self._lock:
+            entry = self._live.get(ident)
+            if entry is None or entry[0] is not ref:
+                return
+            del self._live[ident]
+            shape, dtype = entry[1]
+            self._live_bytes -= int(np.prod(shape)) * dtype.itemsize
+            self.leaked += 1
+        METRICS.count('pool_buffers_leaked')
+
+    def _evict_idle(self, now):
+        for key, last_used in list(self._last_used.items()):
+            if now - last_used > self.idle_after:
+                del self._last_used[key]
+                self._evict_key(key)
+
+    def _trim(self, incoming):
+        """
+        Evicts cached buffers, least recently used keys first, until `incoming` more bytes fit the budget.
+        """
+        while self._free and self._live_bytes + self._cached_bytes + incoming > self.budget:
+            self._evict_key(next(iter(self._free)), 1)
+
+    def _evict_key(self, key, count=None):
+        free = self._free.get(key)
+        if not free:
+            return
+        for _ in range(len(free) if count is None else min(count, len(free))):
+            self._cached_bytes -= free.pop().nbytes
+            self.evictions += 1
+        if not free:
+            del self._free[key]
+
+# The buffer pool of this process, shared by the capture, keying and display stages
+BUFFER_POOL = BufferPool()
+
+METRICS.add_gauge('pool_live_buffers', lambda: BUFFER_POOL.stats()['live_buffers'])
+METRICS.add_gauge('pool_live_mb', lambda: BUFFER_POOL.stats()['live_mb'])
+METRICS.add_gauge('pool_cached_mb', lambda: BUFFER_POOL.stats()['cached_mb'])
+METRICS.add_gauge('pool_hit_rate', lambda: BUFFER_POOL.stats()['hit_rate'])
@@ -1,60 +1,365 @@
-import win32gui
-import win32ui
-from ctypes import windll
+import ctypes
+import threading
+import time
 from PIL import Image
+from frame_source import clip_region
+from buffer_pool import BUFFER_POOL
+from metrics import METRICS
 
-def capture_image(window_name):
+try:
+    import win32gui
+    import win32ui
+    from ctypes import windll
+except ImportError:
+    # Not on Windows, a win32 API (e.g. fake_win32) has to be passed to CaptureSession explicitly
+    win32gui = win32ui = windll = None
+
+# Raster operation copying the source rectangle unchanged (win32con.SRCCOPY)
+SRCCOPY = 0x00CC0020
+
+# GDI objects (DCs and bitmaps) created by every CaptureSession and not released yet
+_live_handles = 0
+_handles_lock = threading.Lock()
+
+def _count_handles(amount):
+    global _live_handles
+    with _handles_lock:
+        _live_handles += amount
+
+def live_gdi_handles():
     """
-    Captures the image of a specified window.
+    Returns:
+        int: The number of GDI objects the capture sessions of this process hold.
+    """
+    return _live_handles
 
-    This function captures the current view of a window given its name. It works by 
-    obtaining the window handle, creating a device context, and copying the window's 
-    content into a bitmap, which is then converted into a PIL Image.
+METRICS.add_gauge('gdi_handles', live_gdi_handles)
+
+class CaptureSession:
+    """
+    A long-lived capture of a single window.
+
+    The window handle is looked up once and the window DC, the compatible DC and the bitmap
+    are kept alive between frames. They are only rebuilt when the window size changes or the
+    handle becomes invalid. While the target window is missing or minimized, capture attempts
+    are retried with an increasing delay instead of on every tick.
+
+    Only the client area is captured. With a `region`, the client area is rendered into the
+    bitmap and just that rectangle is copied into a second bitmap of its size, so the bits
+    handed out contain nothing outside the region.
+
+    With gdi32, the bitmap bits are read into a buffer of the BUFFER_POOL that is reused for every
+    frame of the same size, instead of a new bytes object per frame. Every GDI object is counted
+    while it exists; an object that cannot be released is reported and counted as gdi_handles_leaked,
+    and the remaining objects are released regardless.
 
     Note: 
     - Uncomment the SetProcessDPIAware line if using a high DPI display or scaling > 100%.
-    - Use GetClientRect instead of GetWindowRect to capture just the client area.
 
-    Args:
+    Attributes:
         window_name (str): The title of the window to capture.
+        region (tuple): The (x, y, width, height) rectangle of the client area to capture, or None
+            for the whole client area. It may be changed between captures.
+        hwnd (int): The cached window handle, or None if the window has not been resolved.
+        retry_delay (float): The current delay between capture attempts in seconds, 0 while capturing normally.
+        unavailable_reason (str): Why the window cannot be captured right now, or None.
+        lookups (int): Number of FindWindow lookups performed.
+        rebuilds (int): Number of times the DCs and bitmap were (re)created.
+        handles (int): Number of GDI objects the session holds.
+        leaked_handles (int): Number of GDI objects that could not be released.
+    """
+    def __init__(self, window_name, win32gui_module=None, win32ui_module=None, user32=None,
+                 min_retry_delay=0.1, max_retry_delay=5.0, clock=time.monotonic, region=None, gdi32=None):
+        """
+        Initializes the capture session. The window is resolved on the first capture.
 
-    Returns:
-        Image: A PIL Image object of the captured window.
+        Args:
+            window_name (str): The title of the window to capture.
+            win32gui_module (module, optional): Replacement for the win32gui module, e.g. from fake_win32.
+            win32ui_module (module, optional): Replacement for the win32ui module.
+            user32 (object, optional): Replacement for windll.user32, only PrintWindow is used.
+            min_retry_delay (float): The first retry delay in seconds after the window became unavailable.
+            max_retry_delay (float): The upper limit of the retry delay in seconds.
+            clock (callable): Monotonic clock returning seconds, used for the retry delays.
+            region (tuple, optional): The (x, y, width, height) rectangle of the client area to capture.
+            gdi32 (object, optional): Replacement for windll.gdi32, only GetBitmapBits is used. Without
+                it, replaced win32 modules return the bits through win32ui.
 
-    Raises:
-        ValueError: If the window cannot be captured.
+        Raises:
+            ValueError: If no win32 API is available.
+        """
+        self.win32gui = win32gui_module or win32gui
+        self.win32ui = win32ui_module or win32ui
+        self.user32 = user32 or (windll.user32 if windll is not None else None)
+        # The real gdi32 only knows the handles of the real win32ui
+        self.gdi32 = gdi32 or (windll.gdi32 if windll is not None and win32ui_module is None else None)
+        if self.win32gui is None or self.win32ui is None or self.user32 is None:
+            raise ValueError("The win32 capture API is not available on this system.")
+
+        # Uncomment the following line if you use a high DPI display or >100% scaling size
+        # windll.user32.SetProcessDPIAware()
+
+        self.window_name = window_name
+        self.region = region
+        self.min_retry_delay = min_retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.clock = clock
+
+        self.hwnd = None
+        self.size = None
+        self._hwndDC = None
+        self._mfcDC = None
+        self._saveDC = None
+        self._saveBitMap = None
+        self._regionDC = None
+        self._regionBitMap = None
+        self._regionSize = None
+        self._bits = None
+        self._regionBits = None
+
+        self.retry_delay = 0
+        self._next_attempt = 0
+        self.unavailable_reason = None
+        self.lookups = 0
+        self.rebuilds = 0
+        self.handles = 0
+        self.leaked_handles = 0
+
+    def capture(self):
+        """
+        Captures the current content of the window.
+
+        Returns:
+            tuple or None: The bitmap bits (a bytes-like object of top-down rows of BGRA pixels, valid until
+            the next capture), the width and the height, or None while the window is unavailable or the
+            next retry is not due yet.
+        """
+        if self.clock() < self._next_attempt:
+            return None
+
+        try:
+            result = self._capture()
+        except ValueError as e:
+            self._back_off(str(e))
+            return None
+        except Exception as e:
+            # Most likely the handle went stale between the checks, start over with a fresh lookup
+            self._release_objects()
+            self.hwnd = None
+            self._back_off(f"Error capturing window: {e}")
+            return None
+
+        if self.unavailable_reason is not None:
+            print(f"Capture of '{self.window_name}' resumed.")
+        self.unavailable_reason = None
+        self.retry_delay = 0
+        self._next_attempt = 0
+        return result
+
+    def close(self):
+        """
+        Releases the DCs and the bitmap and forgets the window handle.
+        """
+        self._release_objects()
+        self.hwnd = None
+
+    def _capture(self):
+        """
+        Resolves the window if needed, rebuilds the GDI objects on resize and copies the window content.
+
+        Raises:
+            ValueError: If the window cannot be captured right now.
+        """
+        if self.hwnd is not None and not self.win32gui.IsWindow(self.hwnd):
+            self._release_objects()
+            self.hwnd = None
+
+        if self.hwnd is None:
+            self.lookups += 1
+            hwnd = self.win32gui.FindWindow(None, self.window_name)
+            if not hwnd:
+                raise ValueError(f"Window '{self.window_name}' not found.")
+            self.hwnd = hwnd
+
+        if self.win32gui.IsIconic(self.hwnd):
+            raise ValueError(f"Window '{self.window_name}' is minimized.")
+
+        left, top, right, bot = self.win32gui.GetClientRect(self.hwnd)
+        w = right - left
+        h = bot - top
+        if w <= 0 or h <= 0:
+            raise ValueError(f"Window '{self.window_name}' has no visible area.")
+
+        if (w, h) != self.size:
+            self._build_objects(w, h)
+
+        # PW_CLIENTONLY | PW_RENDERFULLCONTENT: the client area is rendered at the bitmap origin
+        result = self.user32.PrintWindow(self.hwnd, self._saveDC.GetSafeHdc(), 3)
+        if result != 1:
+            raise ValueError("Failure to capture window image.")
+
+        x, y, region_w, region_h = clip_region(self.region, w, h)
+        if (region_w, region_h) == (w, h):
+            return self._read_bits(self._saveBitMap, self._bits), w, h
+
+        if (region_w, region_h) != self._regionSize:
+            self._build_region_objects(region_w, region_h)
+        self._regionDC.BitBlt((0, 0), (region_w, region_h), self._saveDC, (x, y), SRCCOPY)
+        return self._read_bits(self._regionBitMap, self._regionBits), region_w, region_h
+
+    def _read_bits(self, bitmap, buffer):
+        """
+        Copies the bits of a bitmap into its pooled buffer, or returns them as bytes without gdi32.
+        """
+        if buffer is None:
+            return bitmap.GetBitmapBits(True)
+        copied = self.gdi32.GetBitmapBits(ctypes.c_void_p(bitmap.GetHandle()), ctypes.c_long(buffer.nbytes),
+                                          ctypes.c_void_p(buffer.ctypes.data))
+        if copied != buffer.nbytes:
+            raise ValueError("Failure to read the window image.")
+        return buffer
+
+    def _create_bitmap(self, w, h):
+        """
+        Creates a bitmap compatible with the window DC. It is only counted, and returned, once it
+        holds a GDI handle.
+        """
+        bitmap = self.win32ui.CreateBitmap()
+        bitmap.CreateCompatibleBitmap(self._mfcDC, w, h)
+        self._track()
+        return bitmap
+
+    def _build_objects(self, w, h):
+        """
+        (Re)creates the window DC, the compatible DC and a bitmap of the given size.
+
+        Every object is stored as soon as it exists, so the ones created before a failing call are
+        released by _release_objects.
+        """
+        self._release_objects()
+        self.rebuilds += 1
+
+        self._hwndDC = self.win32gui.GetWindowDC(self.hwnd)
+        self._track()
+        self._mfcDC = self.win32ui.CreateDCFromHandle(self._hwndDC)
+        self._track()
+        self._saveDC = self._mfcDC.CreateCompatibleDC()
+        self._track()
+
+        self._saveBitMap = self._create_bitmap(w, h)
+        self._saveDC.SelectObject(self._saveBitMap)
+        if self.gdi32 is not None:
+            self._bits = BUFFER_POOL.acquire((h, w, 4))
+        self.size = (w, h)
+
+    def _build_region_objects(self, w, h):
+        """
+        (Re)creates the compatible DC and the bitmap the capture region is copied into.
+        """
+        self._release_region_objects()
+        self._regionDC = self._mfcDC.CreateCompatibleDC()
+        self._track()
+        self._regionBitMap = self._create_bitmap(w, h)
+        self._regionDC.SelectObject(self._regionBitMap)
+        if self.gdi32 is not None:
+            self._regionBits = BUFFER_POOL.acquire((h, w, 4))
+        self._regionSize = (w, h)
+
+    def _release_region_objects(self):
+        if self._regionBitMap is not None:
+            self._release(self.win32gui.DeleteObject, self._regionBitMap.GetHandle())
+        if self._regionDC is not None:
+            self._release(self._regionDC.DeleteDC)
+        if self._regionBits is not None:
+            BUFFER_POOL.release(self._regionBits)
+        self._regionDC = self._regionBitMap = self._regionBits = None
+        self._regionSize = None
+
+    def _release_objects(self):
+        """
+        Deletes the GDI objects created by _build_objects, tolerating partially built state.
+        """
+        self._release_region_objects()
+        if self._saveBitMap is not None:
+            self._release(self.win32gui.DeleteObject, self._saveBitMap.GetHandle())
+        if self._saveDC is not None:
+            self._release(self._saveDC.DeleteDC)
+        if self._mfcDC is not None:
+            self._release(self._mfcDC.DeleteDC)
+        if self._hwndDC is not None:
+            self._release(self.win32gui.ReleaseDC, self.hwnd, self._hwndDC)
+        if self._bits is not None:
+            BUFFER_POOL.release(self._bits)
+        self._hwndDC = self._mfcDC = self._saveDC = self._saveBitMap = self._bits = None
+        self.size = None
+
+    def _track(self):
+        self.handles += 1
+        _count_handles(1)
+
+    def _release(self, release, *args):
+        """
+        Releases one GDI object, a failure is reported and counted instead of raised so the other
+        objects are still released.
+        """
+        try:
+            release(*args)
+        except Exception as e:
+            self.leaked_handles += 1
+            METRICS.count('gdi_handles_leaked')
+            print(f"Error releasing a GDI object of '{self.window_name}': {e}")
+        self.handles -= 1
+        _count_handles(-1)
+
+    def _back_off(self, reason):
+        """
+        Schedules the next capture attempt with a doubled delay, reporting only changes of the reason.
+        """
+        if reason != self.unavailable_reason:
+            print(f"Capture of '{self.window_name}' paused: {reason}")
+        self.unavailable_reason = reason
+        self.retry_delay = min(self.max_retry_delay, self.retry_delay * 2 if self.retry_delay else self.min_retry_delay)
+        self._next_attempt = self.clock() + self.retry_delay
+
+def capture_window_bits(window_name):
     """
-    hwnd = win32gui.FindWindow(None, window_name)
+    Captures the raw bitmap bits of a specified window once.
 
-    # Uncomment the following line if you use a high DPI display or >100% scaling size
-    # windll.user32.SetProcessDPIAware()
+    Use a CaptureSession to capture the same window repeatedly.
 
-    left, top, right, bot = win32gui.GetWindowRect(hwnd)
-    w = right - left
-    h = bot - top
+    Args:
+        window_name (str): The title of the window to capture.
 
-    hwndDC = win32gui.GetWindowDC(hwnd)
-    mfcDC = win32ui.CreateDCFromHandle(hwndDC)
-    saveDC = mfcDC.CreateCompatibleDC()
+    Returns:
+        tuple: The bitmap bits (bytes, top-down rows of BGRA pixels), the width and the height.
 
-    saveBitMap = win32ui.CreateBitmap()
-    saveBitMap.CreateCompatibleBitmap(mfcDC, w, h)
+    Raises:
+        ValueError: If the window cannot be captured.
+    """
+    session = CaptureSession(window_name)
+    try:
+        bits, width, height = session._capture()
+        # Copy the bits out of the session's buffer before it goes back to the pool
+        bits = bytes(bits)
+    finally:
+        session.close()
+    return bits, width, height
 
-    saveDC.SelectObject(saveBitMap)
-    result = windll.user32.PrintWindow(hwnd, saveDC.GetSafeHdc(), 3)
+def capture_image(window_name):
+    """
+    Captures the image of a specified window.
 
-    bmpinfo = saveBitMap.GetInfo()
-    bmpstr = saveBitMap.GetBitmapBits(True)
+    This function captures the current view of a window given its name and converts 
+    the copied bitmap into a PIL Image.
 
-    im = Image.frombuffer('RGBA', (bmpinfo['bmWidth'], bmpinfo['bmHeight']), bmpstr, 'raw', 'RGBA', 0, 1)
+    Args:
+        window_name (str): The title of the window to capture.
 
-    win32gui.DeleteObject(saveBitMap.GetHandle())
-    saveDC.DeleteDC()
-    mfcDC.DeleteDC()
-    win32gui.ReleaseDC(hwnd, hwndDC)
+    Returns:
+        Image: A PIL Image object of the captured window.
 
-    if result == 1:
-        # Success
-        return im
-    
-    raise ValueError("Failure to capture window image.")
\ No newline at end of file
+    Raises:
+        ValueError: If the window cannot be captured.
+    """
+    bmpstr, width, height = capture_window_bits(window_name)
+    return Image.frombuffer('RGBA', (width, height), bmpstr, 'raw', 'RGBA', 0, 1)
\ No newline at end of file
@@ -0,0 +1,429 @@
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from PyQt5.QtCore import Qt, QThread, QSize, QPoint, QRect, pyqtSignal
+from PyQt5.QtGui import QImage
+from utils import capture_and_process_target_window, capture_target_frame
+from frame_source import crop_frame, union_region
+from pipeline import display_size
+from buffer_pool import BUFFER_POOL
+from metrics import METRICS
+
+RenderedFrame = namedtuple('RenderedFrame', ['image', 'captured_at', 'damage', 'buffer', 'box', 'size'],
+                           defaults=[None, None, None, None])
+RenderedFrame.__doc__ = """
+The part of a keyed frame the overlay shows, at the size it is shown at, ready to be painted.
+
+Attributes:
+    image (QImage): The frame in Format_ARGB32_Premultiplied, or only its opaque part when `box` is
+        given. Its pixels are independent of the pipeline buffers, so it outlives them.
+    captured_at (float): Monotonic time at which capturing the frame started, in seconds.
+    damage (QRect): The part of the frame that differs from the previous frame, or None if all of it may.
+    buffer (ndarray): The pooled buffer holding the pixels of `image`, or None if Qt owns them. It
+        goes back to the BUFFER_POOL with `release_frame` once the frame is no longer shown.
+    box (QRect): Where `image` lies in the frame; everything around it is transparent. None if
+        `image` is the whole frame.
+    size (QSize): The size of the whole frame, None if `image` is the whole frame.
+"""
+
+# Smooth scaling blends neighbouring pixels, so damage spreads by a pixel around the keyed area
+DAMAGE_MARGIN = 2
+
+def scale_damage(damage, width, height, shown):
+    """
+    Maps a damaged (x0, y0, x1, y1) box of a frame to a QRect on the frame shown at the `shown` QSize.
+    """
+    x0, y0, x1, y1 = damage
+    sx, sy = shown.width() / width, shown.height() / height
+    rect = QRect(int(x0 * sx) - DAMAGE_MARGIN, int(y0 * sy) - DAMAGE_MARGIN,
+                 int((x1 - x0) * sx) + 2 * DAMAGE_MARGIN + 1, int((y1 - y0) * sy) + 2 * DAMAGE_MARGIN + 1)
+    return rect.intersected(QRect(QPoint(0, 0), shown))
+
+def display_image(pixels, width, height):
+    """
+    Copies premultiplied BGRA pixels into a pooled buffer of the given size, scaling them if they
+    have another size, and wraps the buffer into a QImage.
+
+    Returns:
+        tuple: The Format_ARGB32_Premultiplied QImage and the buffer holding its pixels.
+    """
+    buffer = BUFFER_POOL.acquire((height, width, 4))
+    if pixels.shape[:2] == (height, width):
+        np.copyto(buffer, pixels)
+    else:
+        interpolation = cv2.INTER_AREA if width < pixels.shape[1] else cv2.INTER_LINEAR
+        cv2.resize(pixels, (width, height), dst=buffer, interpolation=interpolation)
+    return QImage(buffer.data, width, height, buffer.strides[0], QImage.Format_ARGB32_Premultiplied), buffer
+
+def display_opaque(pixels, opaque, width, height):
+    """
+    Scales and wraps only the opaque part of keyed pixels for a frame shown at width x height, see
+    display_image. The transparent rest of the frame is neither scaled nor copied.
+
+    Args:
+        pixels (ndarray): The (height, width, 4) premultiplied BGRA pixels.
+        opaque (tuple): The (x0, y0, x1, y1) bounding box of the opaque pixels, empty if there are none.
+        width (int): The width the frame is shown at.
+        height (int): The height the frame is shown at.
+
+    Returns:
+        tuple: The QImage of the opaque part (a null QImage if there is none), the buffer holding its
+        pixels or None, and the QRect it takes up of the shown frame.
+    """
+    x0, y0, x1, y1 = opaque
+    if x0 >= x1 or y0 >= y1:
+        return QImage(), None, QRect()
+    source_height, source_width = pixels.shape[:2]
+    if (source_width, source_height) == (width, height):
+        box = QRect(x0, y0, x1 - x0, y1 - y0)
+    else:
+        # Round outwards, so the box covers every shown pixel an opaque pixel contributes to
+        left, top = x0 * width // source_width, y0 * height // source_height
+        box = QRect(left, top, -(-x1 * width // source_width) - left, -(-y1 * height // source_height) - top)
+    image, buffer = display_image(pixels[y0:y1, x0:x1], box.width(), box.height())
+    return image, buffer, box
+
+def release_frame(frame):
+    """
+    Gives the pooled buffer of a rendered frame back, once it is no longer shown or was dropped.
+    """
+    if frame is not None and frame.buffer is not None:
+        BUFFER_POOL.release(frame.buffer)
+
+def render_frame(settings, pipeline, target_size, frame=None):
+    """
+    Captures, keys and scales one frame. Safe to call from any thread, it touches no widgets.
+
+    Only the part of the frame the overlay shows is keyed, already downscaled to the size it is
+    shown at. Frames smaller than that are scaled up after keying. Of fused frames, only the
+    bounding box of the opaque pixels is scaled and copied into a pooled buffer, release it with
+    `release_frame` once the frame has been replaced on screen.
+
+    Args:
+        settings (CompiledConfig): The compiled application configuration.
+        pipeline (FramePipeline): The fused pipeline, used when pipeline_settings.mode is 'fused'. The
+            legacy path only uses its keyer.
+        target_size (QSize): The size of the overlay.
+        frame (Frame, optional): An already captured frame to render instead of capturing one.
+
+    Returns:
+        RenderedFrame or None: The frame, or None if nothing was captured or the frame did not change.
+    """
+    captured_at = time.monotonic() if frame is None else frame.timestamp
+    damage = None
+    view_size = (target_size.width(), target_size.height())
+    if settings.fused:
+        image = capture_and_process_target_window(settings, pipeline, view_size, frame)
+        image_format = QImage.Format_ARGB32_Premultiplied
+        if image is not None:
+            opaque = pipeline.opaque
+            if pipeline.change_detector is not None:
+                damage = pipeline.damage
+    else:
+        # The keyer of the pipeline follows the chroma key method and mask scale of the settings
+        image = capture_and_process_target_window(settings, view_size=view_size, frame=frame, keyer=pipeline.keyer)
+        image_format = QImage.Format_ARGB32
+    if image is None:
+        return None
+
+    started = time.perf_counter()
+    # The keyed image is BGRA in memory, which is what the ARGB32 formats expect on little-endian machines
+    height, width, channel = image.shape
+    shown = QSize(*display_size(width, height, *view_size))
+    buffer = box = size = None
+    if settings.fused:
+        # Detach the opaque pixels from the pipeline buffers into a buffer of the pool
+        scaled, buffer, box = display_opaque(image, opaque, shown.width(), shown.height())
+        size = shown
+    else:
+        qImg = QImage(image.data, width, height, image.strides[0], image_format)
+        if shown == qImg.size():
+            # Detach the pixels from the NumPy buffer
+            scaled = qImg.copy()
+        else:
+            scaled = qImg.scaled(shown, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        # Convert here rather than have the painter do it on the GUI thread
+        scaled = scaled.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+    if damage is not None:
+        damage = scale_damage(damage, width, height, shown)
+    METRICS.record('upload', time.perf_counter() - started)
+    return RenderedFrame(scaled, captured_at, damage, buffer, box, size)
+
+class FrameMailbox:
+    """
+    A single-slot, thread-safe handoff where the latest frame wins.
+
+    Putting a frame replaces the one waiting in the slot, so a slow consumer never works
+    through a backlog of stale frames. The buffer of a replaced frame goes back to the pool.
+
+    Attributes:
+        dropped (int): Number of frames replaced before they were taken.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._item = None
+        self.dropped = 0
+
+    def put(self, item):
+        """
+        Places an item in the slot, dropping the one that was waiting.
+        """
+        with self._lock:
+            dropped, self._item = self._item, item
+            if dropped is not None:
+                self.dropped += 1
+                METRICS.count('frames_dropped')
+        release_frame(dropped)
+
+    def take(self):
+        """
+        Empties the slot.
+
+        Returns:
+            The waiting item, or None if the slot is empty.
+        """
+        with self._lock:
+            item, self._item = self._item, None
+            return item
+
+class LatencyTracker:
+    """
+    Keeps the most recent input-to-display latencies.
+    """
+    def __init__(self, size=600):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def summary(self):
+        """
+        Returns:
+            str: The mean, 95th percentile and maximum of the recorded latencies in milliseconds.
+        """
+        if not self.samples:
+            return "no frames displayed"
+        ordered = sorted(self.samples)
+        mean = sum(ordered) / len(ordered)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return (f"mean {mean * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms, max {ordered[-1] * 1000:.1f} ms "
+                f"over {len(ordered)} frames")
+
+class CaptureWorker(QThread):
+    """
+    Captures, keys and scales frames on a background thread.
+
+    Finished frames are put into a FrameMailbox and announced with `frameReady`, so the GUI
+    thread only has to paint the latest one.
+
+    Attributes:
+        mailbox (FrameMailbox): Holds the latest rendered frame.
+        target_size (QSize): The size frames are scaled to, set from the GUI thread on resize.
+    """
+    frameReady = pyqtSignal()
+
+    def __init__(self, window):
+        """
+        Initializes the worker.
+
+        Args:
+            window (TransparentWindow): The window whose settings and pipeline are used.
+        """
+        super().__init__()
+        self.window = window
+        self.mailbox = FrameMailbox()
+        self.target_size = QSize(window.size())
+        self._stop = threading.Event()
+
+    def run(self):
+        """
+        Renders frames at the pace set by the window's FrameScheduler until `stop` is called.
+        """
+        while not self._stop.is_set():
+            started = time.monotonic()
+            frame = render_frame(self.window.settings, self.window.pipeline, self.target_size)
+            scheduler = self.window.scheduler
+            scheduler.record(time.monotonic() - started, frame is not None)
+            if frame is not None:
+                self.mailbox.put(frame)
+                self.frameReady.emit()
+            self._stop.wait(scheduler.delay(started))
+
+    def stop(self):
+        """
+        Asks the loop to finish, waits for the thread to exit and releases the frame left waiting.
+        """
+        self._stop.set()
+        self.wait()
+        release_frame(self.mailbox.take())
+
+class _GroupMember:
+    """
+    The state a CaptureGroup keeps for one overlay.
+    """
+    def __init__(self, window, index):
+        self.window = window
+        self.index = index
+        self.mailbox = FrameMailbox()
+        self.target_size = QSize(window.size())
+        self.next_at = 0.0
+
+class CaptureGroup(QThread):
+    """
+    Captures, keys and scales frames for several overlays on one scheduling thread and a shared worker pool.
+
+    Each overlay keeps its own FrameScheduler, pipeline and mailbox. When an overlay is due, every
+    overlay capturing the same window that is due within half its interval is served by the same
+    capture: the window is grabbed once, over the union of their capture regions, and each overlay
+    keys its own crop of the frame. Overlays showing the same part of the window at the same size
+    and with the same keying share the keyed frame as well; an overlay given a frame keyed by
+    another one repaints it whole and keys its next frame whole. Different windows are captured and keyed
+    in parallel on the pool, so the cost grows with the number of captured windows rather than the
+    number of overlays.
+
+    Attributes:
+        frameReady (pyqtSignal): Emitted with the index of the overlay that has a new frame waiting.
+    """
+    frameReady = pyqtSignal(int)
+
+    def __init__(self, workers=None):
+        """
+        Initializes the group. Overlays are added with `add` before the group is started.
+
+        Args:
+            workers (int, optional): Threads of the pool, by default one per overlay up to the number of cores.
+        """
+        super().__init__()
+        self.workers = workers
+        self._members = []
+        self._stop = threading.Event()
+
+    def add(self, window):
+        """
+        Adds an overlay to the group.
+
+        Args:
+            window (TransparentWindow): The overlay, whose settings, pipeline and scheduler are used.
+
+        Returns:
+            int: The index of the overlay, passed with `frameReady`.
+        """
+        member = _GroupMember(window, len(self._members))
+        self._members.append(member)
+        return member.index
+
+    def take(self, index):
+        """
+        Returns the latest frame rendered for an overlay, or None if none is waiting.
+        """
+        return self._members[index].mailbox.take()
+
+    def setTargetSize(self, index, size):
+        """
+        Sets the size frames of an overlay are scaled to, from the GUI thread on resize.
+        """
+        self._members[index].target_size = QSize(size)
+
+    def dropped(self):
+        """
+        Returns:
+            int: Number of frames replaced in the mailboxes before they were taken.
+        """
+        return sum(member.mailbox.dropped for member in self._members)
+
+    def run(self):
+        """
+        Serves the overlays at the pace set by their schedulers until `stop` is called.
+        """
+        workers = self.workers or min(len(self._members), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max(1, workers), thread_name_prefix='capture-group') as pool:
+            while not self._stop.is_set():
+                next_at = self.tick(pool)
+                self._stop.wait(max(0.0, next_at - time.monotonic()))
+
+    def tick(self, pool=None):
+        """
+        Captures and renders a frame for every overlay that is due.
+
+        Args:
+            pool (Executor, optional): Renders the captured windows in parallel, one after the other without it.
+
+        Returns:
+            float: The monotonic time at which the next overlay is due.
+        """
+        now = time.monotonic()
+        sources = {}
+        for member in self._members:
+            settings = member.window.settings
+            sources.setdefault((settings.backend, settings.title), []).append((member, settings))
+        tasks = []
+        for (backend, title), members in sources.items():
+            if all(member.next_at > now for member, _ in members):
+                continue
+            # Overlays due soon ride along with the capture instead of grabbing the window again
+            riders = [(member, settings) for member, settings in members
+                      if member.next_at - now <= member.window.scheduler.interval() / 2]
+            if pool is None:
+                self._render(backend, title, riders)
+            else:
+                tasks.append(pool.submit(self._render, backend, title, riders))
+        for task in tasks:
+            task.result()
+        return min((member.next_at for member in self._members), default=now + 0.1)
+
+    def _render(self, backend, title, riders):
+        """
+        Grabs one frame of a window and renders it for every overlay in `riders`.
+        """
+        started = time.monotonic()
+        region = union_region([settings.region for _, settings in riders])
+        frame = capture_target_frame(title, backend, region)
+        # The capture is shared, so is its cost
+        capture_cost = (time.monotonic() - started) / len(riders)
+        if frame is None:
+            METRICS.count('capture_unavailable')
+        shared = {}
+        for member, settings in riders:
+            begun = time.monotonic()
+            rendered = None
+            if frame is not None:
+                key = (settings.region, settings.keyer, settings.fused, settings.bounds_key,
+                       member.target_size.width(), member.target_size.height())
+                rendered = shared.get(key)
+                if rendered is not None:
+                    # Every overlay showing the frame releases its buffer
+                    if rendered.buffer is not None:
+                        BUFFER_POOL.retain(rendered.buffer)
+                    # The damage is relative to the frame the first overlay showed before, and this
+                    # overlay's change detector has not seen the frame it now shows
+                    rendered = rendered._replace(damage=None)
+                    member.window.pipeline.invalidate()
+                else:
+                    # A frame unchanged for the first overlay may still be new to this one, key it here
+                    try:
+                        part = crop_frame(frame, settings.region, region)
+                    except ValueError:
+                        part = None
+                    if part is not None:
+                        rendered = render_frame(settings, member.window.pipeline, member.target_size, part)
+                    if rendered is not None:
+                        shared[key] = rendered
+            scheduler = member.window.scheduler
+            scheduler.record(capture_cost + time.monotonic() - begun, rendered is not None)
+            member.next_at = started + scheduler.interval()
+            if rendered is not None:
+                member.mailbox.put(rendered)
+                self.frameReady.emit(member.index)
+
+    def stop(self):
+        """
+        Asks the loop to finish, waits for the thread to exit and releases the frames left waiting.
+        """
+        self._stop.set()
+        self.wait()
+        for member in self._members:
+            release_frame(member.mailbox.take())
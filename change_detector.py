@@ -0,0 +1,147 @@
+import time
+import numpy as np
+
+class ChangeDetector:
+    """
+    Finds the tiles of a frame that changed since they were last keyed.
+
+    Every `sample_step`-th row of the frame is compared with a reference copy of the pixels the
+    current output was keyed from. The sampled rows rotate from frame to frame, so a change that
+    only touches unsampled rows is still found within `sample_step` frames. Comparing exact pixel
+    values instead of hashes rules out collisions.
+
+    Attributes:
+        tile_size (int): Edge length of a square tile in pixels.
+        sample_step (int): Only every sample_step-th row is compared per frame.
+        frames (int): Number of frames checked.
+        skipped_frames (int): Number of frames without any change.
+        dirty_tiles (int): Number of dirty tiles reported in total.
+        skipped_per_second (float): Frames without any change during the last full second.
+        dirty_tiles_per_second (float): Dirty tiles reported during the last full second.
+    """
+    def __init__(self, tile_size=64, sample_step=4):
+        """
+        Initializes the detector.
+
+        Args:
+            tile_size (int): Edge length of a square tile in pixels.
+            sample_step (int): Only every sample_step-th row is compared per frame, at most tile_size.
+        """
+        self.tile_size = tile_size
+        self.sample_step = min(sample_step, tile_size)
+        self.frames = 0
+        self.skipped_frames = 0
+        self.dirty_tiles = 0
+        self.skipped_per_second = 0.0
+        self.dirty_tiles_per_second = 0.0
+        self._window_start = time.monotonic()
+        self._window_counts = (0, 0)
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the reference frame, so the next frame is reported as entirely dirty.
+        """
+        self._reference = None
+        self._phase = 0
+
+    def tile_grid(self, height, width):
+        """
+        Returns the number of tile rows and tile columns of a frame of the given size.
+        """
+        return -(-height // self.tile_size), -(-width // self.tile_size)
+
+    def detect(self, data):
+        """
+        Compares a frame with the reference and returns its dirty tiles.
+
+        Args:
+            data (ndarray): The (height, width, 4) frame pixels.
+
+        Returns:
+            ndarray: A (tile rows, tile columns) bool array, True for tiles that changed. Every tile is
+            dirty for the first frame, after `reset` and when the frame size changes.
+        """
+        height, width = data.shape[:2]
+        pixels = data.view(np.uint32)[..., 0]
+        self.frames += 1
+
+        if self._reference is None or self._reference.shape != (height, width):
+            self._allocate(height, width)
+            dirty = np.ones(self.tile_grid(height, width), dtype=bool)
+        else:
+            phase = self._phase
+            self._phase = (phase + 1) % self.sample_step
+            sampled = pixels[phase::self.sample_step]
+            diff = np.not_equal(sampled, self._reference[phase::self.sample_step], out=self._diff[:sampled.shape[0]])
+            if not diff.any():
+                dirty = np.zeros(self.tile_grid(height, width), dtype=bool)
+            else:
+                dirty = self._reduce_to_tiles(diff, phase)
+
+        count = int(np.count_nonzero(dirty))
+        self.dirty_tiles += count
+        if count == 0:
+            self.skipped_frames += 1
+        self._update_rates()
+        return dirty
+
+    def update(self, data, dirty):
+        """
+        Copies the dirty tiles of a keyed frame into the reference.
+
+        Args:
+            data (ndarray): The (height, width, 4) frame pixels that were keyed.
+            dirty (ndarray): The dirty tiles returned by `detect` for this frame.
+        """
+        pixels = data.view(np.uint32)[..., 0]
+        if dirty.all():
+            np.copyto(self._reference, pixels)
+            return
+        for y0, y1, x0, x1 in self.dirty_spans(dirty, *pixels.shape):
+            self._reference[y0:y1, x0:x1] = pixels[y0:y1, x0:x1]
+
+    def dirty_spans(self, dirty, height, width):
+        """
+        Yields one (y0, y1, x0, x1) pixel rectangle per tile row, spanning its first to last dirty tile.
+        """
+        tile = self.tile_size
+        for row in np.flatnonzero(dirty.any(axis=1)):
+            columns = np.flatnonzero(dirty[row])
+            yield (row * tile, min((row + 1) * tile, height),
+                   columns[0] * tile, min((columns[-1] + 1) * tile, width))
+
+    def _allocate(self, height, width):
+        self._reference = np.empty((height, width), dtype=np.uint32)
+        self._diff = np.empty((-(-height // self.sample_step), width), dtype=bool)
+        self._phase = 0
+        tile_rows, tile_cols = self.tile_grid(height, width)
+        self._column_starts = np.arange(tile_cols) * self.tile_size
+
+        # For every phase: the tile row of each sampled row, and where each tile row starts among them
+        self._row_layout = []
+        for phase in range(self.sample_step):
+            tile_of_sample = (np.arange(phase, height, self.sample_step)) // self.tile_size
+            starts = np.searchsorted(tile_of_sample, np.arange(tile_rows))
+            has_samples = np.isin(np.arange(tile_rows), tile_of_sample)
+            self._row_layout.append((starts[has_samples], has_samples))
+
+    def _reduce_to_tiles(self, diff, phase):
+        """
+        Reduces the per-pixel differences of the sampled rows to one flag per tile.
+        """
+        starts, has_samples = self._row_layout[phase]
+        per_row = np.logical_or.reduceat(diff, self._column_starts, axis=1)
+        dirty = np.zeros((len(has_samples), per_row.shape[1]), dtype=bool)
+        dirty[has_samples] = np.logical_or.reduceat(per_row, starts, axis=0)
+        return dirty
+
+    def _update_rates(self):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed >= 1.0:
+            skipped, dirty = self._window_counts
+            self.skipped_per_second = (self.skipped_frames - skipped) / elapsed
+            self.dirty_tiles_per_second = (self.dirty_tiles - dirty) / elapsed
+            self._window_start = now
+            self._window_counts = (self.skipped_frames, self.dirty_tiles)
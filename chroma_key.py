@@ -0,0 +1,415 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import cv2
+import numpy as np
+
+# The number of threads OpenCV parallelizes its calls with by default
+OPENCV_THREADS = cv2.getNumThreads()
+
+class HSVKeyer:
+    """
+    Computes the chroma key alpha by converting every pixel to HSV and testing it against the bounds.
+
+    This is the reference keyer, it matches `utils.apply_chroma_key` exactly.
+    """
+    def __init__(self):
+        self._hsv = None
+        self._mask = None
+
+    def alpha(self, image, hsv_lower, hsv_upper, out=None):
+        """
+        Computes the alpha channel for an image.
+
+        Args:
+            image (ndarray): The (height, width, 4) BGRA or BGRX image, the fourth byte is ignored.
+            hsv_lower (ndarray): The lower bound of the HSV values to be made transparent.
+            hsv_upper (ndarray): The upper bound of the HSV values to be made transparent.
+            out (ndarray, optional): A (height, width) uint8 buffer to write the alpha into.
+
+        Returns:
+            ndarray: The alpha channel, 0 for keyed pixels and 255 for everything else.
+        """
+        height, width = image.shape[:2]
+        if self._hsv is None or self._hsv.shape[:2] != (height, width):
+            self._hsv = np.empty((height, width, 3), dtype=np.uint8)
+        if out is None:
+            if self._mask is None or self._mask.shape != (height, width):
+                self._mask = np.empty((height, width), dtype=np.uint8)
+            out = self._mask
+
+        cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=self._hsv)
+        cv2.inRange(self._hsv, hsv_lower, hsv_upper, dst=out)
+        cv2.bitwise_not(out, dst=out)
+        return out
+
+class LUTKeyer:
+    """
+    Computes the chroma key alpha with a lookup table indexed by the packed 24-bit BGR color.
+
+    The HSV bounds are compiled once into a table holding the alpha of every 24-bit color, built
+    with the same cvtColor/inRange calls as HSVKeyer, so the result is bit-identical to it. The
+    table is only rebuilt when the bounds change. Keying a frame is then one mask of the packed
+    pixels and a single vectorised gather.
+
+    The table stores one byte per color (16 MB) rather than one bit (2 MB): unpacking bits costs
+    four extra passes over the frame, which is more than the cache misses it saves.
+
+    Attributes:
+        bounds (tuple): The (lower, upper) HSV bounds the table was built for, or None.
+        builds (int): Number of times the table was built.
+    """
+    COLORS = 1 << 24
+    CHUNK = 1 << 20
+
+    def __init__(self):
+        self.bounds = None
+        self.builds = 0
+        self._table = None
+        self._index = None
+        self._mask = None
+
+    def compile(self, hsv_lower, hsv_upper):
+        """
+        Builds the lookup table for the given bounds, unless it was built for them already.
+
+        Args:
+            hsv_lower (ndarray): The lower bound of the HSV values to be made transparent.
+            hsv_upper (ndarray): The upper bound of the HSV values to be made transparent.
+        """
+        bounds = (tuple(int(v) for v in hsv_lower), tuple(int(v) for v in hsv_upper))
+        if bounds == self.bounds:
+            return
+
+        table = np.empty(self.COLORS, dtype=np.uint8)
+        side = int(np.sqrt(self.CHUNK))
+        for start in range(0, self.COLORS, self.CHUNK):
+            # Every packed value B | G << 8 | R << 16 of the chunk, viewed as a BGRX image
+            colors = np.arange(start, start + self.CHUNK, dtype=np.uint32).view(np.uint8).reshape(side, side, 4)
+            hsv = cv2.cvtColor(colors, cv2.COLOR_BGR2HSV)
+            cv2.inRange(hsv, hsv_lower, hsv_upper, dst=table[start:start + self.CHUNK].reshape(side, side))
+        cv2.bitwise_not(table, dst=table)
+
+        self._table = table
+        self.bounds = bounds
+        self.builds += 1
+
+    def share(self, other):
+        """
+        Uses the table another LUTKeyer built instead of building one. The table is only read once built,
+        so keyers on different threads can share it.
+
+        Args:
+            other (LUTKeyer): The keyer whose table is used, compiled for the bounds to key with.
+        """
+        self._table = other._table
+        self.bounds = other.bounds
+
+    def alpha(self, image, hsv_lower, hsv_upper, out=None):
+        """
+        Computes the alpha channel for an image.
+
+        Args:
+            image (ndarray): The (height, width, 4) BGRA or BGRX image, the fourth byte is ignored.
+            hsv_lower (ndarray): The lower bound of the HSV values to be made transparent.
+            hsv_upper (ndarray): The upper bound of the HSV values to be made transparent.
+            out (ndarray, optional): A (height, width) uint8 buffer to write the alpha into.
+
+        Returns:
+            ndarray: The alpha channel, 0 for keyed pixels and 255 for everything else.
+        """
+        self.compile(hsv_lower, hsv_upper)
+
+        height, width = image.shape[:2]
+        if self._index is None or self._index.shape != (height, width):
+            self._index = np.empty((height, width), dtype=np.intp)
+        if out is None:
+            if self._mask is None or self._mask.shape != (height, width):
+                self._mask = np.empty((height, width), dtype=np.uint8)
+            out = self._mask
+
+        np.bitwise_and(image.view(np.uint32)[..., 0], np.uint32(0xFFFFFF), out=self._index, casting='unsafe')
+        np.take(self._table, self._index, out=out, mode='clip')
+        return out
+
+class ScaledKeyer:
+    """
+    Computes the chroma key alpha at a reduced resolution and refines it along the mask edges.
+
+    Every `scale`-th pixel of every `scale`-th row is keyed by the wrapped keyer (sampling, not
+    averaging, so only real pixel colors are keyed) and the alpha is upsampled again. Samples whose
+    3x3 neighbourhood contains both keyed and opaque samples mark the mask edges; the
+    `scale` x `scale` blocks of full-resolution pixels they stand for are keyed again exactly. On frames dominated by flat backgrounds this keys
+    roughly 1/scale² of the pixels. Features thinner than `scale` pixels that lie entirely between
+    two samples can be missed, see `mask_mismatch`.
+
+    Attributes:
+        keyer (HSVKeyer or LUTKeyer): The keyer used for the low-resolution and the edge pixels.
+        scale (int): The downsampling factor, e.g. 2 or 4.
+        refined (int): Number of full-resolution pixels keyed again for the last frame.
+    """
+    KERNEL = np.ones((3, 3), dtype=np.uint8)
+
+    def __init__(self, keyer, scale):
+        """
+        Initializes the keyer.
+
+        Args:
+            keyer (HSVKeyer or LUTKeyer): The keyer to wrap.
+            scale (int): The downsampling factor, e.g. 2 or 4.
+        """
+        self.keyer = keyer
+        self.scale = scale
+        self.refined = 0
+        self._shape = None
+        self._mask = None
+
+    def _allocate(self, height, width):
+        small_height, small_width = -(-height // self.scale), -(-width // self.scale)
+        self._small = np.empty((small_height, small_width, 4), dtype=np.uint8)
+        self._small_alpha = np.empty((small_height, small_width), dtype=np.uint8)
+        self._small_edges = np.empty((small_height, small_width), dtype=np.uint8)
+        # Upsampling by an exact integer factor maps pixel x to sample x // scale
+        up_shape = (small_height * self.scale, small_width * self.scale)
+        self._up = None if up_shape == (height, width) else np.empty(up_shape, dtype=np.uint8)
+        self._offsets = np.arange(self.scale)
+        self._shape = (height, width)
+
+    def alpha(self, image, hsv_lower, hsv_upper, out=None):
+        """
+        Computes the alpha channel for an image.
+
+        Args:
+            image (ndarray): The (height, width, 4) BGRA or BGRX image, the fourth byte is ignored.
+            hsv_lower (ndarray): The lower bound of the HSV values to be made transparent.
+            hsv_upper (ndarray): The upper bound of the HSV values to be made transparent.
+            out (ndarray, optional): A (height, width) uint8 buffer to write the alpha into.
+
+        Returns:
+            ndarray: The alpha channel, 0 for keyed pixels and 255 for everything else.
+        """
+        height, width = image.shape[:2]
+        if self._shape != (height, width):
+            self._allocate(height, width)
+        if out is None:
+            if self._mask is None or self._mask.shape != (height, width):
+                self._mask = np.empty((height, width), dtype=np.uint8)
+            out = self._mask
+
+        scale = self.scale
+        # Copy whole pixels at once, a strided uint8 copy is several times slower
+        np.copyto(self._small.view(np.uint32)[..., 0], image.view(np.uint32)[::scale, ::scale, 0])
+        self.keyer.alpha(self._small, hsv_lower, hsv_upper, out=self._small_alpha)
+
+        # Non-zero wherever the 3x3 neighbourhood holds both keyed and opaque samples
+        cv2.morphologyEx(self._small_alpha, cv2.MORPH_GRADIENT, self.KERNEL, dst=self._small_edges)
+
+        up_size = (self._small.shape[1] * scale, self._small.shape[0] * scale)
+        if self._up is None:
+            cv2.resize(self._small_alpha, up_size, dst=out, interpolation=cv2.INTER_NEAREST)
+        else:
+            cv2.resize(self._small_alpha, up_size, dst=self._up, interpolation=cv2.INTER_NEAREST)
+            np.copyto(out, self._up[:height, :width])
+
+        # Key the full-resolution blocks behind the edge samples again
+        edge_points = cv2.findNonZero(self._small_edges)
+        self.refined = 0
+        if edge_points is not None:
+            block_xs, block_ys = edge_points[:, 0, 0], edge_points[:, 0, 1]
+            ys = np.minimum(block_ys[:, None, None] * scale + self._offsets[None, :, None], height - 1)
+            xs = np.minimum(block_xs[:, None, None] * scale + self._offsets[None, None, :], width - 1)
+            ys, xs = np.broadcast_arrays(ys, xs)
+            colors = image[ys, xs].reshape(-1, 1, 4)
+            out[ys, xs] = self.keyer.alpha(colors, hsv_lower, hsv_upper).reshape(ys.shape)
+            self.refined = ys.size
+        return out
+
+class ParallelKeyer:
+    """
+    Computes the chroma key alpha in stripes of rows on a persistent pool of threads.
+
+    Every worker has its own keyer, as keyers keep scratch buffers, and keys its stripe of the
+    image straight into its rows of the output. OpenCV and NumPy release the GIL while they work,
+    so the stripes are keyed in parallel. The calling thread keys the first stripe itself, so the
+    pool has one thread less than there are workers. LUTKeyers share the table of the first one,
+    which is built once. The pool is started on first use and stopped by `close`.
+
+    Images with fewer than MIN_ROWS rows per worker, e.g. small dirty tiles, are split into fewer stripes.
+
+    Attributes:
+        workers (int): The number of stripes an image is split into at most.
+        keyers (list): The keyer of every worker.
+    """
+    MIN_ROWS = 32
+
+    def __init__(self, create, workers):
+        """
+        Initializes the keyer.
+
+        Args:
+            create (callable): Creates the keyer of a worker, e.g. HSVKeyer or LUTKeyer.
+            workers (int): The number of workers, including the calling thread.
+        """
+        self.workers = workers
+        self.keyers = [create() for _ in range(workers)]
+        self._pool = None
+        self._mask = None
+
+    def close(self):
+        """
+        Stops the threads of the pool without waiting for them. The keyer can still be used, it starts
+        a new pool then, and a frame being keyed meanwhile keys its remaining stripes on the calling thread.
+        """
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def compile(self, hsv_lower, hsv_upper):
+        """
+        Prepares the keyers of the workers for the given bounds: a lookup table is built only once.
+
+        Args:
+            hsv_lower (ndarray): The lower bound of the HSV values to be made transparent.
+            hsv_upper (ndarray): The upper bound of the HSV values to be made transparent.
+        """
+        first = self.keyers[0]
+        if isinstance(first, LUTKeyer):
+            first.compile(hsv_lower, hsv_upper)
+            for keyer in self.keyers[1:]:
+                if keyer.bounds != first.bounds:
+                    keyer.share(first)
+
+    def map(self, function, height):
+        """
+        Calls `function(keyer, rows)` for stripes of rows covering `height` rows, in parallel, and waits
+        for all of them. `rows` is the slice of the rows of the stripe and `keyer` the keyer of the worker.
+
+        Raises:
+            Exception: The first exception raised by a call, once every call returned.
+        """
+        count = max(1, min(self.workers, height // self.MIN_ROWS))
+        bounds = [height * stripe // count for stripe in range(count + 1)]
+        if count > 1 and self._pool is None:
+            self._pool = ThreadPoolExecutor(self.workers - 1, thread_name_prefix='keyer')
+        pool = self._pool
+        futures = []
+        inline = [0]
+        for stripe in range(1, count):
+            try:
+                futures.append(pool.submit(function, self.keyers[stripe], slice(bounds[stripe], bounds[stripe + 1])))
+            except (AttributeError, RuntimeError):
+                # Closed by another thread meanwhile
+                inline.append(stripe)
+        try:
+            for stripe in inline:
+                function(self.keyers[stripe], slice(bounds[stripe], bounds[stripe + 1]))
+        finally:
+            # Never return while other threads still write into the caller's buffers
+            wait(futures)
+        for future in futures:
+            future.result()
+
+    def alpha(self, image, hsv_lower, hsv_upper, out=None):
+        """
+        Computes the alpha channel for an image.
+
+        Args:
+            image (ndarray): The (height, width, 4) BGRA or BGRX image, the fourth byte is ignored.
+            hsv_lower (ndarray): The lower bound of the HSV values to be made transparent.
+            hsv_upper (ndarray): The upper bound of the HSV values to be made transparent.
+            out (ndarray, optional): A (height, width) uint8 buffer to write the alpha into.
+
+        Returns:
+            ndarray: The alpha channel, 0 for keyed pixels and 255 for everything else.
+        """
+        height, width = image.shape[:2]
+        if out is None:
+            if self._mask is None or self._mask.shape != (height, width):
+                self._mask = np.empty((height, width), dtype=np.uint8)
+            out = self._mask
+
+        self.compile(hsv_lower, hsv_upper)
+        self.map(lambda keyer, rows: keyer.alpha(image[rows], hsv_lower, hsv_upper, out=out[rows]), height)
+        return out
+
+KEYERS = {
+    'hsv': HSVKeyer,
+    'lut': LUTKeyer,
+}
+
+MASK_SCALES = (1, 2, 4)
+
+# How keying uses several cores: 'stripes' keys row stripes on a ParallelKeyer, 'opencv' leaves it to
+# the threads OpenCV parallelizes its calls with
+THREADING = ('stripes', 'opencv')
+
+def create_keyer(method='hsv', mask_scale=1, workers=1, threading='stripes'):
+    """
+    Creates a keyer for the given method.
+
+    Args:
+        method (str): One of the keys of KEYERS.
+        mask_scale (int): One of MASK_SCALES. Above 1 the mask is computed at 1/mask_scale resolution
+            and refined along its edges, see ScaledKeyer.
+        workers (int): The number of threads keying in parallel with 'stripes' threading, see ParallelKeyer.
+        threading (str): One of THREADING. With 'opencv' the keyer itself is single-threaded, see
+            configure_threads.
+
+    Returns:
+        HSVKeyer, LUTKeyer, ParallelKeyer or ScaledKeyer: The keyer.
+
+    Raises:
+        ValueError: If the method, the mask scale or the threading is unknown.
+    """
+    if method not in KEYERS:
+        raise ValueError(f"Unknown chroma key method: {method}")
+    if mask_scale not in MASK_SCALES:
+        raise ValueError(f"Unsupported mask scale: {mask_scale}")
+    if threading not in THREADING:
+        raise ValueError(f"Unknown keying threading: {threading}")
+    if threading == 'stripes' and workers > 1:
+        keyer = ParallelKeyer(KEYERS[method], workers)
+    else:
+        keyer = KEYERS[method]()
+    if mask_scale > 1:
+        keyer = ScaledKeyer(keyer, mask_scale)
+    return keyer
+
+def close_keyer(keyer):
+    """
+    Stops the threads of a keyer created by create_keyer once it is no longer used, if it has any.
+    """
+    if isinstance(keyer, ScaledKeyer):
+        keyer = keyer.keyer
+    if isinstance(keyer, ParallelKeyer):
+        keyer.close()
+
+def configure_threads(workers=1, threading='stripes'):
+    """
+    Sets the number of threads OpenCV parallelizes its calls with for the given keying threading.
+
+    With 'opencv' threading that is `workers`. Row stripes are already keyed in parallel, so with
+    more than one stripe worker OpenCV runs single-threaded rather than oversubscribing the cores.
+    Otherwise OpenCV keeps its default. The setting applies to the whole process.
+
+    Args:
+        workers (int): The number of threads keying in parallel.
+        threading (str): One of THREADING.
+    """
+    if threading == 'opencv':
+        cv2.setNumThreads(workers)
+    elif workers > 1:
+        cv2.setNumThreads(1)
+    else:
+        cv2.setNumThreads(OPENCV_THREADS)
+
+def mask_mismatch(mask, reference):
+    """
+    Measures how far a mask deviates from a reference mask of the same size.
+
+    Args:
+        mask (ndarray): The mask to check, e.g. computed by a ScaledKeyer.
+        reference (ndarray): The full-resolution reference mask.
+
+    Returns:
+        float: The percentage of pixels that differ.
+    """
+    return 100.0 * np.count_nonzero(mask != reference) / mask.size
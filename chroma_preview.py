@@ -0,0 +1,109 @@
+from collections import OrderedDict
+import time
+import cv2
+import numpy as np
+from pipeline import display_size, write_keyed_pixels
+
+# The largest (width, height) of the frames the chroma key preview keys
+PREVIEW_SIZE = (320, 240)
+# The shortest time between two frames the proxy takes, in seconds; the editor refreshes every 100 ms
+PREVIEW_INTERVAL = 0.1
+
+class FrameProxy:
+    """
+    Keeps a downscaled copy of the last frame captured of a window, for previewing the chroma key.
+
+    `update` is called on the capturing thread for every frame captured while a preview watches the
+    window, see utils.watch_frames, and takes a frame at most every `interval` seconds, so the
+    capture rate does not pay for a copy of every frame. Frames are downscaled by sampling, not
+    averaging, so only real pixel colors are keyed, as ScaledKeyer does. Every update stores a new
+    array, so a reader on another thread gets a whole frame with one attribute read.
+
+    Attributes:
+        size (tuple): The largest (width, height) of the copy; smaller frames are kept at their size.
+        interval (float): The shortest time between two frames taken, in seconds.
+        image (ndarray): The (height, width, 4) BGRA or BGRX copy of the last frame, or None.
+        frames (int): Number of frames taken, tells readers when a new one arrived.
+    """
+    def __init__(self, size=PREVIEW_SIZE, interval=PREVIEW_INTERVAL):
+        self.size = size
+        self.interval = interval
+        self.image = None
+        self.frames = 0
+        self._taken = None
+
+    def update(self, frame):
+        """
+        Takes a downscaled copy of a captured frame, unless the last one was taken less than `interval` ago.
+
+        Args:
+            frame (Frame): The captured frame.
+        """
+        now = time.monotonic()
+        if self._taken is not None and now - self._taken < self.interval:
+            return
+        self._taken = now
+        height, width = frame.data.shape[:2]
+        if width <= self.size[0] and height <= self.size[1]:
+            image = frame.data.copy()
+        else:
+            size = display_size(width, height, *self.size)
+            image = cv2.resize(frame.data, (max(1, size[0]), max(1, size[1])), interpolation=cv2.INTER_NEAREST)
+        self.image = image
+        self.frames += 1
+
+class PreviewKeyer:
+    """
+    Keys proxy frames for the chroma key preview of the editor, fast enough to follow a slider.
+
+    The HSV conversion of a frame is computed once, so another setting of the bounds only costs
+    one inRange over the proxy and one masked write. The keyed frames are cached per setting of
+    the bounds, the least recently used beyond CACHE_SIZE are dropped, so returning to a setting
+    costs nothing. A new frame clears the cache.
+
+    Attributes:
+        hits (int): Number of keyed frames served from the cache.
+        misses (int): Number of frames keyed.
+    """
+    CACHE_SIZE = 64
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._image = None
+        self._hsv = None
+        self._cache = OrderedDict()
+
+    def key(self, image, hsv_lower, hsv_upper):
+        """
+        Keys a proxy frame.
+
+        Args:
+            image (ndarray): The (height, width, 4) BGRA or BGRX frame, e.g. FrameProxy.image.
+            hsv_lower (ndarray): The lower bound of the HSV values to be made transparent.
+            hsv_upper (ndarray): The upper bound of the HSV values to be made transparent.
+
+        Returns:
+            ndarray: The keyed frame as premultiplied BGRA, shared with the cache, so it must not be modified.
+        """
+        if image is not self._image:
+            self._image = image
+            self._hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+            self._cache.clear()
+
+        bounds = (hsv_lower.tobytes(), hsv_upper.tobytes())
+        keyed = self._cache.get(bounds)
+        if keyed is not None:
+            self._cache.move_to_end(bounds)
+            self.hits += 1
+            return keyed
+
+        mask = cv2.inRange(self._hsv, hsv_lower, hsv_upper)
+        cv2.bitwise_not(mask, dst=mask)
+        keyed = np.empty_like(image)
+        write_keyed_pixels(image, mask, keyed, np.empty_like(image))
+        self._cache[bounds] = keyed
+        if len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+        self.misses += 1
+        return keyed
@@ -1,16 +1,30 @@
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLineEdit, QLabel, QPushButton, QHBoxLayout, QComboBox
-from utils import is_valid_update_interval, is_valid_position
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QGridLayout, QLineEdit, QLabel, QPushButton, QComboBox, QSlider
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
+from PyQt5.QtGui import QImage, QPainter, QPixmap
+from utils import is_valid_update_interval, is_valid_position, is_valid_capture_region, parse_capture_region
+import copy
+import time
+import numpy as np
 import yaml
 
 class HSVInputWidget(QWidget):
     """
-    A custom widget for inputting HSV values.
+    A custom widget for inputting HSV values, with a slider and an input field per channel.
 
     Attributes:
         hInput (QLineEdit): Input field for the Hue value.
         sInput (QLineEdit): Input field for the Saturation value.
         vInput (QLineEdit): Input field for the Value (brightness) value.
+        changed (pyqtSignal): Emitted when a value changed, through its slider or a valid input.
+        settled (pyqtSignal): Emitted when a change is complete: a dragged slider was released, a slider
+            was moved with the keyboard or mouse wheel, or an input field was confirmed.
     """
+    changed = pyqtSignal()
+    settled = pyqtSignal()
+
+    # The largest value of every channel in OpenCV's 8-bit HSV
+    MAXIMUMS = {'h': 179, 's': 255, 'v': 255}
+
     def __init__(self, label, initial_h, initial_s, initial_v):
         """
         Initializes the HSV input widget with specified initial values.
@@ -22,22 +36,115 @@ class HSVInputWidget(QWidget):
             initial_v (int): Initial Value (brightness) value.
         """
         super().__init__()
-        layout = QHBoxLayout()
-        
-        layout.addWidget(QLabel(f'{label} H:'))
-        self.hInput = QLineEdit(str(initial_h))
-        layout.addWidget(self.hInput)
-        
-        layout.addWidget(QLabel('S:'))
-        self.sInput = QLineEdit(str(initial_s))
-        layout.addWidget(self.sInput)
-        
-        layout.addWidget(QLabel('V:'))
-        self.vInput = QLineEdit(str(initial_v))
-        layout.addWidget(self.vInput)
-        
+        layout = QGridLayout()
+        self.sliders = {}
+        for row, (channel, initial) in enumerate((('h', initial_h), ('s', initial_s), ('v', initial_v))):
+            layout.addWidget(QLabel(f'{label} {channel.upper()}:' if row == 0 else f'{channel.upper()}:'), row, 0)
+            slider = QSlider(Qt.Horizontal)
+            slider.setRange(0, self.MAXIMUMS[channel])
+            slider.setValue(int(initial))
+            layout.addWidget(slider, row, 1)
+            field = QLineEdit(str(initial))
+            field.setMaximumWidth(50)
+            layout.addWidget(field, row, 2)
+            slider.valueChanged.connect(lambda value, slider=slider, field=field: self.sliderMoved(slider, field, value))
+            slider.sliderReleased.connect(self.settled)
+            field.textEdited.connect(lambda text, slider=slider: self.fieldEdited(slider, text))
+            field.editingFinished.connect(self.settled)
+            self.sliders[channel] = slider
+            setattr(self, f'{channel}Input', field)
+
         self.setLayout(layout)
 
+    def sliderMoved(self, slider, field, value):
+        """Shows the value of a moved slider in its input field."""
+        field.setText(str(value))
+        self.changed.emit()
+        if not slider.isSliderDown():
+            self.settled.emit()
+
+    def fieldEdited(self, slider, text):
+        """Moves the slider of an input field to its value, if it is a valid one."""
+        try:
+            value = int(text)
+        except ValueError:
+            return
+        if slider.minimum() <= value <= slider.maximum() and value != slider.value():
+            slider.blockSignals(True)
+            slider.setValue(value)
+            slider.blockSignals(False)
+            self.changed.emit()
+
+    def values(self):
+        """
+        Returns:
+            dict: The 'h', 's' and 'v' values of the sliders.
+        """
+        return {channel: slider.value() for channel, slider in self.sliders.items()}
+
+class ChromaKeyPreview(QLabel):
+    """
+    Shows the chroma key with the bounds being edited applied to the last captured frame.
+
+    The frame comes from a FrameProxy fed by the capture of the window, and is keyed by a
+    PreviewKeyer, so showing another setting of the bounds takes a few milliseconds and needs no
+    new capture. Keyed pixels show a checkerboard.
+
+    Attributes:
+        proxy (FrameProxy): Holds the last captured frame, downscaled.
+        keyer (PreviewKeyer): Keys the frame and caches the results.
+        elapsed (float): Seconds it took to show the last setting of the bounds.
+    """
+    CHECKER = 8
+
+    def __init__(self, proxy):
+        from chroma_preview import PreviewKeyer
+        super().__init__('Waiting for a captured frame...')
+        self.proxy = proxy
+        self.keyer = PreviewKeyer()
+        self.elapsed = 0.0
+        self.setAlignment(Qt.AlignCenter)
+        self.setMinimumSize(*proxy.size)
+        self._bounds = None
+        self._frames = 0
+        self._checker = None
+
+    def showKey(self, hsv_lower, hsv_upper):
+        """
+        Shows the last captured frame keyed with the given bounds.
+
+        Args:
+            hsv_lower (ndarray): The lower bound of the HSV values to be made transparent.
+            hsv_upper (ndarray): The upper bound of the HSV values to be made transparent.
+        """
+        self._bounds = (hsv_lower, hsv_upper)
+        image = self.proxy.image
+        if image is None:
+            return
+        started = time.perf_counter()
+        self._frames = self.proxy.frames
+        keyed = self.keyer.key(image, hsv_lower, hsv_upper)
+        height, width = keyed.shape[:2]
+        if self._checker is None or (self._checker.width(), self._checker.height()) != (width, height):
+            self._checker = self.checkerboard(width, height)
+        pixmap = QPixmap(self._checker)
+        painter = QPainter(pixmap)
+        painter.drawImage(0, 0, QImage(keyed.data, width, height, keyed.strides[0], QImage.Format_ARGB32_Premultiplied))
+        painter.end()
+        self.setPixmap(pixmap)
+        self.elapsed = time.perf_counter() - started
+
+    def refresh(self):
+        """Keys the frame again if a new one was captured since it was last shown."""
+        if self._bounds is not None and self.proxy.frames != self._frames:
+            self.showKey(*self._bounds)
+
+    def checkerboard(self, width, height):
+        """Returns a QPixmap of the given size filled with a gray checkerboard."""
+        ys, xs = np.indices((height, width))
+        gray = np.where((xs // self.CHECKER + ys // self.CHECKER) % 2 == 0, 0xFF999999, 0xFF666666).astype(np.uint32)
+        return QPixmap.fromImage(QImage(gray.data, width, height, width * 4, QImage.Format_RGB32).copy())
+
 class ConfigEditor(QWidget):
     """
     A GUI editor for the application's configuration file.
@@ -56,6 +163,9 @@ class ConfigEditor(QWidget):
         super().__init__()
         self.transparent_window = transparent_window
         self.app = app
+        # Whether the overlays show bounds that are only previewed, and whether they were saved
+        self.previewed = False
+        self.committed = False
         self.initUI()
 
     def initUI(self):
@@ -64,10 +174,19 @@ class ConfigEditor(QWidget):
         """        
         self.layout = QVBoxLayout()
         self.screenSelector = QComboBox()
-        self.config = self.load_config('config.yaml')
+        config_store = getattr(self.transparent_window, 'configStore', None)
+        if config_store is not None:
+            # The configuration of the overlay this editor was opened from
+            self.config = copy.deepcopy(self.transparent_window.config)
+        else:
+            self.config = self.load_config('config.yaml')
 
         # Create input fields for window settings
         self.titleInput = QLineEdit(self.config['window_settings']['title'])
+        region = self.config['window_settings'].get('capture_region', 'auto')
+        if isinstance(region, dict):
+            region = f"{region['x']}, {region['y']}, {region['width']}, {region['height']}"
+        self.captureRegionInput = QLineEdit(str(region))
 
         # Create input fields for window size and position
         self.widthInput = QLineEdit(str(self.config['window_settings']['size']['width']))
@@ -88,6 +207,8 @@ class ConfigEditor(QWidget):
         # Add widgets to layout
         self.layout.addWidget(QLabel('Window Title'))
         self.layout.addWidget(self.titleInput)
+        self.layout.addWidget(QLabel('Capture Region (auto or x, y, width, height)'))
+        self.layout.addWidget(self.captureRegionInput)
         self.layout.addWidget(QLabel("Select Screen:"))
         self.layout.addWidget(self.screenSelector)
         self.layout.addWidget(QLabel('Window Width'))
@@ -117,6 +238,14 @@ class ConfigEditor(QWidget):
         self.hsvUpperWidget = HSVInputWidget('HSV Upper', hsv_upper['h'], hsv_upper['s'], hsv_upper['v'])
         self.layout.addWidget(self.hsvUpperWidget)
 
+        # Live preview of the chroma key on the last captured frame
+        self.setupPreview()
+        self.hsvLowerWidget.changed.connect(self.previewChromaKey)
+        self.hsvUpperWidget.changed.connect(self.previewChromaKey)
+        if self.transparent_window is not None:
+            self.hsvLowerWidget.settled.connect(self.pushPreview)
+            self.hsvUpperWidget.settled.connect(self.pushPreview)
+
         # Save button
         self.saveBtn = QPushButton('Save Configuration')
         self.saveBtn.clicked.connect(self.save_config)
@@ -124,6 +253,92 @@ class ConfigEditor(QWidget):
 
         self.setLayout(self.layout)
 
+    def setupPreview(self):
+        """
+        Sets up the chroma key preview, fed by the frames captured of the window the editor was opened from.
+        """
+        from chroma_preview import FrameProxy
+        from utils import capture_target_frame, watch_frames
+        window = self.transparent_window
+        if window is not None:
+            self.previewSource = (window.settings.title, window.settings.backend)
+            region = window.settings.region
+        else:
+            window_settings = self.config['window_settings']
+            if isinstance(window_settings, list):
+                window_settings = window_settings[0]
+            self.previewSource = (window_settings['title'], window_settings.get('capture_backend', 'auto'))
+            region = None
+        self.proxy = FrameProxy()
+        watch_frames(*self.previewSource, self.proxy)
+        if window is None or window.processPipeline is not None:
+            # Nothing captures the window in this process, capture one frame to preview
+            capture_target_frame(*self.previewSource, region)
+
+        self.preview = ChromaKeyPreview(self.proxy)
+        self.layout.addWidget(self.preview)
+        self.preview.showKey(*self.hsvBounds())
+
+        # Follow new captures
+        self.previewTimer = QTimer(self)
+        self.previewTimer.timeout.connect(self.preview.refresh)
+        self.previewTimer.start(100)
+
+    def hsvBounds(self):
+        """
+        Returns:
+            tuple: The lower and upper HSV bounds set in the editor, as uint8 arrays.
+        """
+        return tuple(np.array([values['h'], values['s'], values['v']], dtype=np.uint8)
+                     for values in (self.hsvLowerWidget.values(), self.hsvUpperWidget.values()))
+
+    def previewChromaKey(self):
+        """
+        Shows the bounds set in the editor in the preview.
+        """
+        self.preview.showKey(*self.hsvBounds())
+
+    def pushPreview(self):
+        """
+        Applies the bounds set in the editor to the running overlays in memory, without writing them.
+
+        Only called once a change is complete, not while a slider is dragged: the overlays' keyers
+        compile every new setting of the bounds (the LUT keyer into a 16 MB table), while the
+        preview re-keys a small proxy frame and caches the results.
+        """
+        window = self.transparent_window
+        lower, upper = self.hsvLowerWidget.values(), self.hsvUpperWidget.values()
+        chroma_key_settings = window.config['chroma_key_settings']
+        if (chroma_key_settings['hsv_lower'], chroma_key_settings['hsv_upper']) == (lower, upper):
+            return
+        if not self.previewed:
+            self.originalConfig = copy.deepcopy(window.config)
+        config = copy.deepcopy(window.config)
+        config['chroma_key_settings']['hsv_lower'] = lower
+        config['chroma_key_settings']['hsv_upper'] = upper
+        config_store = getattr(window, 'configStore', None)
+        if config_store is not None:
+            config_store.preview(config, window.overlay)
+        else:
+            window.updateConfig(config)
+        self.previewed = True
+
+    def closeEvent(self, event):
+        """
+        Stops the preview, and puts the overlays back to the saved bounds unless the editor saved them.
+        """
+        from utils import unwatch_frames
+        self.previewTimer.stop()
+        unwatch_frames(*self.previewSource, self.proxy)
+        if self.previewed and not self.committed:
+            config_store = getattr(self.transparent_window, 'configStore', None)
+            if config_store is not None:
+                config_store.revert()
+            else:
+                self.transparent_window.updateConfig(self.originalConfig)
+            self.previewed = False
+        super().closeEvent(event)
+
     def load_config(self, filepath):
         """
         Loads the configuration from a YAML file.
@@ -175,15 +390,27 @@ class ConfigEditor(QWidget):
         if not is_valid_update_interval(self, self.updateIntervalInput.text()):
             return  # Do not save if the input is invalid
 
+        if not is_valid_capture_region(self, self.captureRegionInput.text()):
+            return
+
         # Proceed with saving if the input is valid
         self.config['window_settings']['position']['x'] = int(x_position)
         self.config['window_settings']['position']['y'] = int(y_position)
         self.config['update_interval'] = int(self.updateIntervalInput.text())
+        self.config['window_settings']['capture_region'] = parse_capture_region(self.captureRegionInput.text())
+
+        self.committed = True
+        self.close() # Close the editor window
+
+        # Hand the configuration to the config store, which writes it and updates the main window
+        config_store = getattr(self.transparent_window, 'configStore', None)
+        if config_store is not None:
+            config_store.update(self.config, self.transparent_window.overlay)
+            return
 
         # Write the updated configuration back to the YAML file
         with open('config.yaml', 'w') as file:
             yaml.dump(self.config, file, sort_keys=False)
 
-        self.close() # Close the editor window
         if self.transparent_window:
             self.transparent_window.updateConfig(self.config) # Update the main window with the new config
\ No newline at end of file
@@ -1,5 +1,6 @@
-import yaml
-
+import copy
+import os
+import numpy as np
 import yaml
 
 def load_config(config_file, app):
@@ -14,7 +15,7 @@ def load_config(config_file, app):
 
     Args:
         config_file (str): The path to the YAML configuration file.
-        app (QApplication): The main application.
+        app (QApplication): The main application, None when running headless.
 
     Returns:
         dict: The loaded and validated configuration with default values for missing settings.
@@ -22,12 +23,27 @@ def load_config(config_file, app):
     # Load the configuration file
     with open(config_file, 'r') as file:
         config = yaml.safe_load(file)
-    
-    # Validate and set defaults for window_settings
+    return validate_config(config, app)
+
+def validate_config(config, app):
+    """
+    Validates a configuration dict in place and sets default values for missing settings.
+
+    Args:
+        config (dict): The configuration as parsed from YAML.
+        app (QApplication): The main application, None when running headless.
+
+    Returns:
+        dict: The validated configuration.
+    """
+    # Validate and set defaults for window_settings, a list of them configures one overlay each
     window_settings = config.get('window_settings', {})
-    window_settings['title'] = window_settings.get('title', 'Unassigned Window')
-    window_settings['size'] = window_settings.get('size', {'width': 800, 'height': 600})
-    window_settings['position'] = window_settings.get('position', {'x': 100, 'y': 100})
+    if isinstance(window_settings, list):
+        window_settings = [validate_window_settings(entry) for entry in window_settings if isinstance(entry, dict)]
+        if not window_settings:
+            window_settings = validate_window_settings({})
+    else:
+        window_settings = validate_window_settings(window_settings)
 
     # Validate and set defaults for update_interval
     config['update_interval'] = config.get('update_interval', 70)
@@ -36,12 +52,223 @@ def load_config(config_file, app):
     chroma_key_settings = config.get('chroma_key_settings', {})
     chroma_key_settings['hsv_lower'] = chroma_key_settings.get('hsv_lower', {'h': 50, 's': 100, 'v': 100})
     chroma_key_settings['hsv_upper'] = chroma_key_settings.get('hsv_upper', {'h': 70, 's': 255, 'v': 255})
+    chroma_key_settings['method'] = chroma_key_settings.get('method', 'hsv')
+    if chroma_key_settings['method'] not in ('hsv', 'lut'):
+        chroma_key_settings['method'] = 'hsv'
+    chroma_key_settings['mask_scale'] = chroma_key_settings.get('mask_scale', 1)
+    if chroma_key_settings['mask_scale'] not in (1, 2, 4):
+        chroma_key_settings['mask_scale'] = 1
+    chroma_key_settings['workers'] = chroma_key_settings.get('workers', 1)
+    if chroma_key_settings['workers'] != 'auto' and (not isinstance(chroma_key_settings['workers'], int)
+                                                     or chroma_key_settings['workers'] < 1):
+        chroma_key_settings['workers'] = 1
+    chroma_key_settings['threading'] = chroma_key_settings.get('threading', 'stripes')
+    if chroma_key_settings['threading'] not in ('stripes', 'opencv'):
+        chroma_key_settings['threading'] = 'stripes'
+
+    # Validate and set defaults for pipeline_settings
+    pipeline_settings = config.get('pipeline_settings', {})
+    pipeline_settings['mode'] = pipeline_settings.get('mode', 'fused')
+    if pipeline_settings['mode'] not in ('fused', 'legacy'):
+        pipeline_settings['mode'] = 'fused'
+    pipeline_settings['threaded'] = bool(pipeline_settings.get('threaded', True))
+    pipeline_settings['change_detection'] = bool(pipeline_settings.get('change_detection', True))
+    pipeline_settings['tile_size'] = pipeline_settings.get('tile_size', 64)
+    if not isinstance(pipeline_settings['tile_size'], int) or pipeline_settings['tile_size'] < 8:
+        pipeline_settings['tile_size'] = 64
+    pipeline_settings['processes'] = pipeline_settings.get('processes', 0)
+    if not isinstance(pipeline_settings['processes'], int) or pipeline_settings['processes'] < 0:
+        pipeline_settings['processes'] = 0
+    pipeline_settings['memory_budget_mb'] = pipeline_settings.get('memory_budget_mb', 512)
+    if not isinstance(pipeline_settings['memory_budget_mb'], int) or pipeline_settings['memory_budget_mb'] < 16:
+        pipeline_settings['memory_budget_mb'] = 512
+    config['pipeline_settings'] = pipeline_settings
+
+    # Validate and set defaults for pacing_settings
+    pacing_settings = config.get('pacing_settings', {})
+    pacing_settings['mode'] = pacing_settings.get('mode', 'adaptive')
+    if pacing_settings['mode'] not in ('adaptive', 'fixed'):
+        pacing_settings['mode'] = 'adaptive'
+    for key, default in (('target_fps', 30), ('cpu_budget', 0.25), ('min_fps', 2)):
+        pacing_settings[key] = pacing_settings.get(key, default)
+        if not isinstance(pacing_settings[key], (int, float)) or pacing_settings[key] <= 0:
+            pacing_settings[key] = default
+    pacing_settings['cpu_budget'] = min(pacing_settings['cpu_budget'], 1.0)
+    config['pacing_settings'] = pacing_settings
+
+    # Validate and set defaults for metrics_settings
+    metrics_settings = config.get('metrics_settings', {})
+    metrics_settings['hud'] = bool(metrics_settings.get('hud', False))
+    metrics_settings['export_path'] = str(metrics_settings.get('export_path', 'metrics.json'))
+    metrics_settings['endpoint_port'] = metrics_settings.get('endpoint_port', 0)
+    if not isinstance(metrics_settings['endpoint_port'], int) or not 0 <= metrics_settings['endpoint_port'] <= 65535:
+        metrics_settings['endpoint_port'] = 0
+    config['metrics_settings'] = metrics_settings
+
+    # Validate and set defaults for recording_settings
+    recording_settings = config.get('recording_settings', {})
+    recording_settings['record_path'] = str(recording_settings.get('record_path') or '')
+    recording_settings['replay_path'] = str(recording_settings.get('replay_path') or '')
+    recording_settings['replay_speed'] = recording_settings.get('replay_speed', 1.0)
+    if not isinstance(recording_settings['replay_speed'], (int, float)) or recording_settings['replay_speed'] < 0:
+        recording_settings['replay_speed'] = 1.0
+    config['recording_settings'] = recording_settings
 
     # Validate and set defaults for selected_screen
-    config['selected_screen'] = config.get('selected_screen', app.primaryScreen().name())
+    if 'selected_screen' not in config:
+        config['selected_screen'] = app.primaryScreen().name() if app is not None else None
 
     # Reassign validated and defaulted settings back to config
     config['window_settings'] = window_settings
     config['chroma_key_settings'] = chroma_key_settings
 
     return config
+
+def validate_window_settings(window_settings):
+    """
+    Validates the window_settings of one overlay in place and sets default values for missing settings.
+
+    Args:
+        window_settings (dict): The window settings as parsed from YAML.
+
+    Returns:
+        dict: The validated window settings.
+    """
+    window_settings['title'] = window_settings.get('title', 'Unassigned Window')
+    window_settings['size'] = window_settings.get('size', {'width': 800, 'height': 600})
+    window_settings['position'] = window_settings.get('position', {'x': 100, 'y': 100})
+    window_settings['capture_backend'] = window_settings.get('capture_backend', 'auto')
+    window_settings['capture_region'] = window_settings.get('capture_region', 'auto')
+    region = window_settings['capture_region']
+    if region != 'auto':
+        keys = ('x', 'y', 'width', 'height')
+        if (not isinstance(region, dict) or not all(isinstance(region.get(key), int) for key in keys)
+                or region['x'] < 0 or region['y'] < 0 or region['width'] <= 0 or region['height'] <= 0):
+            window_settings['capture_region'] = 'auto'
+    return window_settings
+
+def overlay_configs(config):
+    """
+    Splits a configuration into the configurations of its overlays.
+
+    A configuration with a single window_settings mapping has one overlay, the configuration itself.
+    With a list of window_settings, each overlay gets a configuration with its own entry as
+    window_settings and a copy of the other sections. An entry may set its own selected_screen.
+
+    Args:
+        config (dict): The validated application configuration.
+
+    Returns:
+        list: One configuration dict per overlay.
+    """
+    window_settings = config['window_settings']
+    if isinstance(window_settings, dict):
+        return [config]
+    configs = []
+    for index in range(len(window_settings)):
+        # Every overlay gets its own copy of the shared sections, changing one overlay leaves the others alone
+        overlay = copy.deepcopy(config)
+        entry = overlay['window_settings'] = overlay['window_settings'][index]
+        overlay['selected_screen'] = entry.get('selected_screen', config['selected_screen'])
+        configs.append(overlay)
+    return configs
+
+def merge_overlay_config(config, overlay, overlay_config):
+    """
+    Merges the configuration of one overlay back into the application configuration.
+
+    The window_settings and selected_screen of the overlay replace its entry, the other sections
+    are shared by every overlay and are taken over as they are.
+
+    Args:
+        config (dict): The application configuration with a list of window_settings.
+        overlay (int): The index of the overlay in window_settings.
+        overlay_config (dict): The configuration of the overlay, see overlay_configs.
+
+    Returns:
+        dict: The merged configuration, `config` itself is not modified.
+    """
+    merged = dict(overlay_config)
+    entry = dict(overlay_config['window_settings'])
+    if 'selected_screen' in entry or overlay_config['selected_screen'] != config['selected_screen']:
+        entry['selected_screen'] = overlay_config['selected_screen']
+    merged['selected_screen'] = config['selected_screen']
+    merged['window_settings'] = list(config['window_settings'])
+    merged['window_settings'][overlay] = entry
+    return merged
+
+class CompiledConfig:
+    """
+    An immutable snapshot of the settings the frame loop reads, compiled once per configuration.
+
+    The nested dicts of the configuration are flattened into attributes and the HSV bounds are
+    converted to read-only NumPy arrays up front, so rendering a frame does no dict lookups and
+    no allocations for its settings. Snapshots cannot be modified, which makes them safe to share
+    with worker threads; a configuration change compiles a new snapshot and swaps the reference.
+
+    Attributes:
+        title (str): The title of the window to capture.
+        backend (str): The capture backend.
+        region (tuple): The (x, y, width, height) capture region, or None for the whole client area.
+        size (tuple): The (width, height) of the overlay.
+        hsv_lower (ndarray): The lower HSV bound of the keyed color, uint8.
+        hsv_upper (ndarray): The upper HSV bound of the keyed color, uint8.
+        bounds_key (tuple): The lower and upper bounds as tuples of ints, to compare or hash the bounds
+            of two snapshots.
+        keyer (tuple): The (method, mask_scale, workers, threading) arguments of chroma_key.create_keyer,
+            with 'auto' workers resolved to the number of cores.
+        fused (bool): Whether the fused pipeline is used.
+        threaded (bool): Whether frames are rendered on a worker thread.
+        change_detection (tuple): The (enabled, tile_size) pair configuring change detection.
+        processes (int): The number of keying processes, 0 to key in this process.
+        update_interval (int): The capture interval in milliseconds.
+        pacing (tuple): The (mode, target_fps, cpu_budget, min_fps) pacing settings.
+    """
+    __slots__ = ('title', 'backend', 'region', 'size', 'hsv_lower', 'hsv_upper', 'bounds_key', 'keyer', 'fused',
+                 'threaded', 'change_detection', 'processes', 'update_interval', 'pacing')
+
+    def __init__(self, config):
+        """
+        Compiles a validated configuration, see validate_config.
+
+        Args:
+            config (dict): The application configuration.
+        """
+        window_settings = config['window_settings']
+        chroma_key_settings = config['chroma_key_settings']
+        pipeline_settings = config['pipeline_settings']
+        pacing_settings = config['pacing_settings']
+        region = window_settings['capture_region']
+        workers = chroma_key_settings['workers']
+        hsv_lower, hsv_upper = (
+            np.array([bound['h'], bound['s'], bound['v']], dtype=np.uint8)
+            for bound in (chroma_key_settings['hsv_lower'], chroma_key_settings['hsv_upper'])
+        )
+        hsv_lower.flags.writeable = False
+        hsv_upper.flags.writeable = False
+        values = {
+            'title': window_settings['title'],
+            'backend': window_settings['capture_backend'],
+            'region': None if region == 'auto' else (region['x'], region['y'], region['width'], region['height']),
+            'size': (window_settings['size']['width'], window_settings['size']['height']),
+            'hsv_lower': hsv_lower,
+            'hsv_upper': hsv_upper,
+            'bounds_key': (tuple(hsv_lower.tolist()), tuple(hsv_upper.tolist())),
+            'keyer': (chroma_key_settings['method'], chroma_key_settings['mask_scale'],
+                      (os.cpu_count() or 1) if workers == 'auto' else workers, chroma_key_settings['threading']),
+            'fused': pipeline_settings['mode'] == 'fused',
+            'threaded': pipeline_settings['threaded'],
+            'change_detection': (pipeline_settings['change_detection'], pipeline_settings['tile_size']),
+            'processes': pipeline_settings['processes'],
+            'update_interval': config['update_interval'],
+            'pacing': (pacing_settings['mode'], pacing_settings['target_fps'], pacing_settings['cpu_budget'],
+                       pacing_settings['min_fps']),
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable, compile a new one instead")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable, compile a new one instead")
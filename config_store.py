@@ -0,0 +1,173 @@
+import copy
+import hashlib
+import os
+import yaml
+from PyQt5.QtCore import QObject, QFileSystemWatcher, QTimer, pyqtSignal
+from config_loader import load_config, validate_config, merge_overlay_config
+
+def changed_sections(old_config, new_config):
+    """
+    Returns the top-level configuration keys whose values differ between two configurations.
+    """
+    keys = set(old_config) | set(new_config)
+    return {key for key in keys if old_config.get(key) != new_config.get(key)}
+
+class ConfigStore(QObject):
+    """
+    Owns the configuration file: reloads it when it changes on disk and persists the app's own changes.
+
+    Change notifications of the file are debounced, since editors often fire several per save.
+    The content of the file is hashed after every load and write, so notifications caused by the
+    app's own writes, or by saves that did not change anything, are ignored. Writes are delayed by
+    `write_delay` milliseconds to coalesce bursts, and replace the file atomically through a
+    temporary file. Editors that replace the file instead of writing it make the watcher drop it;
+    the file is watched again as soon as it exists.
+
+    Attributes:
+        path (str): The configuration file.
+        config (dict): The current, validated configuration.
+        configChanged (pyqtSignal): Emitted with the new configuration after a reload.
+    """
+    configChanged = pyqtSignal(dict)
+
+    def __init__(self, path, app, debounce=250, write_delay=250):
+        """
+        Loads the configuration and starts watching the file.
+
+        Args:
+            path (str): The configuration file.
+            app (QApplication): The main application.
+            debounce (int): Milliseconds to wait for further change notifications before reloading.
+            write_delay (int): Milliseconds to wait for further changes before writing.
+        """
+        super().__init__()
+        self.path = path
+        self.app = app
+        self.config = load_config(path, app)
+        self._digest = self._read_digest()
+        self._pending = None
+
+        self._reloadTimer = QTimer(self)
+        self._reloadTimer.setSingleShot(True)
+        self._reloadTimer.setInterval(debounce)
+        self._reloadTimer.timeout.connect(self.reload)
+
+        self._writeTimer = QTimer(self)
+        self._writeTimer.setSingleShot(True)
+        self._writeTimer.setInterval(write_delay)
+        self._writeTimer.timeout.connect(self.flush)
+
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.addPath(os.path.dirname(os.path.abspath(path)))
+        self.watcher.fileChanged.connect(self._fileChanged)
+        self.watcher.directoryChanged.connect(self._directoryChanged)
+        self._rearm()
+
+    def save(self, config, overlay=None):
+        """
+        Makes `config` the current configuration and writes it to the file shortly.
+
+        Args:
+            config (dict): The configuration, or that of one overlay if `overlay` is given.
+            overlay (int, optional): The index of the overlay in window_settings `config` belongs to.
+        """
+        if overlay is not None:
+            config = merge_overlay_config(self.config, overlay, config)
+        self.config = config
+        self._pending = config
+        self._writeTimer.start()
+
+    def update(self, config, overlay=None):
+        """
+        Validates a configuration coming from the app (e.g. the editor), saves it and announces it.
+
+        Args:
+            config (dict): The configuration, or that of one overlay if `overlay` is given.
+            overlay (int, optional): The index of the overlay in window_settings `config` belongs to.
+        """
+        self.save(validate_config(copy.deepcopy(config), self.app), overlay)
+        self.configChanged.emit(self.config)
+
+    def preview(self, config, overlay=None):
+        """
+        Announces a configuration coming from the app without making it current or writing it, e.g.
+        while the editor previews the chroma key. `revert` announces the current one again.
+
+        Args:
+            config (dict): The configuration, or that of one overlay if `overlay` is given.
+            overlay (int, optional): The index of the overlay in window_settings `config` belongs to.
+        """
+        config = validate_config(copy.deepcopy(config), self.app)
+        if overlay is not None:
+            config = merge_overlay_config(self.config, overlay, config)
+        self.configChanged.emit(config)
+
+    def revert(self):
+        """
+        Announces the current configuration again, undoing a preview.
+        """
+        self.configChanged.emit(self.config)
+
+    def flush(self):
+        """
+        Writes a pending configuration now, atomically.
+        """
+        self._writeTimer.stop()
+        if self._pending is None:
+            return
+        data = yaml.dump(self._pending, sort_keys=False).encode()
+        self._pending = None
+        temporary = self.path + '.tmp'
+        try:
+            with open(temporary, 'wb') as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.path)
+        except OSError as e:
+            print(f"Error writing configuration: {e}")
+            return
+        self._digest = hashlib.sha1(data).hexdigest()
+        self._rearm()
+
+    def reload(self):
+        """
+        Reloads the file if its content changed since it was last loaded or written.
+        """
+        self._rearm()
+        digest = self._read_digest()
+        if digest is None or digest == self._digest:
+            return
+        try:
+            config = load_config(self.path, self.app)
+        except (OSError, yaml.YAMLError, AttributeError) as e:
+            # Most likely caught in the middle of a save, the next notification retries
+            print(f"Error reloading configuration: {e}")
+            return
+        self._digest = digest
+        if not changed_sections(self.config, config):
+            return
+        self.config = config
+        self.configChanged.emit(config)
+
+    def _read_digest(self):
+        try:
+            with open(self.path, 'rb') as file:
+                return hashlib.sha1(file.read()).hexdigest()
+        except OSError:
+            return None
+
+    def _rearm(self):
+        """
+        Watches the file again if an editor replaced it.
+        """
+        if self.path not in self.watcher.files() and os.path.exists(self.path):
+            self.watcher.addPath(self.path)
+
+    def _fileChanged(self, path):
+        self._reloadTimer.start()
+
+    def _directoryChanged(self, path):
+        # Only of interest while the file itself is not watched, i.e. after it was replaced
+        if self.path not in self.watcher.files():
+            self._reloadTimer.start()
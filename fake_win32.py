@@ -0,0 +1,235 @@
+import ctypes
+import itertools
+import numpy as np
+
+class FakeWindow:
+    """
+    A window known to the fake win32 API.
+
+    Attributes:
+        title (str): The window title.
+        width (int): The window width in pixels.
+        height (int): The window height in pixels.
+        minimized (bool): Whether the window is minimized (IsIconic).
+        color (tuple): The BGRA color PrintWindow fills the bitmap with when `pixels` is None.
+        pixels (ndarray): Optional (height, width, 4) uint8 BGRA content returned by PrintWindow.
+    """
+    def __init__(self, title, width=1920, height=1080, color=(0, 255, 0, 255)):
+        self.title = title
+        self.width = width
+        self.height = height
+        self.minimized = False
+        self.color = color
+        self.pixels = None
+
+    def render(self, w, h):
+        """
+        Returns the window content for a bitmap of the given size as BGRA bytes.
+        """
+        if self.pixels is not None:
+            content = np.zeros((h, w, 4), dtype=np.uint8)
+            ph, pw = min(h, self.pixels.shape[0]), min(w, self.pixels.shape[1])
+            content[:ph, :pw] = self.pixels[:ph, :pw]
+            return content.tobytes()
+        return bytes(self.color) * (w * h)
+
+class FakeWin32:
+    """
+    An in-memory stand-in for the parts of win32gui, win32ui, windll.user32 and windll.gdi32 used by
+    capture_image.CaptureSession, so captures can be exercised and benchmarked on Linux.
+
+    Pass the namespaces to the session:
+
+        api = FakeWin32()
+        window = api.add_window('VTube Studio', 1280, 720)
+        session = CaptureSession('VTube Studio', api.win32gui, api.win32ui, api.user32, gdi32=api.gdi32)
+
+    Attributes:
+        win32gui (FakeWin32gui): The win32gui replacement.
+        win32ui (FakeWin32ui): The win32ui replacement.
+        user32 (FakeUser32): The windll.user32 replacement.
+        gdi32 (FakeGdi32): The windll.gdi32 replacement.
+        windows (dict): The existing windows, keyed by handle.
+        bitmaps (dict): The bitmaps holding a GDI handle, keyed by handle.
+        calls (dict): Number of calls per API function name.
+        live_objects (int): DCs and bitmaps that were created but not released yet.
+    """
+    def __init__(self):
+        self.windows = {}
+        self.bitmaps = {}
+        self.calls = {}
+        self.live_objects = 0
+        self._handles = itertools.count(0x1000)
+        self.win32gui = FakeWin32gui(self)
+        self.win32ui = FakeWin32ui(self)
+        self.user32 = FakeUser32(self)
+        self.gdi32 = FakeGdi32(self)
+
+    def add_window(self, title, width=1920, height=1080, color=(0, 255, 0, 255)):
+        """
+        Creates a window and returns it, its handle is available as `window.hwnd`.
+        """
+        window = FakeWindow(title, width, height, color)
+        window.hwnd = next(self._handles)
+        self.windows[window.hwnd] = window
+        return window
+
+    def destroy_window(self, window):
+        """
+        Removes a window, invalidating its handle.
+        """
+        self.windows.pop(window.hwnd, None)
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _window(self, hwnd):
+        window = self.windows.get(hwnd)
+        if window is None:
+            raise OSError(1400, 'Invalid window handle.')
+        return window
+
+class FakeWin32gui:
+    """The subset of win32gui used for window capture."""
+    def __init__(self, api):
+        self._api = api
+
+    def FindWindow(self, class_name, title):
+        self._api._count('FindWindow')
+        return next((hwnd for hwnd, window in self._api.windows.items() if window.title == title), 0)
+
+    def IsWindow(self, hwnd):
+        self._api._count('IsWindow')
+        return hwnd in self._api.windows
+
+    def IsIconic(self, hwnd):
+        self._api._count('IsIconic')
+        return self._api._window(hwnd).minimized
+
+    def GetWindowRect(self, hwnd):
+        self._api._count('GetWindowRect')
+        window = self._api._window(hwnd)
+        return 0, 0, window.width, window.height
+
+    def GetClientRect(self, hwnd):
+        self._api._count('GetClientRect')
+        window = self._api._window(hwnd)
+        return 0, 0, window.width, window.height
+
+    def GetWindowDC(self, hwnd):
+        self._api._count('GetWindowDC')
+        self._api._window(hwnd)
+        self._api.live_objects += 1
+        return FakeWindowDC(hwnd)
+
+    def ReleaseDC(self, hwnd, dc):
+        self._api._count('ReleaseDC')
+        self._api.live_objects -= 1
+
+    def DeleteObject(self, handle):
+        self._api._count('DeleteObject')
+        self._api.bitmaps.pop(handle, None)
+        self._api.live_objects -= 1
+
+class FakeWin32ui:
+    """The subset of win32ui used for window capture."""
+    def __init__(self, api):
+        self._api = api
+
+    def CreateDCFromHandle(self, hdc):
+        self._api._count('CreateDCFromHandle')
+        self._api.live_objects += 1
+        return FakeDC(self._api, hdc.hwnd)
+
+    def CreateBitmap(self):
+        self._api._count('CreateBitmap')
+        return FakeBitmap(self._api)
+
+class FakeUser32:
+    """The subset of windll.user32 used for window capture."""
+    def __init__(self, api):
+        self._api = api
+
+    def PrintWindow(self, hwnd, hdc, flags):
+        self._api._count('PrintWindow')
+        window = self._api.windows.get(hwnd)
+        if window is None or hdc.bitmap is None:
+            return 0
+        bitmap = hdc.bitmap
+        bitmap.bits = window.render(bitmap.width, bitmap.height)
+        return 1
+
+class FakeGdi32:
+    """The subset of windll.gdi32 used for window capture, called with ctypes arguments."""
+    def __init__(self, api):
+        self._api = api
+
+    def GetBitmapBits(self, hbitmap, size, bits):
+        self._api._count('GetBitmapBits')
+        bitmap = self._api.bitmaps.get(hbitmap.value)
+        if bitmap is None:
+            return 0
+        count = min(size.value, len(bitmap.bits))
+        ctypes.memmove(bits.value, bitmap.bits, count)
+        return count
+
+class FakeWindowDC:
+    def __init__(self, hwnd):
+        self.hwnd = hwnd
+
+class FakeDC:
+    """A device context as returned by win32ui."""
+    def __init__(self, api, hwnd):
+        self._api = api
+        self.hwnd = hwnd
+        self.bitmap = None
+
+    def CreateCompatibleDC(self):
+        self._api._count('CreateCompatibleDC')
+        self._api.live_objects += 1
+        return FakeDC(self._api, self.hwnd)
+
+    def SelectObject(self, bitmap):
+        self._api._count('SelectObject')
+        self.bitmap = bitmap
+
+    def GetSafeHdc(self):
+        return self
+
+    def BitBlt(self, dest_pos, size, src_dc, src_pos, rop):
+        self._api._count('BitBlt')
+        (dx, dy), (w, h), (sx, sy) = dest_pos, size, src_pos
+        src, dest = src_dc.bitmap, self.bitmap
+        src_pixels = np.frombuffer(src.bits, dtype=np.uint8).reshape(src.height, src.width, 4)
+        dest_pixels = np.frombuffer(dest.bits, dtype=np.uint8).reshape(dest.height, dest.width, 4).copy()
+        dest_pixels[dy:dy + h, dx:dx + w] = src_pixels[sy:sy + h, sx:sx + w]
+        dest.bits = dest_pixels.tobytes()
+
+    def DeleteDC(self):
+        self._api._count('DeleteDC')
+        self._api.live_objects -= 1
+
+class FakeBitmap:
+    """A bitmap as returned by win32ui.CreateBitmap."""
+    def __init__(self, api):
+        self._api = api
+        self.width = 0
+        self.height = 0
+        self.bits = b''
+
+    def CreateCompatibleBitmap(self, dc, w, h):
+        self._api._count('CreateCompatibleBitmap')
+        self._api.live_objects += 1
+        self._api.bitmaps[self.GetHandle()] = self
+        self.width, self.height = w, h
+        self.bits = bytes(w * h * 4)
+
+    def GetInfo(self):
+        return {'bmWidth': self.width, 'bmHeight': self.height, 'bmBitsPixel': 32}
+
+    def GetBitmapBits(self, as_string):
+        self._api._count('GetBitmapBits')
+        return self.bits
+
+    def GetHandle(self):
+        return id(self)
@@ -0,0 +1,238 @@
+import numpy as np
+from buffer_pool import BUFFER_POOL
+
+# An encoded frame is a header of HEADER_SIZE bytes, followed by
+#   - one bit per tile of the encoded tile range, set for the tiles that changed (np.packbits order),
+#   - the lengths of the alternating transparent and opaque runs over the pixels of the changed
+#     tiles, starting with a transparent run, as uint32,
+#   - the BGRA pixels of the opaque runs.
+# The pixels of the changed tiles are taken tile by tile, each row by row.
+MAGIC = b'WMSC'
+VERSION = 1
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u2'),
+    ('flags', '<u2'),
+    ('width', '<u4'),
+    ('height', '<u4'),
+    ('tile_size', '<u2'),
+    ('reserved', '<u2'),
+    ('tiles', '<u2', (4,)),
+    ('bbox', '<u4', (4,)),
+    ('changed', '<u4'),
+    ('runs', '<u4'),
+    ('opaque', '<u4'),
+    ('timestamp', '<f8'),
+])
+
+# Set on frames that are encoded against a fully transparent frame rather than the previous one
+FLAG_KEYFRAME = 1
+
+def tiles(image, tile_size):
+    """
+    Returns a (rows, columns, tile_size, tile_size, 4) view of the tiles of a BGRA image whose
+    size is a multiple of `tile_size`.
+    """
+    height, width = image.shape[:2]
+    return image.reshape(height // tile_size, tile_size, width // tile_size, tile_size, 4).swapaxes(1, 2)
+
+def run_lengths(mask):
+    """
+    Returns the lengths of the alternating runs of False and True in a flat boolean array, starting
+    with a run of False (of length 0 if the array starts with True), as uint32.
+    """
+    edges = np.flatnonzero(mask[1:] != mask[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], edges, [mask.size])))
+    if mask.size and mask[0]:
+        runs = np.concatenate(([0], runs))
+    return runs.astype('<u4')
+
+def opaque_bbox(alpha):
+    """
+    Returns the (x, y, width, height) bounding box of the non-zero pixels of an alpha channel, or None
+    if there are none.
+    """
+    rows = np.flatnonzero(alpha.any(axis=1))
+    if rows.size == 0:
+        return None
+    columns = np.flatnonzero(alpha.any(axis=0))
+    return columns[0], rows[0], columns[-1] + 1 - columns[0], rows[-1] + 1 - rows[0]
+
+class FrameEncoder:
+    """
+    Encodes keyed BGRA frames, e.g. the output of utils.apply_chroma_key, into a compact byte string.
+
+    Keyed mascot frames are mostly transparent and mostly unchanged from one frame to the next, so
+    only the tiles that changed since the previous frame are encoded, only within the bounding box
+    of the opaque pixels of both frames, and of their pixels only the opaque ones, as runs. Transparent
+    pixels (alpha 0) are decoded as zero, whatever their color was, as they are displayed; opaque
+    pixels are kept exactly.
+
+    Frames are encoded against the previous one, so they have to be decoded in order from a
+    keyframe. A keyframe is written first, after a size change, every `keyframe_interval` frames
+    and after `reset`, so a consumer can start at any keyframe.
+
+    Attributes:
+        tile_size (int): Edge length in pixels of the tiles compared with the previous frame.
+        keyframe_interval (int): Frames between keyframes, 0 to only write them when needed.
+    """
+    def __init__(self, tile_size=32, keyframe_interval=60):
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+        # The previous frame with its transparent pixels zeroed, padded to whole tiles
+        self._previous = None
+        self._size = None
+        # The (top, bottom, left, right) tiles that may hold opaque pixels of the previous frame
+        self._range = None
+        self._since_keyframe = 0
+
+    def reset(self):
+        """
+        Makes the next frame a keyframe, e.g. when a new consumer attaches.
+        """
+        self._size = None
+
+    def release(self):
+        """
+        Gives the buffer of the previous frame back to the pool, the next frame is a keyframe.
+        """
+        if self._previous is not None:
+            BUFFER_POOL.release(self._previous)
+            self._previous = None
+        self._size = None
+
+    def encode(self, pixels, timestamp=0.0, keyframe=False):
+        """
+        Encodes a frame.
+
+        Args:
+            pixels (ndarray): The (height, width, 4) uint8 BGRA frame, straight or premultiplied alpha.
+            timestamp (float): The capture time of the frame, stored in the header.
+            keyframe (bool): Whether to encode a keyframe regardless of the interval.
+
+        Returns:
+            bytes: The encoded frame.
+        """
+        height, width = pixels.shape[:2]
+        tile = self.tile_size
+        shape = (-(-height // tile) * tile, -(-width // tile) * tile, 4)
+        keyframe = (keyframe or self._size != (width, height)
+                    or bool(self.keyframe_interval) and self._since_keyframe >= self.keyframe_interval)
+        if keyframe:
+            if self._previous is None or self._previous.shape != shape:
+                self.release()
+                self._previous = BUFFER_POOL.acquire(shape)
+            self._previous.fill(0)
+            self._size = (width, height)
+            self._range = None
+            self._since_keyframe = 0
+        self._since_keyframe += 1
+
+        header = np.zeros((), dtype=HEADER_DTYPE)
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['flags'] = FLAG_KEYFRAME if keyframe else 0
+        header['width'], header['height'] = width, height
+        header['tile_size'] = tile
+        header['timestamp'] = timestamp
+
+        opaque = pixels[..., 3] != 0
+        bbox = opaque_bbox(opaque)
+        current = None
+        if bbox is not None:
+            header['bbox'] = bbox
+            x, y, w, h = bbox
+            current = (y // tile, -(-(y + h) // tile), x // tile, -(-(x + w) // tile))
+        # Outside the tiles that hold opaque pixels of either frame, both are transparent
+        ranges = [bounds for bounds in (current, self._range) if bounds is not None]
+        self._range = current
+        if not ranges:
+            return header.tobytes()
+        top, bottom, left, right = (min(bounds[0] for bounds in ranges), max(bounds[1] for bounds in ranges),
+                                    min(bounds[2] for bounds in ranges), max(bounds[3] for bounds in ranges))
+        header['tiles'] = (top, bottom, left, right)
+
+        # The encoded tiles of the frame, transparent pixels zeroed like in the previous frame
+        region = BUFFER_POOL.acquire(((bottom - top) * tile, (right - left) * tile, 4))
+        region.fill(0)
+        y0, y1, x0, x1 = top * tile, min(bottom * tile, height), left * tile, min(right * tile, width)
+        np.copyto(region[:y1 - y0, :x1 - x0], pixels[y0:y1, x0:x1], where=opaque[y0:y1, x0:x1, None])
+        previous = self._previous[top * tile:bottom * tile, left * tile:right * tile]
+        changed = (region != previous).reshape(bottom - top, tile, right - left, tile * 4).any(axis=(1, 3))
+        selected = tiles(region, tile)[changed]
+        tiles(previous, tile)[changed] = selected
+        BUFFER_POOL.release(region)
+
+        selected = selected.reshape(-1, 4)
+        mask = selected[:, 3] != 0
+        runs = run_lengths(mask)
+        header['changed'] = np.count_nonzero(changed)
+        header['runs'] = runs.size
+        header['opaque'] = np.count_nonzero(mask)
+        return b''.join((header.tobytes(), np.packbits(changed).tobytes(), runs.tobytes(), selected[mask].tobytes()))
+
+class FrameDecoder:
+    """
+    Decodes the frames of a FrameEncoder, in the order they were encoded.
+    """
+    def __init__(self):
+        self._frame = None
+        self._geometry = None
+
+    def release(self):
+        """
+        Gives the buffer of the decoded frame back to the pool, the next frame has to be a keyframe.
+        """
+        if self._frame is not None:
+            BUFFER_POOL.release(self._frame)
+            self._frame = None
+        self._geometry = None
+
+    def decode(self, data):
+        """
+        Decodes a frame.
+
+        Args:
+            data (bytes): The encoded frame.
+
+        Returns:
+            tuple: The (height, width, 4) uint8 BGRA frame, a view of a buffer of the decoder that is
+            only valid until the next call, and the header record (see HEADER_DTYPE).
+
+        Raises:
+            ValueError: If the data is not an encoded frame, or a delta frame does not follow the frame
+                it was encoded against.
+        """
+        header = np.frombuffer(data, dtype=HEADER_DTYPE, count=1)[0]
+        if header['magic'] != MAGIC or header['version'] != VERSION:
+            raise ValueError(f"Not an encoded frame of version {VERSION}.")
+        width, height, tile = int(header['width']), int(header['height']), int(header['tile_size'])
+        shape = (-(-height // tile) * tile, -(-width // tile) * tile, 4)
+        if header['flags'] & FLAG_KEYFRAME:
+            if self._frame is None or self._frame.shape != shape:
+                self.release()
+                self._frame = BUFFER_POOL.acquire(shape)
+            self._frame.fill(0)
+            self._geometry = (width, height, tile)
+        elif self._geometry != (width, height, tile):
+            raise ValueError("A delta frame has to follow the frame it was encoded against, starting with a keyframe.")
+
+        top, bottom, left, right = (int(bound) for bound in header['tiles'])
+        count = int(header['changed'])
+        if count:
+            offset = HEADER_SIZE
+            bits = (bottom - top) * (right - left)
+            changed = np.unpackbits(np.frombuffer(data, dtype=np.uint8, count=-(-bits // 8), offset=offset),
+                                    count=bits).view(bool).reshape(bottom - top, right - left)
+            offset += -(-bits // 8)
+            runs = np.frombuffer(data, dtype='<u4', count=int(header['runs']), offset=offset)
+            offset += runs.nbytes
+            opaque = np.frombuffer(data, dtype=np.uint8, count=int(header['opaque']) * 4, offset=offset)
+            decoded = np.zeros((count, tile, tile, 4), dtype=np.uint8)
+            # Odd runs are opaque
+            mask = np.repeat(np.arange(runs.size) % 2 == 1, runs)
+            decoded.reshape(-1, 4)[mask] = opaque.reshape(-1, 4)
+            region = self._frame[top * tile:bottom * tile, left * tile:right * tile]
+            tiles(region, tile)[changed] = decoded
+        return self._frame[:height, :width], header
@@ -0,0 +1,205 @@
+import os
+import queue
+import threading
+import time
+import numpy as np
+from frame_source import FrameSource, clip_region
+from buffer_pool import BUFFER_POOL
+from metrics import METRICS
+
+# Every recording starts with a header of HEADER_SIZE bytes, followed by fixed-size frame records
+MAGIC = b'WMFRAMES'
+VERSION = 1
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('width', '<u4'),
+    ('height', '<u4'),
+    ('stride', '<u4'),
+    ('pixel_format', 'S4'),
+    ('reserved', 'V36'),
+])
+
+def record_dtype(width, height):
+    """
+    Returns the dtype of one frame record: the monotonic grab time in seconds, followed by the
+    pixels as tightly packed rows of 4 bytes per pixel.
+    """
+    return np.dtype([('timestamp', '<f8'), ('pixels', 'u1', (height, width, 4))])
+
+def read_header(path):
+    """
+    Reads the header of a recording.
+
+    Returns:
+        dict: The width, height, stride and pixel_format of the recorded frames, and the number of
+        complete frame records in the file as 'frames'.
+
+    Raises:
+        ValueError: If the file is not a recording of a supported version.
+    """
+    with open(path, 'rb') as file:
+        data = file.read(HEADER_SIZE)
+    if len(data) < HEADER_SIZE:
+        raise ValueError(f"{path} is not a frame recording.")
+    header = np.frombuffer(data, dtype=HEADER_DTYPE)[0]
+    if header['magic'] != MAGIC or header['version'] != VERSION:
+        raise ValueError(f"{path} is not a frame recording of version {VERSION}.")
+    width, height = int(header['width']), int(header['height'])
+    return {
+        'width': width,
+        'height': height,
+        'stride': int(header['stride']),
+        'pixel_format': header['pixel_format'].decode(),
+        'frames': (os.path.getsize(path) - HEADER_SIZE) // record_dtype(width, height).itemsize,
+    }
+
+class FrameRecorder:
+    """
+    Appends captured frames to a recording file.
+
+    The recording has the geometry of the first frame; frames of another size (e.g. after the
+    target window was resized) are not recorded. Grabbed pixels are only valid until the next grab,
+    so `write` copies them into a pooled record and a background thread writes it to disk, keeping
+    the disk off the capture path. When the disk falls `queue_size` frames behind, further frames are dropped and
+    counted as frames_unrecorded.
+
+    The file is a header followed by records that all have the same size, so a recording cut
+    short (e.g. by a crash) stays readable up to its last complete record.
+
+    Attributes:
+        path (str): The recording file.
+        frames (int): Number of frames written.
+    """
+    def __init__(self, path, queue_size=8):
+        self.path = path
+        self.frames = 0
+        self._file = open(path, 'wb')
+        self._geometry = None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._writer = threading.Thread(target=self._write_loop, name='frame-recorder', daemon=True)
+        self._writer.start()
+        print(f"Recording frames to {path}")
+
+    def write(self, frame):
+        """
+        Queues a frame for writing. Safe to call from any thread.
+
+        Args:
+            frame (Frame): The captured frame.
+        """
+        geometry = (frame.width, frame.height, frame.pixel_format)
+        with self._lock:
+            if self._geometry is None:
+                self._geometry = geometry
+                header = np.zeros(1, dtype=HEADER_DTYPE)
+                header['magic'] = MAGIC
+                header['version'] = VERSION
+                header['width'], header['height'] = frame.width, frame.height
+                header['stride'] = frame.width * 4
+                header['pixel_format'] = frame.pixel_format.encode()
+                self._queue.put(header.tobytes())
+        if geometry != self._geometry:
+            METRICS.count('frames_unrecorded')
+            return
+        record = BUFFER_POOL.acquire((1,), record_dtype(frame.width, frame.height))
+        record['timestamp'] = frame.timestamp
+        record['pixels'][0] = frame.data
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            BUFFER_POOL.release(record)
+            METRICS.count('frames_unrecorded')
+
+    def close(self):
+        """
+        Writes the queued frames and closes the file.
+        """
+        self._queue.put(None)
+        self._writer.join()
+        self._file.close()
+        print(f"Recorded {self.frames} frames to {self.path}")
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, bytes):
+                self._file.write(item)
+                continue
+            self._file.write(item.data)
+            BUFFER_POOL.release(item)
+            self.frames += 1
+
+class ReplayFrameSource(FrameSource):
+    """
+    Serves the frames of a recording instead of capturing a window.
+
+    The recording is memory-mapped, and grabbed frames are views of the mapping, so replaying
+    copies no pixels and only touches the pages of the frames actually served. At `speed` 1 the
+    frame that was current at the same time into the recording is served, so frames are skipped
+    when captures are slower than the recording, as they would be on a live window; 2 replays twice
+    as fast. At `speed` 0 every grab serves the next frame, which makes a run deterministic.
+    The recording starts over at its end. `region` crops the recorded frames.
+    """
+    def __init__(self, window_title, path, speed=1.0):
+        """
+        Initializes the replay source.
+
+        Args:
+            window_title (str): The title of the window the recording stands in for.
+            path (str): The recording file, see FrameRecorder.
+            speed (float): The replay rate relative to the recording, 0 to serve a new frame on every grab.
+        """
+        super().__init__(window_title)
+        self.path = path
+        self.speed = speed
+        self._pixels = None
+
+    def open(self):
+        """
+        Maps the recording.
+
+        Raises:
+            ValueError: If the file is not a recording or holds no frames.
+        """
+        header = read_header(self.path)
+        if header['frames'] == 0:
+            raise ValueError(f"The recording {self.path} holds no frames.")
+        self.pixel_format = header['pixel_format']
+        records = np.memmap(self.path, dtype=record_dtype(header['width'], header['height']), mode='r',
+                            offset=HEADER_SIZE, shape=(header['frames'],))
+        self._pixels = records['pixels']
+        times = np.array(records['timestamp'])
+        self._offsets = times - times[0]
+        # One frame interval past the last frame, so that it is shown as long as the others
+        interval = (self._offsets[-1] / (len(times) - 1) if len(times) > 1 else 0.0) or 1.0
+        self._duration = self._offsets[-1] + interval
+        self._started = time.monotonic()
+        self._next = 0
+        super().open()
+
+    def grab(self):
+        """
+        Returns the current frame of the recording, as a view of the mapped file.
+        """
+        if self.speed > 0:
+            elapsed = ((time.monotonic() - self._started) * self.speed) % self._duration
+            index = int(np.searchsorted(self._offsets, elapsed, side='right')) - 1
+        else:
+            index = self._next % len(self._pixels)
+            self._next += 1
+        pixels = self._pixels[index]
+        height, width = pixels.shape[:2]
+        x, y, width, height = clip_region(self.region, width, height)
+        return self._make_frame(pixels[y:y + height, x:x + width], width, height, pixels.shape[1] * 4)
+
+    def close(self):
+        """
+        Unmaps the recording.
+        """
+        self._pixels = None
+        super().close()
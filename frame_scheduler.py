@@ -0,0 +1,126 @@
+import time
+
+PACING_MODES = ('adaptive', 'fixed')
+
+class FrameScheduler:
+    """
+    Decides when to capture the next frame, based on what the previous frames cost and showed.
+
+    In adaptive mode frames are captured at `target_fps` while the content changes. Every frame
+    without a change stretches the interval by BACKOFF, down to `min_fps`. The first changed frame
+    restores the target rate. The measured per-frame pipeline cost is averaged, and the interval is
+    never shorter than that cost divided by `cpu_budget`, so the pipeline uses at most that
+    fraction of a core. While the overlay is hidden or covered, frames are captured at `min_fps`.
+
+    In fixed mode the interval is always `update_interval`, as before.
+
+    Attributes:
+        mode (str): 'adaptive' or 'fixed'.
+        target_fps (float): The frame rate while the content changes.
+        cpu_budget (float): The fraction of one core the pipeline may use, e.g. 0.25.
+        min_fps (float): The frame rate while idle, hidden or covered.
+        visible (bool): Whether the overlay can currently be seen, set by the window.
+        cost (float): Moving average of the per-frame pipeline cost in seconds.
+        achieved_fps (float): Frames processed during the last full second.
+    """
+    BACKOFF = 1.25
+    SMOOTHING = 0.2
+
+    def __init__(self, mode='adaptive', target_fps=30, cpu_budget=0.25, min_fps=2, update_interval=70):
+        """
+        Initializes the scheduler.
+
+        Args:
+            mode (str): One of PACING_MODES.
+            target_fps (float): The frame rate while the content changes.
+            cpu_budget (float): The fraction of one core the pipeline may use.
+            min_fps (float): The frame rate while idle, hidden or covered.
+            update_interval (int): The interval in milliseconds used in fixed mode.
+        """
+        self.visible = True
+        self.cost = 0.0
+        self.achieved_fps = 0.0
+        self._frames = 0
+        self._window_start = time.monotonic()
+        self._window_frames = 0
+        self.configure(mode, target_fps, cpu_budget, min_fps, update_interval)
+
+    def configure(self, mode, target_fps, cpu_budget, min_fps, update_interval):
+        """
+        Applies new settings, the measured cost is kept.
+
+        Raises:
+            ValueError: If the mode is unknown.
+        """
+        if mode not in PACING_MODES:
+            raise ValueError(f"Unknown pacing mode: {mode}")
+        self.mode = mode
+        self.target_fps = target_fps
+        self.cpu_budget = cpu_budget
+        self.min_fps = min(min_fps, target_fps)
+        self.update_interval = update_interval
+        self._interval = 1.0 / target_fps
+
+    def record(self, cost, changed):
+        """
+        Records a processed frame.
+
+        Args:
+            cost (float): The time the pipeline spent on the frame, in seconds.
+            changed (bool): Whether the frame showed new content.
+        """
+        self.cost = cost if self._frames == 0 else self.cost + self.SMOOTHING * (cost - self.cost)
+        self._frames += 1
+        if changed:
+            self._interval = 1.0 / self.target_fps
+        else:
+            self._interval = min(self._interval * self.BACKOFF, 1.0 / self.min_fps)
+        self._update_rate()
+
+    def interval(self):
+        """
+        Returns:
+            float: The time in seconds from the start of the last frame to the start of the next one.
+        """
+        if self.mode == 'fixed':
+            return self.update_interval / 1000
+        if not self.visible:
+            return 1.0 / self.min_fps
+        return max(self._interval, self.cost / self.cpu_budget)
+
+    def delay(self, started):
+        """
+        Returns the time left to wait before the next frame.
+
+        Args:
+            started (float): Monotonic time at which the last frame started.
+
+        Returns:
+            float: The delay in seconds, 0 if the next frame is already due.
+        """
+        return max(0.0, self.interval() - (time.monotonic() - started))
+
+    def _update_rate(self):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed >= 1.0:
+            self.achieved_fps = (self._frames - self._window_frames) / elapsed
+            self._window_start = now
+            self._window_frames = self._frames
+
+def create_frame_scheduler(settings, scheduler=None):
+    """
+    Creates a scheduler from the configuration, or reconfigures an existing one.
+
+    Args:
+        settings (CompiledConfig): The compiled application configuration.
+        scheduler (FrameScheduler, optional): The scheduler to reconfigure.
+
+    Returns:
+        FrameScheduler: The configured scheduler.
+    """
+    settings = settings.pacing + (settings.update_interval,)
+    if scheduler is None:
+        return FrameScheduler(*settings)
+    scheduler.configure(*settings)
+    return scheduler
@@ -0,0 +1,548 @@
+import os
+import queue
+import sys
+import threading
+import time
+import numpy as np
+from multiprocessing import shared_memory
+from buffer_pool import BUFFER_POOL
+from frame_codec import FrameDecoder, FrameEncoder
+from metrics import METRICS
+
+# What a sink does when its consumer falls behind: drop the oldest frame waiting, or block the engine
+BACKPRESSURE_MODES = ('drop', 'block')
+
+# Set in the flags of a frame whose pixels are premultiplied by alpha (the fused pipeline)
+FLAG_PREMULTIPLIED = 1
+# Set in the flags of a stream frame whose payload is encoded by frame_codec rather than raw pixels
+FLAG_SPARSE = 2
+
+# How stream sinks write the pixels: raw, or encoded by frame_codec.FrameEncoder
+CODECS = ('raw', 'sparse')
+
+# Every frame written to a stream (named pipe, stdout or file) is a header followed by `size` bytes of
+# payload: height * stride bytes of BGRA pixels, or a frame_codec frame with FLAG_SPARSE
+STREAM_MAGIC = b'WMFR'
+STREAM_HEADER_DTYPE = np.dtype([
+    ('magic', 'S4'),
+    ('width', '<u4'),
+    ('height', '<u4'),
+    ('stride', '<u4'),
+    ('flags', '<u4'),
+    ('size', '<u4'),
+    ('seq', '<u8'),
+    ('timestamp', '<f8'),
+])
+
+# The shared-memory double buffer starts with a header of SHM_HEADER_SIZE bytes, followed by two slots
+# of `capacity` bytes each
+SHM_MAGIC = b'WMFRAMEB'
+SHM_VERSION = 1
+SHM_HEADER_SIZE = 128
+SHM_HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('state', '<u4'),
+    ('capacity', '<u8'),
+    ('seq', '<u8'),
+    ('read_seq', '<u8'),
+    ('latest', '<u4'),
+    ('reserved', '<u4'),
+    ('slot_seq', '<u8', (2,)),
+    ('width', '<u4', (2,)),
+    ('height', '<u4', (2,)),
+    ('flags', '<u4', (2,)),
+    ('timestamp', '<f8', (2,)),
+])
+
+# States of a shared-memory double buffer
+SHM_OPEN, SHM_REPLACED, SHM_CLOSED = 1, 2, 3
+
+class FrameSink:
+    """
+    Base class of the outputs the headless mode streams keyed frames to.
+
+    `write` is called by the engine for every keyed frame and must not keep a reference to the
+    pixels, which belong to the pipeline. Frames are numbered per sink, starting at 1.
+
+    Attributes:
+        name (str): The sink as given on the command line, e.g. 'shm:mascot'.
+        backpressure (str): One of BACKPRESSURE_MODES.
+        frames (int): Number of frames handed to the consumer.
+        dropped (int): Number of frames the consumer did not get because it fell behind.
+        bytes (int): Number of bytes handed to the consumer, encoded if the sink encodes frames.
+        closed (bool): Whether the sink stopped accepting frames, e.g. after its consumer went away for good.
+    """
+    def __init__(self, name, backpressure='drop'):
+        if backpressure not in BACKPRESSURE_MODES:
+            raise ValueError(f"Unknown backpressure mode: {backpressure}")
+        self.name = name
+        self.backpressure = backpressure
+        self.frames = 0
+        self.dropped = 0
+        self.bytes = 0
+        self.closed = False
+        self._seq = 0
+
+    def write(self, pixels, timestamp, flags=0):
+        """
+        Hands a frame to the consumer. In block mode, waits until the consumer can take it.
+
+        Args:
+            pixels (ndarray): The (height, width, 4) uint8 BGRA frame.
+            timestamp (float): Monotonic time at which the frame was captured, in seconds.
+            flags (int): FLAG_PREMULTIPLIED if the pixels are premultiplied by alpha.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Stops accepting frames and releases the resources of the sink.
+        """
+        self.closed = True
+
+    def _dropped(self, count=1):
+        self.dropped += count
+        METRICS.count('sink_frames_dropped', count)
+
+class SharedMemorySink(FrameSink):
+    """
+    Publishes frames in a named shared-memory double buffer (POSIX shm_open, a named file mapping on Windows).
+
+    Each frame is written into the slot that does not hold the latest frame, so a consumer copying
+    the latest frame is not overwritten by the next one. Every slot has a sequence counter that is odd
+    while the slot is being written and twice the frame number once it is complete: a consumer reads
+    it before and after copying the pixels and retries if it changed (see SharedFrameReader). The
+    header's `seq` is the number of the latest frame, and consumers store the number of the last frame
+    they read in `read_seq`.
+
+    In drop mode the latest frame always wins, frames replaced before a consumer read them are counted
+    as dropped. In block mode, a new frame is only published once a consumer read the latest one.
+
+    The block is created without slots and replaced with the first frame, and again whenever a frame
+    does not fit the slots: the old block is marked SHM_REPLACED so consumers attach to the new one.
+    """
+    def __init__(self, name, backpressure='drop'):
+        """
+        Initializes the sink and creates its shared memory block.
+
+        Args:
+            name (str): The name of the shared memory block.
+            backpressure (str): One of BACKPRESSURE_MODES.
+
+        Raises:
+            ValueError: If a block of that name exists already.
+        """
+        super().__init__(f"shm:{name}", backpressure)
+        self.shm_name = name
+        self.shm = None
+        self._header = None
+        if not self._create(0):
+            raise ValueError(f"The shared memory {name} is already in use.")
+
+    def _create(self, capacity):
+        if self.shm is not None:
+            self._header['state'] = SHM_REPLACED
+            self._release()
+        try:
+            self.shm = shared_memory.SharedMemory(name=self.shm_name, create=True,
+                                                  size=SHM_HEADER_SIZE + max(2 * capacity, 1))
+        except FileExistsError:
+            # A consumer still holds the replaced block open (Windows), try again with the next frame
+            return False
+        self._header = np.ndarray((), dtype=SHM_HEADER_DTYPE, buffer=self.shm.buf)
+        self._header[()] = np.zeros((), dtype=SHM_HEADER_DTYPE)
+        self._header['magic'] = SHM_MAGIC
+        self._header['version'] = SHM_VERSION
+        self._header['capacity'] = capacity
+        self._header['seq'] = self._header['read_seq'] = self._seq
+        self._header['state'] = SHM_OPEN
+        return True
+
+    def write(self, pixels, timestamp, flags=0):
+        if self.closed:
+            return
+        height, width = pixels.shape[:2]
+        if self.shm is None or pixels.nbytes > int(self._header['capacity']):
+            # Frames are dropped until the block can be created
+            if not self._create(pixels.nbytes):
+                self._dropped()
+                return
+        header = self._header
+        if self.backpressure == 'block':
+            while header['read_seq'] < self._seq and not self.closed:
+                time.sleep(0.001)
+            if self.closed:
+                return
+        elif self._seq and header['read_seq'] and header['read_seq'] < self._seq:
+            # A consumer is attached and never read the frame this one replaces
+            self._dropped()
+
+        frame = self._seq + 1
+        slot = 1 - int(header['latest']) if self._seq else 0
+        capacity = int(header['capacity'])
+        header['slot_seq'][slot] = 2 * frame - 1
+        target = np.ndarray((height, width, 4), dtype=np.uint8, buffer=self.shm.buf,
+                            offset=SHM_HEADER_SIZE + slot * capacity)
+        np.copyto(target, pixels)
+        del target
+        header['width'][slot], header['height'][slot] = width, height
+        header['flags'][slot] = flags
+        header['timestamp'][slot] = timestamp
+        header['slot_seq'][slot] = 2 * frame
+        header['latest'] = slot
+        header['seq'] = frame
+        self._seq = frame
+        self.frames += 1
+        self.bytes += pixels.nbytes
+
+    def close(self):
+        """
+        Marks the buffer closed for the consumers and destroys it.
+        """
+        super().close()
+        if self.shm is not None:
+            self._header['state'] = SHM_CLOSED
+            self._release()
+
+    def _release(self):
+        self._header = None
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+class StreamSink(FrameSink):
+    """
+    Writes frames to a byte stream, each as a STREAM_HEADER_DTYPE header followed by its payload.
+
+    Frames are copied into pooled buffers and written by a background thread, so a slow consumer
+    never stalls capturing. At most `queue_size` frames wait; when the queue is full, drop mode
+    discards the oldest waiting frame and block mode waits for room.
+
+    With the 'sparse' codec, frames are encoded by frame_codec on the writer thread, in the order
+    they are written, so dropped frames do not break the chain of delta frames. A consumer that
+    connects gets a keyframe first.
+
+    Subclasses open the stream in `_connect`, which may block until a consumer is there, and can
+    reconnect after the consumer went away.
+    """
+    reconnect = False
+
+    def __init__(self, name, backpressure='drop', queue_size=4, codec='raw'):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec: {codec}")
+        super().__init__(name, backpressure)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stream = None
+        self._encoder = FrameEncoder() if codec == 'sparse' else None
+        self._writer = threading.Thread(target=self._write_loop, name=f"sink-{name}", daemon=True)
+        self._writer.start()
+
+    def write(self, pixels, timestamp, flags=0):
+        if self.closed:
+            return
+        height, width = pixels.shape[:2]
+        header = np.zeros((), dtype=STREAM_HEADER_DTYPE)
+        header['magic'] = STREAM_MAGIC
+        header['width'], header['height'], header['stride'] = width, height, width * 4
+        header['flags'] = flags
+        self._seq += 1
+        header['seq'] = self._seq
+        header['timestamp'] = timestamp
+        buffer = BUFFER_POOL.acquire(pixels.shape)
+        np.copyto(buffer, pixels)
+        item = (header, buffer)
+
+        if self.backpressure == 'block':
+            while not self.closed:
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            BUFFER_POOL.release(buffer)
+            return
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    _, oldest = self._queue.get_nowait()
+                except queue.Empty:
+                    continue
+                BUFFER_POOL.release(oldest)
+                self._dropped()
+
+    def close(self):
+        """
+        Writes the frames still waiting, closes the stream and stops the writer thread. A writer
+        stuck on a consumer that stopped reading is left behind after a timeout.
+        """
+        if self.closed:
+            return
+        super().close()
+        try:
+            self._queue.put(None, timeout=2.0)
+        except queue.Full:
+            return
+        self._writer.join(timeout=2.0)
+
+    def _connect(self):
+        """
+        Returns the stream to write to, an object with `write` and `close`.
+        """
+        raise NotImplementedError
+
+    def _disconnect(self):
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            header, buffer = item
+            try:
+                if self._stream is None:
+                    self._stream = self._connect()
+                    if self._encoder is not None:
+                        self._encoder.reset()
+                payload = buffer.data
+                if self._encoder is not None:
+                    payload = self._encoder.encode(buffer, float(header['timestamp']))
+                    header['flags'] = int(header['flags']) | FLAG_SPARSE
+                header['size'] = len(payload) if self._encoder is not None else buffer.nbytes
+                self._stream.write(header.tobytes())
+                self._stream.write(payload)
+                self.frames += 1
+                self.bytes += header.itemsize + int(header['size'])
+            except Exception as e:
+                # The consumer went away, the frame is lost
+                self._dropped()
+                self._disconnect()
+                if not self.reconnect:
+                    print(f"Sink {self.name} closed: {e}")
+                    self.closed = True
+                    break
+            finally:
+                BUFFER_POOL.release(buffer)
+        # Frames left after the consumer went away
+        try:
+            while True:
+                item = self._queue.get_nowait()
+                if item is not None:
+                    BUFFER_POOL.release(item[1])
+        except queue.Empty:
+            pass
+        self._disconnect()
+        if self._encoder is not None:
+            self._encoder.release()
+
+class PipeSink(StreamSink):
+    """
+    Writes frames to a named pipe: a FIFO at `path` on POSIX, created if missing, or the pipe
+    `path` (e.g. \\\\.\\pipe\\mascot) served through win32pipe on Windows.
+
+    Writing waits for a consumer to open the pipe. When the consumer goes away, the next frame waits
+    for another one.
+    """
+    reconnect = True
+
+    def __init__(self, path, backpressure='drop', queue_size=4, codec='raw'):
+        self.path = path
+        if sys.platform != 'win32' and not os.path.exists(path):
+            os.mkfifo(path)
+        super().__init__(f"pipe:{path}", backpressure, queue_size, codec)
+
+    def _connect(self):
+        if sys.platform == 'win32':
+            return _Win32Pipe(self.path)
+        return open(self.path, 'wb', buffering=0)
+
+    def close(self):
+        if sys.platform != 'win32' and self._stream is None and not self.closed:
+            # Unblock the writer thread if it is still waiting for a consumer to open the FIFO
+            try:
+                os.close(os.open(self.path, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        super().close()
+
+class _Win32Pipe:
+    """
+    The server end of a Windows named pipe, connected to one consumer.
+    """
+    def __init__(self, path):
+        import win32pipe
+        self._handle = win32pipe.CreateNamedPipe(path, win32pipe.PIPE_ACCESS_OUTBOUND,
+                                                 win32pipe.PIPE_TYPE_BYTE | win32pipe.PIPE_WAIT, 1, 1 << 20, 0, 0, None)
+        win32pipe.ConnectNamedPipe(self._handle, None)
+
+    def write(self, data):
+        import win32file
+        win32file.WriteFile(self._handle, data)
+
+    def close(self):
+        import win32file
+        import win32pipe
+        win32pipe.DisconnectNamedPipe(self._handle)
+        win32file.CloseHandle(self._handle)
+
+class StdoutSink(StreamSink):
+    """
+    Writes frames to the standard output of the process, e.g. for `python run.py --headless --sink stdout | encoder`.
+
+    The sink owns the binary stream; text output of the app has to go to stderr meanwhile.
+    """
+    def __init__(self, stream=None, backpressure='drop', queue_size=4, codec='raw'):
+        self._output = stream or sys.stdout.buffer
+        super().__init__('stdout', backpressure, queue_size, codec)
+
+    def _connect(self):
+        return self._output
+
+    def _disconnect(self):
+        self._stream = None
+
+class FileSink(StreamSink):
+    """
+    Writes frames to a file, a recording of the keyed frames that read_stream_frames plays back.
+    """
+    def __init__(self, path, backpressure='drop', queue_size=4, codec='raw'):
+        self.path = path
+        self._file = open(path, 'wb')
+        super().__init__(f"file:{path}", backpressure, queue_size, codec)
+
+    def _connect(self):
+        return self._file
+
+def create_sink(spec, backpressure='drop', stdout=None, codec='raw'):
+    """
+    Creates a sink from its command line form: shm:NAME, pipe:PATH, file:PATH or stdout.
+
+    Args:
+        spec (str): The sink.
+        backpressure (str): One of BACKPRESSURE_MODES.
+        stdout (file, optional): The binary standard output, for the stdout sink.
+        codec (str): One of CODECS, how stream sinks write frames. The shared-memory sink always
+            holds raw frames, its consumers may skip frames.
+
+    Raises:
+        ValueError: If the sink or codec is unknown.
+    """
+    kind, _, target = spec.partition(':')
+    if kind == 'shm' and target:
+        return SharedMemorySink(target, backpressure)
+    if kind == 'pipe' and target:
+        return PipeSink(target, backpressure, codec=codec)
+    if kind == 'file' and target:
+        return FileSink(target, backpressure, codec=codec)
+    if spec == 'stdout':
+        return StdoutSink(stdout, backpressure, codec=codec)
+    raise ValueError(f"Unknown sink: {spec}, use shm:NAME, pipe:PATH, file:PATH or stdout.")
+
+class SharedFrameReader:
+    """
+    Reads the frames of a SharedMemorySink from another process.
+
+    The consumer side of the double buffer, also a reference for consumers in other languages:
+    wait for a new `seq`, copy the `latest` slot between two matching reads of its `slot_seq`,
+    then store the frame number in `read_seq`.
+    """
+    def __init__(self, name):
+        """
+        Attaches to the shared memory block of a sink.
+
+        Raises:
+            FileNotFoundError: If no sink of that name exists.
+            ValueError: If the block is not a frame double buffer.
+        """
+        self.name = name
+        self.shm = shared_memory.SharedMemory(name=name)
+        if sys.platform != 'win32':
+            # Attaching registers the block with this process's resource tracker, which would destroy it on exit
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self._header = np.ndarray((), dtype=SHM_HEADER_DTYPE, buffer=self.shm.buf)
+        if self._header['magic'] != SHM_MAGIC or self._header['version'] != SHM_VERSION:
+            self.close()
+            raise ValueError(f"{name} is not a frame double buffer of version {SHM_VERSION}.")
+        self.last_seq = int(self._header['read_seq'])
+
+    @property
+    def state(self):
+        return int(self._header['state'])
+
+    def read(self, timeout=1.0):
+        """
+        Waits for a frame newer than the last one read and copies it.
+
+        Returns:
+            tuple or None: The (height, width, 4) pixels, the frame number, the capture time and the
+            flags, or None if no new frame arrived within `timeout` or the sink replaced or closed the block.
+        """
+        header = self._header
+        deadline = time.monotonic() + timeout
+        while True:
+            if header['state'] != SHM_OPEN:
+                return None
+            seq = int(header['seq'])
+            if seq > self.last_seq:
+                slot = int(header['latest'])
+                before = int(header['slot_seq'][slot])
+                if before == 2 * seq:
+                    width, height = int(header['width'][slot]), int(header['height'][slot])
+                    capacity = int(header['capacity'])
+                    pixels = np.ndarray((height, width, 4), dtype=np.uint8, buffer=self.shm.buf,
+                                        offset=SHM_HEADER_SIZE + slot * capacity).copy()
+                    timestamp, flags = float(header['timestamp'][slot]), int(header['flags'][slot])
+                    if int(header['slot_seq'][slot]) == before:
+                        self.last_seq = seq
+                        header['read_seq'] = seq
+                        return pixels, seq, timestamp, flags
+                continue
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0.001)
+
+    def close(self):
+        self._header = None
+        self.shm.close()
+
+def read_stream_frames(stream):
+    """
+    Yields the frames written by a StreamSink to a byte stream, until it ends. Sparse frames are
+    decoded, into a buffer that is reused for the next frame.
+
+    Yields:
+        tuple: The header record (see STREAM_HEADER_DTYPE) and the (height, width, 4) pixels.
+
+    Raises:
+        ValueError: If the stream is not a frame stream.
+    """
+    decoder = FrameDecoder()
+    try:
+        while True:
+            data = stream.read(STREAM_HEADER_DTYPE.itemsize)
+            if len(data) < STREAM_HEADER_DTYPE.itemsize:
+                return
+            header = np.frombuffer(data, dtype=STREAM_HEADER_DTYPE)[0]
+            if header['magic'] != STREAM_MAGIC:
+                raise ValueError("Not a frame stream.")
+            size = int(header['size'])
+            payload = stream.read(size)
+            if len(payload) < size:
+                return
+            if header['flags'] & FLAG_SPARSE:
+                pixels, _ = decoder.decode(payload)
+            else:
+                pixels = np.frombuffer(payload, dtype=np.uint8).reshape(int(header['height']), int(header['width']), 4)
+            yield header, pixels
+    finally:
+        decoder.release()
@@ -0,0 +1,573 @@
+import ctypes
+import ctypes.util
+import sys
+import time
+from collections import namedtuple
+import numpy as np
+
+Frame = namedtuple('Frame', ['data', 'width', 'height', 'stride', 'pixel_format', 'timestamp'])
+Frame.__doc__ = """
+A single captured frame.
+
+Attributes:
+    data (ndarray): A (height, width, 4) uint8 view of the pixels. Rows may be padded, see `stride`.
+    width (int): Width of the frame in pixels.
+    height (int): Height of the frame in pixels.
+    stride (int): Number of bytes between the starts of two consecutive rows in the source buffer.
+    pixel_format (str): Byte order of a pixel, either 'BGRA' or 'BGRX' (fourth byte is padding).
+    timestamp (float): Monotonic time at which the frame was grabbed, in seconds.
+"""
+
+def clip_region(region, width, height):
+    """
+    Clips a capture region to a client area of the given size.
+
+    Args:
+        region (tuple): The (x, y, width, height) rectangle to capture, or None for the whole client area.
+        width (int): The width of the client area.
+        height (int): The height of the client area.
+
+    Returns:
+        tuple: The (x, y, width, height) part of the region inside the client area.
+
+    Raises:
+        ValueError: If the region lies entirely outside the client area.
+    """
+    if region is None:
+        return 0, 0, width, height
+    x, y, region_width, region_height = region
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(width, x + region_width), min(height, y + region_height)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(f"The capture region {tuple(region)} lies outside the {width}x{height} client area.")
+    return x0, y0, x1 - x0, y1 - y0
+
+def union_region(regions):
+    """
+    Returns the smallest capture region covering all of the given ones.
+
+    Args:
+        regions (list): (x, y, width, height) rectangles, or None for the whole client area.
+
+    Returns:
+        tuple: The (x, y, width, height) bounding box, or None if any region is the whole client area.
+    """
+    if any(region is None for region in regions):
+        return None
+    x0 = min(region[0] for region in regions)
+    y0 = min(region[1] for region in regions)
+    x1 = max(region[0] + region[2] for region in regions)
+    y1 = max(region[1] + region[3] for region in regions)
+    return x0, y0, x1 - x0, y1 - y0
+
+def crop_frame(frame, region, captured_region=None):
+    """
+    Returns the part of a frame inside a capture region, without copying the pixels.
+
+    Args:
+        frame (Frame): A frame captured with `captured_region`.
+        region (tuple): The (x, y, width, height) rectangle of the client area to keep, or None for all of it.
+        captured_region (tuple): The region `frame` was captured with, None for the whole client area.
+
+    Returns:
+        Frame: The cropped frame, `frame` itself if the region covers all of it.
+
+    Raises:
+        ValueError: If the region lies entirely outside the frame.
+    """
+    if region is None or region == captured_region:
+        return frame
+    if captured_region is not None:
+        region = (region[0] - captured_region[0], region[1] - captured_region[1], region[2], region[3])
+    x, y, width, height = clip_region(region, frame.width, frame.height)
+    if (x, y, width, height) == (0, 0, frame.width, frame.height):
+        return frame
+    return frame._replace(data=frame.data[y:y + height, x:x + width], width=width, height=height)
+
+class FrameSource:
+    """
+    Base class for the capture backends that deliver frames of a target window.
+
+    A frame source is opened once, grabbed from on every tick and closed when it is no
+    longer needed. Backends report the pixel format and stride of the frames they deliver
+    so that later stages can wrap the pixels without converting them first.
+
+    Backends capture the client area of the window, or only the `region` of it, cropped
+    where the pixels are copied out of the window so later stages never see the rest.
+
+    Attributes:
+        window_title (str): The title of the window to capture.
+        region (tuple): The (x, y, width, height) rectangle of the client area to capture, or None
+            for the whole client area. It may be changed between grabs.
+        pixel_format (str): Byte order of the pixels delivered by `grab`.
+        width (int): Width of the last grabbed frame, 0 before the first grab.
+        height (int): Height of the last grabbed frame, 0 before the first grab.
+        stride (int): Row stride of the last grabbed frame in bytes, 0 before the first grab.
+    """
+    pixel_format = 'BGRA'
+
+    def __init__(self, window_title):
+        """
+        Initializes the frame source for the given window.
+
+        Args:
+            window_title (str): The title of the window to capture.
+        """
+        self.window_title = window_title
+        self.region = None
+        self.width = 0
+        self.height = 0
+        self.stride = 0
+        self.is_open = False
+
+    def open(self):
+        """
+        Acquires the resources needed to capture the target window.
+
+        Raises:
+            ValueError: If the backend cannot be used to capture the target window.
+        """
+        self.is_open = True
+
+    def grab(self):
+        """
+        Captures the current content of the target window.
+
+        Returns:
+            Frame: The captured frame, or None while the target is temporarily unavailable and the
+            backend is waiting to retry. The data stays valid until the next call to `grab` or `close`.
+
+        Raises:
+            ValueError: If the window cannot be captured.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases every resource acquired by `open` and `grab`.
+        """
+        self.is_open = False
+
+    def _make_frame(self, data, width, height, stride):
+        """
+        Records the geometry of a freshly grabbed frame and wraps it into a Frame.
+        """
+        self.width, self.height, self.stride = width, height, stride
+        return Frame(data, width, height, stride, self.pixel_format, time.monotonic())
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class Win32FrameSource(FrameSource):
+    """
+    Captures a window through the Win32 API (PrintWindow into a GDI bitmap).
+
+    The capture runs in a CaptureSession, so the window handle and the GDI objects are reused
+    between frames and a missing or minimized window is retried with increasing delays.
+    """
+    pixel_format = 'BGRA'
+
+    def __init__(self, window_title, api=None):
+        """
+        Initializes the frame source for the given window.
+
+        Args:
+            window_title (str): The title of the window to capture.
+            api (FakeWin32, optional): An object providing win32gui, win32ui and user32 replacements,
+                e.g. fake_win32.FakeWin32 to capture on systems without the win32 API.
+        """
+        super().__init__(window_title)
+        self.api = api
+        self.session = None
+
+    def open(self):
+        """
+        Starts the capture session.
+        """
+        from capture_image import CaptureSession
+        if self.api is not None:
+            self.session = CaptureSession(self.window_title, self.api.win32gui, self.api.win32ui, self.api.user32,
+                                          gdi32=getattr(self.api, 'gdi32', None))
+        else:
+            self.session = CaptureSession(self.window_title)
+        super().open()
+
+    def grab(self):
+        """
+        Captures the target window with PrintWindow and wraps the bitmap bits without copying them.
+
+        Returns None while the window is unavailable.
+        """
+        self.session.region = self.region
+        result = self.session.capture()
+        if result is None:
+            return None
+        bits, width, height = result
+        data = np.frombuffer(bits, dtype=np.uint8).reshape(height, width, 4)
+        return self._make_frame(data, width, height, width * 4)
+
+    def close(self):
+        """
+        Releases the GDI objects of the capture session.
+        """
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        super().close()
+
+# Xlib and MIT-SHM definitions used by the X11 backend
+class _XImage(ctypes.Structure):
+    _fields_ = [
+        ('width', ctypes.c_int), ('height', ctypes.c_int), ('xoffset', ctypes.c_int),
+        ('format', ctypes.c_int), ('data', ctypes.c_void_p), ('byte_order', ctypes.c_int),
+        ('bitmap_unit', ctypes.c_int), ('bitmap_bit_order', ctypes.c_int), ('bitmap_pad', ctypes.c_int),
+        ('depth', ctypes.c_int), ('bytes_per_line', ctypes.c_int), ('bits_per_pixel', ctypes.c_int),
+        ('red_mask', ctypes.c_ulong), ('green_mask', ctypes.c_ulong), ('blue_mask', ctypes.c_ulong),
+        ('obdata', ctypes.c_void_p), ('funcs', ctypes.c_void_p * 6),
+    ]
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ('shmseg', ctypes.c_ulong), ('shmid', ctypes.c_int),
+        ('shmaddr', ctypes.c_void_p), ('readOnly', ctypes.c_int),
+    ]
+
+class _XWindowAttributes(ctypes.Structure):
+    _fields_ = [
+        ('x', ctypes.c_int), ('y', ctypes.c_int), ('width', ctypes.c_int), ('height', ctypes.c_int),
+        ('border_width', ctypes.c_int), ('depth', ctypes.c_int), ('visual', ctypes.c_void_p),
+        ('root', ctypes.c_ulong), ('class', ctypes.c_int), ('bit_gravity', ctypes.c_int),
+        ('win_gravity', ctypes.c_int), ('backing_store', ctypes.c_int), ('backing_planes', ctypes.c_ulong),
+        ('backing_pixel', ctypes.c_ulong), ('save_under', ctypes.c_int), ('colormap', ctypes.c_ulong),
+        ('map_installed', ctypes.c_int), ('map_state', ctypes.c_int), ('all_event_masks', ctypes.c_long),
+        ('your_event_mask', ctypes.c_long), ('do_not_propagate_mask', ctypes.c_long),
+        ('override_redirect', ctypes.c_int), ('screen', ctypes.c_void_p),
+    ]
+
+class _XErrorEvent(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_int), ('display', ctypes.c_void_p), ('resourceid', ctypes.c_ulong),
+        ('serial', ctypes.c_ulong), ('error_code', ctypes.c_ubyte), ('request_code', ctypes.c_ubyte),
+        ('minor_code', ctypes.c_ubyte),
+    ]
+
+_XErrorHandler = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(_XErrorEvent))
+
+_ZPIXMAP = 2
+_IS_VIEWABLE = 2
+_ALL_PLANES = 0xFFFFFFFF
+_IPC_PRIVATE = 0
+_IPC_CREAT = 0o1000
+_IPC_RMID = 0
+# shmat returns (void *) -1 on failure
+_SHMAT_FAILED = ctypes.c_void_p(-1).value
+
+# The libraries loaded by _load_xlib, loaded once per process
+_xlib_handles = None
+
+# Xlib keeps one error handler for the whole process. It is installed once and records the last
+# protocol error of every display an X11ShmFrameSource opened, errors of other displays are ignored.
+_x_errors = {}
+
+def _handle_x_error(display, event):
+    if display in _x_errors:
+        _x_errors[display] = event.contents.error_code
+    return 0
+
+_x_error_handler = _XErrorHandler(_handle_x_error)
+
+def _load_xlib():
+    """
+    Loads libX11, libXext and libc and declares the signatures used by the X11 backend.
+
+    The first call also installs the error handler of the process, since Xlib exits the process
+    on protocol errors by default.
+
+    Returns:
+        tuple: The libX11, libXext and libc handles.
+
+    Raises:
+        ValueError: If the X11 libraries cannot be found.
+    """
+    global _xlib_handles
+    if _xlib_handles is not None:
+        return _xlib_handles
+    x11_path = ctypes.util.find_library('X11')
+    xext_path = ctypes.util.find_library('Xext')
+    if not x11_path or not xext_path:
+        raise ValueError("The x11 capture backend requires libX11 and libXext.")
+    xlib = ctypes.cdll.LoadLibrary(x11_path)
+    xext = ctypes.cdll.LoadLibrary(xext_path)
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+    xlib.XOpenDisplay.restype = ctypes.c_void_p
+    xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+    xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+    xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+    xlib.XQueryTree.argtypes = [
+        ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_ulong),
+        ctypes.POINTER(ctypes.POINTER(ctypes.c_ulong)), ctypes.POINTER(ctypes.c_uint),
+    ]
+    xlib.XFetchName.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(ctypes.c_char_p)]
+    xlib.XFree.argtypes = [ctypes.c_void_p]
+    xlib.XGetWindowAttributes.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XWindowAttributes)]
+    xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XDestroyImage.argtypes = [ctypes.POINTER(_XImage)]
+    xlib.XSetErrorHandler.argtypes = [_XErrorHandler]
+    xlib.XSetErrorHandler.restype = ctypes.c_void_p
+
+    xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+    xext.XShmCreateImage.argtypes = [
+        ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p,
+        ctypes.POINTER(_XShmSegmentInfo), ctypes.c_uint, ctypes.c_uint,
+    ]
+    xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+    xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+    xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+    xext.XShmGetImage.argtypes = [
+        ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XImage), ctypes.c_int, ctypes.c_int, ctypes.c_ulong,
+    ]
+
+    libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+    libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+    libc.shmat.restype = ctypes.c_void_p
+    libc.shmdt.argtypes = [ctypes.c_void_p]
+    libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+    xlib.XSetErrorHandler(_x_error_handler)
+    _xlib_handles = xlib, xext, libc
+    return _xlib_handles
+
+class X11ShmFrameSource(FrameSource):
+    """
+    Captures a named X11 window through MIT-SHM shared-memory images.
+
+    The X server writes the window content straight into a shared memory segment that is
+    mapped into this process, so no pixel data travels over the X socket. Works with any
+    X server that offers the MIT-SHM extension, including a headless Xvfb.
+
+    The display connection is kept open while the target window is missing or not viewable, and
+    the window is looked up again with an increasing delay instead of on every tick, as
+    CaptureSession does for the win32 backend.
+
+    Attributes:
+        retry_delay (float): The current delay between capture attempts in seconds, 0 while capturing normally.
+        unavailable_reason (str): Why the window cannot be captured right now, or None.
+    """
+    pixel_format = 'BGRX'
+
+    def __init__(self, window_title, display_name=None, min_retry_delay=0.1, max_retry_delay=5.0,
+                 clock=time.monotonic):
+        """
+        Initializes the frame source for the given window.
+
+        Args:
+            window_title (str): The title (WM_NAME) of the window to capture.
+            display_name (str, optional): The X display to connect to. Defaults to $DISPLAY.
+            min_retry_delay (float): The first retry delay in seconds after the window became unavailable.
+            max_retry_delay (float): The upper limit of the retry delay in seconds.
+            clock (callable): Monotonic clock returning seconds, used for the retry delays.
+        """
+        super().__init__(window_title)
+        self.display_name = display_name
+        self.min_retry_delay = min_retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.clock = clock
+        self.retry_delay = 0
+        self.unavailable_reason = None
+        self._next_attempt = 0
+        self._display = None
+        self._window = None
+        self._image = None
+        self._shminfo = None
+
+    def open(self):
+        """
+        Connects to the X server and checks for MIT-SHM. The target window is looked up by `grab`.
+        """
+        self._xlib, self._xext, self._libc = _load_xlib()
+
+        display_name = self.display_name.encode() if self.display_name else None
+        self._display = self._xlib.XOpenDisplay(display_name)
+        if not self._display:
+            raise ValueError("Unable to open the X display.")
+        _x_errors[self._display] = None
+        if not self._xext.XShmQueryExtension(self._display):
+            self.close()
+            raise ValueError("The X server does not support the MIT-SHM extension.")
+        super().open()
+
+    def grab(self):
+        """
+        Copies the window content into the shared memory segment and wraps it without copying.
+
+        Returns None while the window is missing or not viewable, or the next retry is not due yet.
+        """
+        if not self.is_open:
+            self.open()
+        if self.clock() < self._next_attempt:
+            return None
+
+        if self._window is None:
+            self._window = self._find_window(self._xlib.XDefaultRootWindow(self._display))
+            if self._window is None:
+                return self._back_off(f"No X11 window titled '{self.window_title}' was found.")
+
+        attributes = _XWindowAttributes()
+        if not self._xlib.XGetWindowAttributes(self._display, self._window, ctypes.byref(attributes)):
+            # Most likely the window was destroyed, start over with a fresh lookup
+            self._window = None
+            return self._back_off("Unable to query the target window.")
+        if attributes.map_state != _IS_VIEWABLE:
+            return self._back_off("The target window is not viewable.")
+
+        # The server copies only the capture region into the shared image
+        x, y, width, height = clip_region(self.region, attributes.width, attributes.height)
+        if self._image is None or (self._image.contents.width, self._image.contents.height) != (width, height):
+            self._create_image(attributes, width, height)
+
+        _x_errors[self._display] = None
+        ok = self._xext.XShmGetImage(self._display, self._window, self._image, x, y, _ALL_PLANES)
+        self._xlib.XSync(self._display, 0)
+        if not ok or _x_errors[self._display] is not None:
+            # The window may have been unmapped or destroyed since it was queried
+            self._window = None
+            return self._back_off("Failure to capture window image.")
+
+        if self.unavailable_reason is not None:
+            print(f"Capture of '{self.window_title}' resumed.")
+        self.unavailable_reason = None
+        self.retry_delay = 0
+        self._next_attempt = 0
+
+        image = self._image.contents
+        stride = image.bytes_per_line
+        buffer = (ctypes.c_ubyte * (stride * height)).from_address(image.data)
+        data = np.frombuffer(buffer, dtype=np.uint8).reshape(height, stride)[:, :width * 4].reshape(height, width, 4)
+        return self._make_frame(data, width, height, stride)
+
+    def close(self):
+        """
+        Detaches the shared memory segment and closes the display connection.
+        """
+        self._destroy_image()
+        if self._display:
+            self._xlib.XCloseDisplay(self._display)
+            _x_errors.pop(self._display, None)
+            self._display = None
+        self._window = None
+        super().close()
+
+    def _back_off(self, reason):
+        """
+        Schedules the next capture attempt with a doubled delay, reporting only changes of the reason.
+
+        Returns:
+            None: So that `grab` can return the result.
+        """
+        if reason != self.unavailable_reason:
+            print(f"Capture of '{self.window_title}' paused: {reason}")
+        self.unavailable_reason = reason
+        self.retry_delay = min(self.max_retry_delay, self.retry_delay * 2 if self.retry_delay else self.min_retry_delay)
+        self._next_attempt = self.clock() + self.retry_delay
+        return None
+
+    def _find_window(self, window):
+        """
+        Recursively searches the window tree below `window` for the target title.
+        """
+        name = ctypes.c_char_p()
+        if self._xlib.XFetchName(self._display, window, ctypes.byref(name)) and name.value is not None:
+            title = name.value.decode('utf-8', 'replace')
+            self._xlib.XFree(name)
+            if title == self.window_title:
+                return window
+
+        root, parent = ctypes.c_ulong(), ctypes.c_ulong()
+        children = ctypes.POINTER(ctypes.c_ulong)()
+        count = ctypes.c_uint()
+        if not self._xlib.XQueryTree(self._display, window, ctypes.byref(root), ctypes.byref(parent),
+                                     ctypes.byref(children), ctypes.byref(count)):
+            return None
+        try:
+            for i in range(count.value):
+                found = self._find_window(children[i])
+                if found is not None:
+                    return found
+        finally:
+            if children:
+                self._xlib.XFree(children)
+        return None
+
+    def _create_image(self, attributes, width, height):
+        """
+        (Re)creates the shared memory image for the given capture size.
+        """
+        self._destroy_image()
+        shminfo = _XShmSegmentInfo()
+        image = self._xext.XShmCreateImage(self._display, attributes.visual, attributes.depth, _ZPIXMAP,
+                                           None, ctypes.byref(shminfo), width, height)
+        if not image:
+            raise ValueError("Unable to create a shared memory image.")
+        if image.contents.bits_per_pixel != 32:
+            self._xlib.XDestroyImage(image)
+            raise ValueError("The x11 capture backend only supports 32 bits per pixel visuals.")
+
+        size = image.contents.bytes_per_line * image.contents.height
+        shminfo.shmid = self._libc.shmget(_IPC_PRIVATE, size, _IPC_CREAT | 0o600)
+        if shminfo.shmid < 0:
+            self._xlib.XDestroyImage(image)
+            raise ValueError("Unable to allocate a shared memory segment.")
+        shminfo.shmaddr = self._libc.shmat(shminfo.shmid, None, 0)
+        if shminfo.shmaddr in (None, _SHMAT_FAILED):
+            self._libc.shmctl(shminfo.shmid, _IPC_RMID, None)
+            self._xlib.XDestroyImage(image)
+            raise ValueError(f"Unable to attach the shared memory segment (errno {ctypes.get_errno()}).")
+        image.contents.data = shminfo.shmaddr
+        shminfo.readOnly = 0
+
+        self._xext.XShmAttach(self._display, ctypes.byref(shminfo))
+        self._xlib.XSync(self._display, 0)
+        # The segment is released automatically once both processes have detached
+        self._libc.shmctl(shminfo.shmid, _IPC_RMID, None)
+
+        self.pixel_format = 'BGRA' if attributes.depth == 32 else 'BGRX'
+        self._image, self._shminfo = image, shminfo
+
+    def _destroy_image(self):
+        if self._image is None:
+            return
+        self._xext.XShmDetach(self._display, ctypes.byref(self._shminfo))
+        self._xlib.XDestroyImage(self._image)
+        self._libc.shmdt(self._shminfo.shmaddr)
+        self._image, self._shminfo = None, None
+
+FRAME_SOURCES = {
+    'win32': Win32FrameSource,
+    'x11': X11ShmFrameSource,
+}
+
+def create_frame_source(window_title, backend='auto'):
+    """
+    Creates a frame source for the given window using the requested capture backend.
+
+    Args:
+        window_title (str): The title of the window to capture.
+        backend (str): One of the keys of FRAME_SOURCES, or 'auto' to pick the backend of the current platform.
+
+    Returns:
+        FrameSource: The (unopened) frame source.
+
+    Raises:
+        ValueError: If the backend is unknown.
+    """
+    if backend == 'auto':
+        backend = 'win32' if sys.platform == 'win32' else 'x11'
+    if backend not in FRAME_SOURCES:
+        raise ValueError(f"Unknown capture backend: {backend}")
+    return FRAME_SOURCES[backend](window_title)
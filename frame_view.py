@@ -0,0 +1,115 @@
+import time
+from PyQt5.QtWidgets import QWidget
+from PyQt5.QtGui import QImage, QPainter, QRegion, QTransform
+from PyQt5.QtCore import QPoint, QRect, QRectF
+from pipeline import display_size
+from metrics import METRICS
+
+class FrameView(QWidget):
+    """
+    Paints keyed frames directly in paintEvent.
+
+    Frames are expected in QImage.Format_ARGB32_Premultiplied, the format the raster paint engine
+    blends natively, and already cropped and scaled to the size they are shown at, so painting is
+    a plain blit. Only when the widget was resized before a newly scaled frame arrived is the frame
+    scaled while painting. The placement of the frame (the area it is shown in and the transform
+    from image to widget coordinates) is computed once per frame or widget size and cached.
+
+    Updates repaint only the damaged part of the frame when one is given. A frame can also come as
+    just its opaque part and the box it lies in: only that part is painted, and only the boxes of the
+    previous and the new frame (within the damage) are repainted. Outside of them both frames are
+    transparent, so the rest of the widget, cleared when it was last repainted, is left alone.
+
+    Attributes:
+        image (QImage): The frame currently shown, or its opaque part, or None.
+        box (QRect): Where `image` lies in the frame.
+        frameSize (QSize): The size of the whole frame.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.image = None
+        self.box = QRect()
+        self.frameSize = None
+        self._placementKey = None
+        self._area = QRect()
+        self._transform = QTransform()
+
+    def setFrame(self, image, damage=None, box=None, size=None):
+        """
+        Shows a new frame.
+
+        Args:
+            image (QImage): The frame, converted to Format_ARGB32_Premultiplied if it is not.
+            damage (QRect, optional): The part of the frame that changed since the previous frame.
+            box (QRect, optional): Where the image lies in the frame when it only holds its opaque part,
+                the rest of the frame is transparent.
+            size (QSize, optional): The size of the whole frame when `box` is given.
+        """
+        if not image.isNull() and image.format() != QImage.Format_ARGB32_Premultiplied:
+            image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        if box is None:
+            size = image.size()
+            box = QRect(QPoint(0, 0), size)
+        resized = self.frameSize is None or size != self.frameSize
+        previous = self.box
+        self.image, self.box, self.frameSize = image, box, size
+        if resized:
+            self.update()
+            return
+        area, transform = self.placement()
+        # Outside of both boxes, both frames are transparent
+        region = QRegion()
+        for rect in (previous, box):
+            if damage is not None:
+                rect = rect.intersected(damage)
+            if not rect.isEmpty():
+                region += self.mapRect(rect, area, transform)
+        if not region.isEmpty():
+            self.update(region)
+
+    @staticmethod
+    def mapRect(rect, area, transform):
+        """
+        Returns the widget rectangle covering a rectangle of the frame, clipped to the area it is shown in.
+        """
+        return transform.mapRect(QRectF(rect)).toAlignedRect().adjusted(-1, -1, 1, 1).intersected(area)
+
+    def placement(self):
+        """
+        Returns the area the frame is shown in and the transform from image to widget coordinates.
+
+        The frame is shown at the top left, at the largest size with its aspect ratio that fits the widget.
+        """
+        key = (self.frameSize, self.size())
+        if key != self._placementKey:
+            image_width, image_height = self.frameSize.width(), self.frameSize.height()
+            width, height = display_size(image_width, image_height, self.width(), self.height())
+            self._area = QRect(0, 0, width, height)
+            self._transform = QTransform()
+            if (width, height) != (image_width, image_height):
+                self._transform = QTransform.fromScale(width / image_width, height / image_height)
+            self._placementKey = key
+        return self._area, self._transform
+
+    def paintEvent(self, event):
+        """
+        Paints the part of the frame inside the region being repainted.
+        """
+        if self.image is None or self.image.isNull():
+            return
+        started = time.perf_counter()
+        area, transform = self.placement()
+        painter = QPainter(self)
+        exposed = event.rect().intersected(area)
+        if transform.isScaling():
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+            painter.setClipRect(exposed)
+            painter.setTransform(transform)
+            painter.drawImage(self.box.topLeft(), self.image)
+        else:
+            # A blit, copy only the exposed pixels of the image
+            exposed = exposed.intersected(self.box)
+            if not exposed.isEmpty():
+                painter.drawImage(exposed.topLeft(), self.image, exposed.translated(-self.box.topLeft()))
+        painter.end()
+        METRICS.record('paint', time.perf_counter() - started)
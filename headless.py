@@ -0,0 +1,111 @@
+import threading
+import time
+from config_loader import CompiledConfig
+from pipeline import FramePipeline
+from chroma_key import configure_threads, create_keyer
+from change_detector import ChangeDetector
+from frame_scheduler import create_frame_scheduler
+from frame_sink import FLAG_PREMULTIPLIED
+from utils import capture_and_process_target_window, capture_target_frame
+from metrics import METRICS
+
+class HeadlessEngine:
+    """
+    Captures and keys one window without any Qt window, and streams the keyed frames to sinks.
+
+    Frames are keyed once at the size they are captured at and handed to every sink, so several
+    consumers cost one capture and one keying plus a copy each. Frames are paced by the configured
+    FrameScheduler; with change detection enabled, unchanged frames are not sent, consumers keep
+    showing the last one.
+
+    Attributes:
+        sinks (list): The FrameSinks the frames are written to.
+        frames (int): Number of keyed frames written to the sinks.
+    """
+    def __init__(self, config, sinks, stats_interval=5.0):
+        """
+        Initializes the engine.
+
+        Args:
+            config (dict): The validated configuration of the window, see config_loader.overlay_configs.
+            sinks (list): The FrameSinks to write to.
+            stats_interval (float): Seconds between throughput reports on stderr, 0 for none.
+        """
+        self.settings = CompiledConfig(config)
+        self.sinks = sinks
+        self.stats_interval = stats_interval
+        self.frames = 0
+        enabled, tile_size = self.settings.change_detection
+        configure_threads(*self.settings.keyer[2:])
+        self.pipeline = FramePipeline(create_keyer(*self.settings.keyer),
+                                      change_detector=ChangeDetector(tile_size) if enabled else None)
+        self.scheduler = create_frame_scheduler(self.settings)
+        self._stop = threading.Event()
+
+    def run(self):
+        """
+        Streams frames until `stop` is called, the process is interrupted or every sink closed.
+        """
+        settings = self.settings
+        flags = FLAG_PREMULTIPLIED if settings.fused else 0
+        last_report = time.monotonic()
+        last_counts = self._counts()
+        try:
+            while not self._stop.is_set():
+                started = time.monotonic()
+                frame = capture_target_frame(settings.title, settings.backend, settings.region)
+                keyed = None
+                if frame is not None:
+                    timestamp = frame.timestamp
+                    pipeline = self.pipeline if settings.fused else None
+                    keyed = capture_and_process_target_window(settings, pipeline, frame=frame, keyer=self.pipeline.keyer)
+                if keyed is not None:
+                    for sink in self.sinks:
+                        sink.write(keyed, timestamp, flags)
+                    self.frames += 1
+                    METRICS.count('frames_streamed')
+                self.scheduler.record(time.monotonic() - started, keyed is not None)
+                if all(sink.closed for sink in self.sinks):
+                    print("Every sink closed, stopping.")
+                    break
+                now = time.monotonic()
+                if self.stats_interval and now - last_report >= self.stats_interval:
+                    counts = self._counts()
+                    print(self.report(last_counts, counts, now - last_report))
+                    last_report, last_counts = now, counts
+                self._stop.wait(self.scheduler.delay(started))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def stop(self):
+        """
+        Asks `run` to return after the current frame. Safe to call from any thread or a signal handler.
+        """
+        self._stop.set()
+
+    def close(self):
+        """
+        Closes the sinks and releases the pipeline buffers.
+        """
+        for sink in self.sinks:
+            sink.close()
+        self.pipeline.release()
+
+    def _counts(self):
+        return [(sink.frames, sink.bytes, sink.dropped) for sink in self.sinks]
+
+    def report(self, before, after, elapsed):
+        """
+        Returns:
+            str: The frames per second, MB per second and dropped frames of every sink between two
+            snapshots of the sink counters taken `elapsed` seconds apart.
+        """
+        lines = [f"Headless: {self.scheduler.achieved_fps:.1f} fps keyed"]
+        for sink, (frames, size, dropped), (frames_after, size_after, dropped_after) in zip(self.sinks, before, after):
+            state = " (closed)" if sink.closed else ""
+            lines.append(f"  {sink.name}: {(frames_after - frames) / elapsed:.1f} fps, "
+                         f"{(size_after - size) / elapsed / (1 << 20):.1f} MB/s, "
+                         f"{dropped_after - dropped} dropped{state}")
+        return '\n'.join(lines)
@@ -0,0 +1,240 @@
+import csv
+import ctypes
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+import numpy as np
+
+# Pipeline stages in the order a frame passes them
+STAGES = ('capture', 'convert', 'key', 'upload', 'paint')
+
+class Metrics:
+    """
+    Rolling per-stage timings, event counters and gauges of the frame pipeline.
+
+    Stages record their durations with `record` (time them with time.perf_counter). Only the
+    most recent `window` samples of each stage are kept, so percentiles follow the current
+    behaviour during long sessions. Recording is a deque append and safe from any thread; only the
+    first sample of a new stage takes the lock, as snapshots copy the samples under it.
+    Gauges are read when a snapshot is taken, the resident memory of the process is always one.
+
+    Attributes:
+        window (int): Number of samples kept per stage.
+        counters (dict): Event counts by name, e.g. frames_dropped.
+        started (float): Monotonic time at which the metrics were created or reset.
+    """
+    def __init__(self, window=600):
+        self.window = window
+        self._lock = threading.Lock()
+        self._gauges = {}
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets every sample and counter.
+        """
+        self._timings = {}
+        self.counters = {}
+        self.started = time.monotonic()
+
+    def record(self, stage, seconds):
+        """
+        Records how long a stage took for one frame.
+
+        Args:
+            stage (str): The stage name, one of STAGES for the built-in stages.
+            seconds (float): The duration in seconds.
+        """
+        samples = self._timings.get(stage)
+        if samples is None:
+            with self._lock:
+                samples = self._timings.setdefault(stage, deque(maxlen=self.window))
+        samples.append(seconds)
+
+    def count(self, name, amount=1):
+        """
+        Adds to an event counter.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_gauge(self, name, function):
+        """
+        Adds a gauge, reported with the value `function` returns when a snapshot is taken.
+        """
+        self._gauges[name] = function
+
+    def snapshot(self):
+        """
+        Summarizes the current state of every stage and counter.
+
+        Returns:
+            dict: 'stages' maps each stage to its sample count and p50, p95, p99 and max in milliseconds,
+            'counters' holds the event counters, 'gauges' the values of the gauges added with `add_gauge`,
+            'rss_mb' the resident memory of the process (None if unknown) and 'uptime_s' the seconds
+            since the metrics were created or reset.
+        """
+        # Copied under the lock, the recording threads may add stages meanwhile
+        with self._lock:
+            timings = {stage: list(samples) for stage, samples in self._timings.items()}
+            counters = dict(self.counters)
+        stages = {}
+        ordered = [stage for stage in STAGES if stage in timings]
+        ordered += sorted(stage for stage in timings if stage not in STAGES)
+        for stage in ordered:
+            samples = np.array(timings[stage]) * 1000
+            if not len(samples):
+                continue
+            p50, p95, p99 = np.percentile(samples, (50, 95, 99))
+            stages[stage] = {'count': len(samples), 'p50_ms': round(float(p50), 3), 'p95_ms': round(float(p95), 3),
+                             'p99_ms': round(float(p99), 3), 'max_ms': round(float(samples.max()), 3)}
+        rss = process_rss()
+        return {
+            'stages': stages,
+            'counters': counters,
+            'gauges': {name: function() for name, function in list(self._gauges.items())},
+            'rss_mb': None if rss is None else round(rss / (1 << 20), 1),
+            'uptime_s': round(time.monotonic() - self.started, 1),
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_csv(self):
+        """
+        Returns the snapshot as CSV, one row per stage, counter and gauge.
+        """
+        snapshot = self.snapshot()
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        writer.writerow(['name', 'kind', 'count', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'value'])
+        for stage, summary in snapshot['stages'].items():
+            writer.writerow([stage, 'stage', summary['count'], summary['p50_ms'], summary['p95_ms'],
+                             summary['p99_ms'], summary['max_ms'], ''])
+        for name, value in snapshot['counters'].items():
+            writer.writerow([name, 'counter', '', '', '', '', '', value])
+        for name, value in snapshot['gauges'].items():
+            writer.writerow([name, 'gauge', '', '', '', '', '', value])
+        writer.writerow(['rss_mb', 'gauge', '', '', '', '', '', snapshot['rss_mb']])
+        writer.writerow(['uptime_s', 'gauge', '', '', '', '', '', snapshot['uptime_s']])
+        return output.getvalue()
+
+    def export(self, path):
+        """
+        Writes the snapshot to a file, as CSV if the path ends in .csv and as JSON otherwise.
+        """
+        with open(path, 'w', newline='') as file:
+            file.write(self.to_csv() if path.lower().endswith('.csv') else self.to_json())
+
+    def summary(self):
+        """
+        Returns:
+            str: A few lines of text describing the snapshot, as shown by the HUD.
+        """
+        snapshot = self.snapshot()
+        lines = [f"{'stage':<8} {'p50':>7} {'p95':>7} {'p99':>7}"]
+        for stage, summary in snapshot['stages'].items():
+            lines.append(f"{stage:<8} {summary['p50_ms']:>7.2f} {summary['p95_ms']:>7.2f} {summary['p99_ms']:>7.2f}")
+        lines += [f"{name}: {value}" for name, value in snapshot['counters'].items()]
+        lines += [f"{name}: {value}" for name, value in snapshot['gauges'].items()]
+        if snapshot['rss_mb'] is not None:
+            lines.append(f"RSS: {snapshot['rss_mb']:.1f} MB")
+        return '\n'.join(lines)
+
+class _ProcessMemoryCounters(ctypes.Structure):
+    _fields_ = [('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong)] + [
+        (name, ctypes.c_size_t) for name in (
+            'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+            'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')
+    ]
+
+def process_rss():
+    """
+    Returns:
+        int or None: The resident set size (working set on Windows) of this process in bytes, or None
+        if it cannot be determined on this platform.
+    """
+    if sys.platform == 'win32':
+        counters = _ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+        return None
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+class MetricsServer:
+    """
+    Serves the metrics over HTTP on localhost, for scraping during long sessions.
+
+    GET /metrics returns the JSON snapshot and GET /metrics.csv the CSV one.
+    """
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        """
+        Initializes the server, it starts listening in `start`.
+
+        Args:
+            metrics (Metrics): The metrics to serve.
+            port (int): The TCP port to listen on.
+            host (str): The address to bind, localhost by default.
+        """
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self._server = None
+
+    def start(self):
+        """
+        Binds the port and serves requests on a daemon thread.
+
+        Raises:
+            OSError: If the port cannot be bound.
+        """
+        # Only imported when the endpoint is enabled, it adds noticeably to the startup time
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path in ('/', '/metrics'):
+                    body, content_type = metrics.to_json(), 'application/json'
+                elif path == '/metrics.csv':
+                    body, content_type = metrics.to_csv(), 'text/csv'
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True).start()
+        print(f"Serving metrics on http://{self.host}:{self._server.server_address[1]}/metrics")
+
+    def stop(self):
+        """
+        Stops serving and releases the port.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+# The metrics of this process, shared by every stage of the pipeline
+METRICS = Metrics()
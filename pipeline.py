@@ -0,0 +1,397 @@
+import time
+import cv2
+import numpy as np
+from chroma_key import HSVKeyer, ParallelKeyer, close_keyer
+from buffer_pool import BUFFER_POOL
+from metrics import METRICS
+
+# ARGB32 pixels viewed as native (little-endian) uint32 values: 0xAARRGGBB
+OPAQUE_ALPHA = np.uint32(0xFF000000)
+
+class FramePipeline:
+    """
+    Keys captured frames without intermediate copies.
+
+    The capture buffer is wrapped as a NumPy view and keyed straight into preallocated
+    output buffers. The output is premultiplied BGRA, which is the memory layout of
+    QImage.Format_ARGB32_Premultiplied on little-endian machines, so Qt can wrap it
+    directly without converting it. The only full-frame write per tick is the output itself.
+
+    Output buffers are used round robin, so the previously returned frame stays valid while
+    the next one is being keyed. Buffers come from the BUFFER_POOL and go back to it when the
+    frame size changes or the pipeline is released.
+
+    With a view size, frames are first cropped to the part the overlay shows and downscaled to the
+    size it is shown at (see ViewScaler), so keying only touches pixels that will be displayed.
+
+    With a change detector, frames identical to the last keyed one are skipped altogether and
+    otherwise only the tiles that changed are keyed again; the alpha and pixels of the other
+    tiles are reused from the previous output.
+
+    The bounding box of the opaque pixels is tracked along (see OpaqueBounds), from the alpha of
+    the pixels keyed, so later stages can leave the transparent rest of the frame alone.
+
+    Attributes:
+        keyer (HSVKeyer or LUTKeyer): Computes the alpha channel, see chroma_key.KEYERS. With a
+            ParallelKeyer, every stripe of rows is keyed and written to the output by its own worker.
+        change_detector (ChangeDetector): Finds the dirty tiles of a frame, or None to key every frame entirely.
+        buffers (int): Number of output buffers that are rotated.
+        shape (tuple): The (height, width) the buffers are allocated for, or None.
+        damage (tuple): The (x0, y0, x1, y1) bounding box of the pixels keyed again for the last
+            returned frame, or None before the first frame.
+        opaque (tuple): The (x0, y0, x1, y1) bounding box of the opaque pixels of the last returned
+            frame, empty (x0 == x1) if it has none, or None before the first frame.
+    """
+    def __init__(self, keyer=None, buffers=2, change_detector=None):
+        """
+        Initializes the pipeline. Buffers are allocated on the first frame.
+
+        Args:
+            keyer (HSVKeyer or LUTKeyer, optional): Computes the alpha channel. Defaults to an HSVKeyer.
+            buffers (int): Number of output buffers that are rotated.
+            change_detector (ChangeDetector, optional): Enables skipping unchanged frames and tiles.
+        """
+        self.keyer = keyer or HSVKeyer()
+        self.buffers = buffers
+        self.change_detector = change_detector
+        self.shape = None
+        self.damage = None
+        self.opaque = None
+        self.bounds = OpaqueBounds()
+        self._outputs = []
+        self._index = 0
+        self._keyed_with = None
+        self._lower = None
+        self._upper = None
+        self._view_scaler = ViewScaler()
+
+    def invalidate(self):
+        """
+        Forgets the frame the change detector compares with, so the next frame is keyed whole. Needed
+        when the overlay shows a frame keyed by another pipeline instead of the last one keyed here.
+        """
+        detector = self.change_detector
+        if detector is not None:
+            detector.reset()
+
+    def _allocate(self, height, width):
+        """
+        Allocates the working and output buffers for frames of the given size.
+        """
+        self._release_buffers()
+        self._mask = BUFFER_POOL.acquire((height, width))
+        self._alpha = BUFFER_POOL.acquire((height, width, 4))
+        self._outputs = [BUFFER_POOL.acquire((height, width, 4)) for _ in range(self.buffers)]
+        self._index = 0
+        self.shape = (height, width)
+
+    def _release_buffers(self):
+        if self.shape is not None:
+            for buffer in [self._mask, self._alpha] + self._outputs:
+                BUFFER_POOL.release(buffer)
+        self._outputs = []
+        self.shape = None
+
+    def release(self):
+        """
+        Gives every buffer back to the pool and stops the threads of the keyer. Returned frames are no
+        longer valid, the next frame allocates new buffers.
+        """
+        self._release_buffers()
+        close_keyer(self.keyer)
+        self._view_scaler.release()
+        self.bounds.reset()
+        self.opaque = None
+        if self.change_detector is not None:
+            self.change_detector.reset()
+
+    def next_output(self, height, width):
+        """
+        Returns the next output buffer, reallocating all buffers if the frame size changed.
+
+        Args:
+            height (int): The frame height.
+            width (int): The frame width.
+
+        Returns:
+            ndarray: A (height, width, 4) uint8 buffer.
+        """
+        if self.shape != (height, width):
+            self._allocate(height, width)
+        output = self._outputs[self._index]
+        self._index = (self._index + 1) % self.buffers
+        return output
+
+    def process(self, frame, hsv_lower, hsv_upper, view_size=None):
+        """
+        Applies the chroma key to a captured frame.
+
+        Args:
+            frame (Frame): The captured frame, in BGRA or BGRX format.
+            hsv_lower (ndarray): The lower bound of the HSV values to be made transparent.
+            hsv_upper (ndarray): The upper bound of the HSV values to be made transparent. With change
+                detection, new bounds must come as new arrays, e.g. those of a new CompiledConfig.
+            view_size (tuple, optional): The (width, height) of the overlay. When given, only the visible
+                part of the frame is keyed, at the size it is shown at.
+
+        Returns:
+            ndarray: The keyed frame as premultiplied BGRA. Keyed pixels are all zero. None if the
+            change detector found the frame unchanged, the previous output is still current then.
+        """
+        data = frame.data
+        if view_size is not None:
+            started = time.perf_counter()
+            data = self._view_scaler.scale(data, *view_size)
+            METRICS.record('convert', time.perf_counter() - started)
+
+        started = time.perf_counter()
+        output = self._key_frame(data, hsv_lower, hsv_upper)
+        METRICS.record('key', time.perf_counter() - started)
+        if output is None:
+            METRICS.count('frames_skipped')
+        return output
+
+    def _key_frame(self, data, hsv_lower, hsv_upper):
+        """
+        Keys the (cropped) frame pixels, see `process`.
+        """
+        height, width = data.shape[:2]
+
+        # Read once, the GUI thread may swap the detector while a worker thread is keying
+        detector = self.change_detector
+        if detector is None:
+            output = self.next_output(height, width)
+            self._key(data, output, hsv_lower, hsv_upper)
+            self.damage = (0, 0, width, height)
+            self.opaque = self.bounds.update(self._mask)
+            return output
+
+        # A different keyer or different bounds invalidate every previously keyed tile. The bounds of a
+        # CompiledConfig are read-only and replaced with the snapshot, so comparing identities suffices
+        keyer = self.keyer
+        if keyer is not self._keyed_with or hsv_lower is not self._lower or hsv_upper is not self._upper:
+            self._keyed_with, self._lower, self._upper = keyer, hsv_lower, hsv_upper
+            detector.reset()
+
+        dirty = detector.detect(data)
+        if not dirty.any():
+            return None
+
+        previous = self._outputs[self._index - 1] if self.shape == (height, width) else None
+        output = self.next_output(height, width)
+        if self.bounds.tile_size != detector.tile_size:
+            self.bounds = OpaqueBounds(detector.tile_size)
+        if dirty.all() or previous is None:
+            self._key(data, output, hsv_lower, hsv_upper)
+            self.damage = (0, 0, width, height)
+            self.opaque = self.bounds.update(self._mask)
+        else:
+            np.copyto(output, previous)
+            spans = list(detector.dirty_spans(dirty, height, width))
+            for y0, y1, x0, x1 in spans:
+                self._key(data[y0:y1, x0:x1], output[y0:y1, x0:x1], hsv_lower, hsv_upper,
+                          self._mask[y0:y1, x0:x1], self._alpha[y0:y1, x0:x1])
+                self.bounds.update(self._mask[y0:y1, x0:x1], x0, y0, (height, width))
+            self.damage = (min(span[2] for span in spans), spans[0][0],
+                           max(span[3] for span in spans), spans[-1][1])
+            self.opaque = self.bounds.box
+        detector.update(data, dirty)
+        return output
+
+    def _key(self, data, output, hsv_lower, hsv_upper, mask=None, scratch=None):
+        """
+        Keys the given pixels (a whole frame or a rectangle of it) into the output.
+        """
+        mask = self._mask if mask is None else mask
+        scratch = self._alpha if scratch is None else scratch
+
+        # Read once, the GUI thread may swap the keyer while a worker thread is keying
+        keyer = self.keyer
+        if isinstance(keyer, ParallelKeyer):
+            # Every stripe is keyed and written by its worker, the output is not touched twice
+            def key_stripe(stripe_keyer, rows):
+                stripe_keyer.alpha(data[rows], hsv_lower, hsv_upper, out=mask[rows])
+                write_keyed_pixels(data[rows], mask[rows], output[rows], scratch[rows])
+            keyer.compile(hsv_lower, hsv_upper)
+            keyer.map(key_stripe, data.shape[0])
+            return
+
+        # Keyers read the first three channels of the 4-channel frame, no BGRA2BGR pass needed
+        keyer.alpha(data, hsv_lower, hsv_upper, out=mask)
+        write_keyed_pixels(data, mask, output, scratch)
+
+class OpaqueBounds:
+    """
+    Tracks the bounding box of the opaque pixels of keyed frames.
+
+    The box is derived from projections of the alpha mask kept per tile: for every row, which tile
+    columns have an opaque pixel in it, and for every column, which tile rows do. When only some
+    tiles of a frame are keyed again, only their projections are recomputed, and the box follows
+    from the projections without looking at the rest of the mask. Where the width allows, the mask
+    is reduced 8 pixels at a time as uint64 words.
+
+    Attributes:
+        tile_size (int): Edge length in pixels of the tiles the projections are kept for.
+        box (tuple): The (x0, y0, x1, y1) bounding box of the opaque pixels, empty (x0 == x1) if there
+            are none, or None before the first update.
+    """
+    def __init__(self, tile_size=64):
+        self.tile_size = tile_size
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the projections, the next update has to cover the whole frame.
+        """
+        self.box = None
+        self._rows = None
+        self._columns = None
+
+    def update(self, mask, x0=0, y0=0, shape=None):
+        """
+        Recomputes the projections of a keyed rectangle of the frame, and the bounding box.
+
+        Args:
+            mask (ndarray): The (height, width) alpha of the rectangle, 0 where transparent.
+            x0 (int): The left of the rectangle in the frame, on the tile grid.
+            y0 (int): The top of the rectangle in the frame, on the tile grid.
+            shape (tuple, optional): The (height, width) of the frame. Defaults to the mask size.
+
+        Returns:
+            tuple: The bounding box of the opaque pixels of the frame, see `box`.
+        """
+        tile = self.tile_size
+        height, width = mask.shape if shape is None else shape
+        if self._rows is None or self._rows.shape[0] != height or self._columns.shape[1] != width:
+            self._rows = np.zeros((height, -(-width // tile)), dtype=bool)
+            self._columns = np.zeros((-(-height // tile), width), dtype=bool)
+        rect_height, rect_width = mask.shape
+        words, step = mask, tile
+        if tile % 8 == 0 and rect_width % 8 == 0:
+            words, step = mask.view(np.uint64), tile // 8
+        columns = np.bitwise_or.reduceat(words, np.arange(0, rect_height, tile), axis=0)
+        self._columns[y0 // tile:y0 // tile + len(columns), x0:x0 + rect_width] = columns.view(np.uint8) != 0
+        rows = np.bitwise_or.reduceat(words, np.arange(0, words.shape[1], step), axis=1)
+        self._rows[y0:y0 + rect_height, x0 // tile:x0 // tile + rows.shape[1]] = rows != 0
+
+        opaque_rows = np.flatnonzero(self._rows.any(axis=1))
+        if opaque_rows.size == 0:
+            self.box = (0, 0, 0, 0)
+        else:
+            opaque_columns = np.flatnonzero(self._columns.any(axis=0))
+            self.box = (int(opaque_columns[0]), int(opaque_rows[0]), int(opaque_columns[-1]) + 1, int(opaque_rows[-1]) + 1)
+        return self.box
+
+def display_size(width, height, view_width, view_height):
+    """
+    Returns the (width, height) a frame is shown at: the largest size with its aspect ratio that fits the view.
+    """
+    shown_height = view_width * height // width
+    if shown_height <= view_height:
+        return view_width, shown_height
+    return view_height * width // height, view_height
+
+def visible_region(width, height, view_width, view_height):
+    """
+    Works out which part of a frame the overlay shows, and at what size.
+
+    The overlay scales the frame to cover the view while keeping its aspect ratio, and shows the
+    middle of it in an area of `display_size`; everything around that is cropped.
+
+    Args:
+        width (int): The frame width.
+        height (int): The frame height.
+        view_width (int): The overlay width.
+        view_height (int): The overlay height.
+
+    Returns:
+        tuple: The (x, y, width, height) rectangle of the frame that is shown and the (width, height)
+        it is shown at.
+    """
+    shown_width, shown_height = display_size(width, height, view_width, view_height)
+    scale = max(view_width / width, view_height / height)
+    source_width = min(width, max(1, round(shown_width / scale)))
+    source_height = min(height, max(1, round(shown_height / scale)))
+    source = ((width - source_width) // 2, (height - source_height) // 2, source_width, source_height)
+    return source, (shown_width, shown_height)
+
+class ViewScaler:
+    """
+    Crops frames to the part the overlay shows and downscales them to the size it is shown at.
+
+    Downscaling takes two steps into preallocated buffers: INTER_AREA by the largest whole factor,
+    which OpenCV runs as a fast box filter, then INTER_LINEAR for the remaining factor below 2.
+    A single INTER_AREA by a fractional factor takes OpenCV's generic path, which costs about as
+    much as keying the full frame. Frames shown at their size or larger are only cropped, the
+    crop is a view without a copy. The buffers come from the BUFFER_POOL.
+    """
+    def __init__(self):
+        self._reduced = None
+        self._scaled = None
+
+    def _buffer(self, buffer, height, width, data):
+        shape = (height, width) + data.shape[2:]
+        if buffer is None or buffer.shape != shape or buffer.dtype != data.dtype:
+            if buffer is not None:
+                BUFFER_POOL.release(buffer)
+            buffer = BUFFER_POOL.acquire(shape, data.dtype)
+        return buffer
+
+    def release(self):
+        """
+        Gives the buffers back to the pool, scaled frames returned before are no longer valid.
+        """
+        for buffer in (self._reduced, self._scaled):
+            if buffer is not None:
+                BUFFER_POOL.release(buffer)
+        self._reduced = self._scaled = None
+
+    def scale(self, data, view_width, view_height):
+        """
+        Returns the visible pixels of a frame at the size they are shown at.
+
+        Args:
+            data (ndarray): The (height, width, channels) frame.
+            view_width (int): The overlay width.
+            view_height (int): The overlay height.
+
+        Returns:
+            ndarray: The visible pixels, a view of `data` or a buffer owned by the scaler.
+        """
+        height, width = data.shape[:2]
+        (x, y, source_width, source_height), (shown_width, shown_height) = visible_region(width, height, view_width, view_height)
+        cropped = data[y:y + source_height, x:x + source_width]
+        if shown_width >= source_width:
+            return cropped
+
+        factor = int(min(source_width / shown_width, source_height / shown_height))
+        if factor >= 2:
+            reduced_width, reduced_height = source_width // factor, source_height // factor
+            self._reduced = self._buffer(self._reduced, reduced_height, reduced_width, data)
+            cv2.resize(cropped[:reduced_height * factor, :reduced_width * factor], (reduced_width, reduced_height),
+                       dst=self._reduced, interpolation=cv2.INTER_AREA)
+            cropped = self._reduced
+            if (reduced_width, reduced_height) == (shown_width, shown_height):
+                return cropped
+
+        self._scaled = self._buffer(self._scaled, shown_height, shown_width, data)
+        cv2.resize(cropped, (shown_width, shown_height), dst=self._scaled, interpolation=cv2.INTER_LINEAR)
+        return self._scaled
+
+def write_keyed_pixels(data, alpha, output, scratch):
+    """
+    Writes premultiplied BGRA pixels with the given alpha into the output buffer.
+
+    The alpha is either 0 or 255, so premultiplying is a bitwise AND of each pixel with
+    the alpha replicated into all four bytes.
+
+    Args:
+        data (ndarray): The (height, width, 4) source pixels, the fourth byte is ignored.
+        alpha (ndarray): The (height, width) alpha values, 0 or 255.
+        output (ndarray): The (height, width, 4) destination buffer.
+        scratch (ndarray): A (height, width, 4) uint8 buffer that is overwritten.
+    """
+    cv2.merge((alpha, alpha, alpha, alpha), dst=scratch)
+    output32 = output.view(np.uint32)[..., 0]
+    np.bitwise_or(data.view(np.uint32)[..., 0], OPAQUE_ALPHA, out=output32)
+    np.bitwise_and(output32, scratch.view(np.uint32)[..., 0], out=output32)
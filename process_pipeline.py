@@ -0,0 +1,416 @@
+import multiprocessing
+import os
+import queue
+import time
+import cv2
+import numpy as np
+from multiprocessing import shared_memory
+from pipeline import visible_region
+from metrics import METRICS
+
+# Slot states of the SharedFrameRing
+FREE, WRITING, CAPTURED, KEYING, KEYED, READING = range(6)
+
+class SharedFrameRing:
+    """
+    A ring of fixed-size BGRA frame slots in a `multiprocessing.shared_memory` block.
+
+    The block starts with a header holding the last sequence number handed out and the number of
+    keyed frames taken back for new captures, then one metadata record per slot (state, owning
+    process, sequence number, frame size, capture time and the bounding box of the opaque pixels
+    once keyed), followed by the slots themselves. Sequence numbers are handed out by the ring, so
+    they keep increasing across restarts of the capture process. Processes only exchange slot
+    indices; the pixels never leave the shared block. State changes go through a shared lock.
+
+    Attributes:
+        slots (int): Number of frame slots.
+        max_width (int): The widest frame a slot can hold.
+        max_height (int): The tallest frame a slot can hold.
+        header (ndarray): The header record, living in shared memory.
+        meta (ndarray): The per-slot metadata records, living in shared memory.
+    """
+    HEADER_DTYPE = np.dtype([('seq', np.int64), ('stolen', np.int64)])
+    HEADER_SIZE = 64
+
+    META_DTYPE = np.dtype([
+        ('state', np.int32), ('owner', np.int32), ('seq', np.int64),
+        ('width', np.int32), ('height', np.int32), ('timestamp', np.float64),
+        ('opaque', np.int32, (4,)),
+    ])
+
+    def __init__(self, slots, max_width, max_height, lock, name=None):
+        """
+        Creates the shared block, or attaches to an existing one when `name` is given.
+
+        Args:
+            slots (int): Number of frame slots.
+            max_width (int): The widest frame a slot can hold.
+            max_height (int): The tallest frame a slot can hold.
+            lock (multiprocessing.Lock): The lock guarding slot state changes, shared by all processes.
+            name (str, optional): The name of an existing block to attach to.
+        """
+        self.slots = slots
+        self.max_width = max_width
+        self.max_height = max_height
+        self.lock = lock
+        self.slot_bytes = max_width * max_height * 4
+        self._data_offset = self.HEADER_SIZE + -(-slots * self.META_DTYPE.itemsize // 64) * 64
+        size = self._data_offset + slots * self.slot_bytes
+
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.header = np.ndarray((), dtype=self.HEADER_DTYPE, buffer=self.shm.buf)
+        self.meta = np.ndarray((slots,), dtype=self.META_DTYPE, buffer=self.shm.buf, offset=self.HEADER_SIZE)
+        if self.owner:
+            self.header[()] = 0
+            self.meta[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def fits(self, width, height):
+        return width <= self.max_width and height <= self.max_height
+
+    def frame(self, slot, width=None, height=None):
+        """
+        Returns a (height, width, 4) view of a slot, by default sized as recorded in its metadata.
+        """
+        width = int(self.meta[slot]['width']) if width is None else width
+        height = int(self.meta[slot]['height']) if height is None else height
+        offset = self._data_offset + slot * self.slot_bytes
+        return np.ndarray((height, width, 4), dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+
+    def acquire(self, owner):
+        """
+        Takes a free slot for writing and gives it the next sequence number. When none is free, the
+        oldest keyed frame that was not picked up yet is dropped in favour of the new one and counted
+        in the `stolen` header field; its index may still be waiting in the done queue.
+
+        Returns:
+            int or None: The slot index, or None if every slot is busy.
+        """
+        with self.lock:
+            states = self.meta['state']
+            free = np.flatnonzero(states == FREE)
+            if len(free):
+                slot = int(free[0])
+            else:
+                keyed = np.flatnonzero(states == KEYED)
+                if not len(keyed):
+                    return None
+                slot = int(keyed[np.argmin(self.meta['seq'][keyed])])
+                self.header['stolen'] += 1
+            self.header['seq'] += 1
+            self.meta[slot]['seq'] = self.header['seq']
+            self.meta[slot]['state'] = WRITING
+            self.meta[slot]['owner'] = owner
+            self.meta[slot]['timestamp'] = time.monotonic()
+            return slot
+
+    def transition(self, slot, expected, state, owner=0):
+        """
+        Moves a slot from the `expected` state to `state`.
+
+        Returns:
+            bool: False if the slot was not in the expected state (e.g. it was reclaimed meanwhile).
+        """
+        with self.lock:
+            if self.meta[slot]['state'] != expected:
+                return False
+            self.meta[slot]['state'] = state
+            self.meta[slot]['owner'] = owner
+            return True
+
+    def reclaim(self, dead_owner=None, older_than=None):
+        """
+        Frees the slots held by a dead process, and slots stuck in a non-free state for too long.
+
+        Args:
+            dead_owner (int, optional): The pid of a process that exited.
+            older_than (float, optional): Free slots captured before this monotonic time, unless being read.
+
+        Returns:
+            int: The number of slots freed.
+        """
+        with self.lock:
+            busy = self.meta['state'] != FREE
+            stale = np.zeros(self.slots, dtype=bool)
+            if dead_owner is not None:
+                stale |= busy & (self.meta['owner'] == dead_owner)
+            if older_than is not None:
+                stale |= busy & (self.meta['state'] != READING) & (self.meta['timestamp'] < older_than)
+            self.meta['state'][stale] = FREE
+            return int(np.count_nonzero(stale))
+
+    def close(self):
+        """
+        Detaches from the shared block and, in the creating process, destroys it.
+        """
+        self.meta = None
+        self.header = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def _drain(config_queue, config):
+    """Returns the newest config waiting in the queue, or `config` if there is none."""
+    try:
+        while True:
+            config = config_queue.get_nowait()
+    except queue.Empty:
+        return config
+
+def _capture_main(ring_args, lock, work_queue, config_queue, stop_event, replay=None):
+    """
+    Entry point of the capture process: grabs frames into free ring slots and queues them for keying.
+    """
+    from config_loader import CompiledConfig
+    from utils import capture_target_frame, close_frame_sources, replay_recording
+    if replay is not None:
+        replay_recording(*replay)
+    ring = SharedFrameRing(ring_args[0], ring_args[1], ring_args[2], lock, name=ring_args[3])
+    config = config_queue.get()
+    settings = CompiledConfig(config)
+    pid = os.getpid()
+    oversized = False
+    try:
+        while not stop_event.is_set():
+            started = time.monotonic()
+            latest = _drain(config_queue, config)
+            if latest is not config:
+                config, settings = latest, CompiledConfig(latest)
+            frame = capture_target_frame(settings.title, settings.backend, settings.region)
+            if frame is not None:
+                if not ring.fits(frame.width, frame.height):
+                    if not oversized:
+                        print(f"Frame of {frame.width}x{frame.height} exceeds the shared ring slots, skipping it.")
+                    oversized = True
+                else:
+                    oversized = False
+                    slot = ring.acquire(pid)
+                    if slot is not None:
+                        np.copyto(ring.frame(slot, frame.width, frame.height), frame.data)
+                        ring.meta[slot]['width'] = frame.width
+                        ring.meta[slot]['height'] = frame.height
+                        ring.meta[slot]['timestamp'] = started
+                        ring.transition(slot, WRITING, CAPTURED)
+                        work_queue.put(slot)
+            # Sleep rather than wait on the event: a process killed while waiting on a multiprocessing
+            # Event never acknowledges its wake-up, and setting the event would hang
+            time.sleep(max(0.0, settings.update_interval / 1000 - (time.monotonic() - started)))
+    finally:
+        close_frame_sources()
+        ring.close()
+
+def _key_main(ring_args, lock, work_queue, done_queue, config_queue, stop_event):
+    """
+    Entry point of a keying process: keys captured slots in place into premultiplied BGRA.
+    """
+    from chroma_key import create_keyer
+    from pipeline import OpaqueBounds, write_keyed_pixels
+    from config_loader import CompiledConfig
+
+    # Parallelism comes from the processes, keep OpenCV from oversubscribing the cores
+    cv2.setNumThreads(1)
+    ring = SharedFrameRing(ring_args[0], ring_args[1], ring_args[2], lock, name=ring_args[3])
+    config = config_queue.get()
+    settings = CompiledConfig(config)
+    keyer = create_keyer(*settings.keyer[:2])
+    pid = os.getpid()
+    bounds = OpaqueBounds()
+    mask = scratch = None
+    try:
+        while not stop_event.is_set():
+            try:
+                slot = work_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            latest = _drain(config_queue, config)
+            if latest is not config:
+                previous, config, settings = settings, latest, CompiledConfig(latest)
+                if settings.keyer != previous.keyer:
+                    keyer = create_keyer(*settings.keyer[:2])
+
+            if not ring.transition(slot, CAPTURED, KEYING, pid):
+                continue
+            data = ring.frame(slot)
+            if mask is None or mask.shape != data.shape[:2]:
+                mask = np.empty(data.shape[:2], dtype=np.uint8)
+                scratch = np.empty(data.shape, dtype=np.uint8)
+            keyer.alpha(data, settings.hsv_lower, settings.hsv_upper, out=mask)
+            write_keyed_pixels(data, mask, data, scratch)
+            ring.meta[slot]['opaque'] = bounds.update(mask)
+            del data
+            if ring.transition(slot, KEYING, KEYED):
+                done_queue.put(slot)
+    finally:
+        ring.close()
+
+class ProcessPipeline:
+    """
+    Runs capture and keying in separate processes that share frames through a SharedFrameRing.
+
+    One process captures into free slots, `workers` processes key the captured slots in place,
+    and the Qt process picks up the newest keyed frame, scales it and paints it. Only slot
+    indices and config dicts cross process boundaries. Processes that die are restarted and
+    the slots they held are reclaimed.
+
+    Attributes:
+        workers (int): Number of keying processes.
+        dropped (int): Keyed frames that were superseded by a newer one before being displayed.
+        restarts (int): Number of processes restarted after they exited unexpectedly.
+    """
+    STALE_AFTER = 2.0
+
+    def __init__(self, config, workers, max_width=3840, max_height=2160, replay=None):
+        """
+        Initializes the pipeline, processes are started by `start`.
+
+        Args:
+            config (dict): The application configuration.
+            workers (int): Number of keying processes.
+            max_width (int): The widest frame the ring slots can hold.
+            max_height (int): The tallest frame the ring slots can hold.
+            replay (tuple, optional): The (path, speed) of a recording to replay instead of capturing,
+                see utils.replay_recording.
+        """
+        self.config = config
+        self.replay = replay
+        self.workers = workers
+        self.max_width = max_width
+        self.max_height = max_height
+        self.dropped = 0
+        self.restarts = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = {}
+        self._config_queues = {}
+        self._last_seq = 0
+        self._stolen = 0
+        self.ring = None
+
+    def start(self):
+        """
+        Creates the shared ring and starts the capture process and the keying processes.
+        """
+        self._lock = self._context.Lock()
+        self.ring = SharedFrameRing(self.workers + 3, self.max_width, self.max_height, self._lock)
+        self._ring_args = (self.ring.slots, self.max_width, self.max_height, self.ring.name)
+        self._work_queue = self._context.Queue()
+        self._done_queue = self._context.Queue()
+        self._stop_event = self._context.Event()
+        self._start_process('capture')
+        for i in range(self.workers):
+            self._start_process(f'key-{i}')
+
+    def _start_process(self, role):
+        config_queue = self._context.Queue()
+        config_queue.put(self.config)
+        if role == 'capture':
+            target, args = _capture_main, (self._ring_args, self._lock, self._work_queue, config_queue,
+                                           self._stop_event, self.replay)
+        else:
+            target, args = _key_main, (self._ring_args, self._lock, self._work_queue, self._done_queue,
+                                       config_queue, self._stop_event)
+        process = self._context.Process(target=target, args=args, name=f'window-mascot-{role}', daemon=True)
+        process.start()
+        self._processes[role] = process
+        self._config_queues[role] = config_queue
+
+    def update_config(self, config):
+        """
+        Sends a new configuration to every process.
+        """
+        self.config = config
+        for config_queue in self._config_queues.values():
+            config_queue.put(config)
+
+    def check_processes(self):
+        """
+        Restarts processes that exited and reclaims the slots they, or lost queue entries, held.
+        """
+        for role, process in list(self._processes.items()):
+            if not process.is_alive():
+                print(f"Pipeline process {role} exited with code {process.exitcode}, restarting it.")
+                self.ring.reclaim(dead_owner=process.pid)
+                self.restarts += 1
+                self._start_process(role)
+        self.ring.reclaim(older_than=time.monotonic() - self.STALE_AFTER)
+
+    def latest(self, target_size):
+        """
+        Takes the newest keyed frame, if any, and crops and scales it for display.
+
+        Args:
+            target_size (QSize): The size of the overlay.
+
+        Returns:
+            RenderedFrame or None: The frame, or None if no newer frame was keyed since the last call.
+        """
+        # Only the app process displays frames, the pipeline processes do not load Qt
+        from PyQt5.QtCore import QSize
+        from capture_worker import RenderedFrame, display_opaque
+        slots = []
+        try:
+            while True:
+                slots.append(self._done_queue.get_nowait())
+        except queue.Empty:
+            pass
+        # Keyed frames the capture process took back for new captures were dropped unseen
+        stolen = int(self.ring.header['stolen'])
+        if stolen != self._stolen:
+            self.dropped += stolen - self._stolen
+            METRICS.count('frames_dropped', stolen - self._stolen)
+            self._stolen = stolen
+        if not slots:
+            return None
+
+        # A slot taken back and keyed again can be queued twice, its state tells whether it is current
+        slots = list(dict.fromkeys(slots))
+        # Latest frame wins, frames keyed out of order or superseded are released unseen
+        newest = max(slots, key=lambda slot: self.ring.meta[slot]['seq'])
+        for slot in slots:
+            if slot != newest or self.ring.meta[slot]['seq'] <= self._last_seq:
+                if self.ring.transition(slot, KEYED, FREE):
+                    self.dropped += 1
+                    METRICS.count('frames_dropped')
+        if not self.ring.transition(newest, KEYED, READING):
+            return None
+
+        started = time.perf_counter()
+        self._last_seq = int(self.ring.meta[newest]['seq'])
+        captured_at = float(self.ring.meta[newest]['timestamp'])
+        data = self.ring.frame(newest)
+        height, width, channel = data.shape
+        # The keying processes do not know the overlay size, so the frame is cropped here
+        (x, y, source_width, source_height), shown = visible_region(width, height, target_size.width(),
+                                                                    target_size.height())
+        # The opaque box of the frame, clipped to the visible part and relative to it
+        x0, y0, x1, y1 = (int(bound) for bound in self.ring.meta[newest]['opaque'])
+        opaque = (min(max(x0 - x, 0), source_width), min(max(y0 - y, 0), source_height),
+                  min(max(x1 - x, 0), source_width), min(max(y1 - y, 0), source_height))
+        image, buffer, box = display_opaque(data[y:y + source_height, x:x + source_width], opaque, *shown)
+        del data
+        self.ring.transition(newest, READING, FREE)
+        METRICS.record('upload', time.perf_counter() - started)
+        return RenderedFrame(image, captured_at, buffer=buffer, box=box, size=QSize(*shown))
+
+    def stop(self, timeout=2.0):
+        """
+        Stops every process, terminating those that do not exit in time, and destroys the ring.
+        """
+        if self.ring is None:
+            return
+        self._stop_event.set()
+        for process in self._processes.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join(timeout)
+        self._processes.clear()
+        for q in [self._work_queue, self._done_queue, *self._config_queues.values()]:
+            q.cancel_join_thread()
+            q.close()
+        self._config_queues.clear()
+        self.ring.close()
+        self.ring = None
@@ -1,24 +1,218 @@
-from PyQt5.QtCore import QFileSystemWatcher
-from PyQt5.QtWidgets import QApplication
+import time
+
+# Taken before any other import, the startup profile counts from here
+STARTED = time.perf_counter()
+
+import argparse
 import sys
-from transparent_window import TransparentWindow
-from config_loader import load_config
+from startup import HEAVY_MODULES, StartupProfile
+
+def parse_arguments():
+    """
+    Parses the command line options of run.py, the remaining arguments are left to Qt.
+    """
+    parser = argparse.ArgumentParser(description="Show a window as a transparent, chroma keyed overlay.")
+    parser.add_argument('--record', metavar='PATH', help="Record the raw captured frames to PATH.")
+    parser.add_argument('--replay', metavar='PATH', help="Replay the frames recorded to PATH instead of capturing.")
+    parser.add_argument('--replay-speed', type=float, metavar='SPEED',
+                        help="Replay rate relative to the recording, 0 to serve a new frame on every capture.")
+    parser.add_argument('--startup-profile', nargs='?', const='', metavar='PATH',
+                        help="Print import times and the time to the first frame, and store them as JSON in PATH if given.")
+    parser.add_argument('--headless', action='store_true',
+                        help="Show no overlay, stream the keyed frames of the first window to the --sink outputs instead.")
+    parser.add_argument('--sink', action='append', default=[], metavar='SINK',
+                        help="Where --headless streams frames to: shm:NAME, pipe:PATH, file:PATH or stdout. Repeat for several consumers.")
+    parser.add_argument('--backpressure', choices=('drop', 'block'), default='drop',
+                        help="When a consumer falls behind, drop its oldest frame or block capturing (default: drop).")
+    parser.add_argument('--sink-codec', choices=('raw', 'sparse'), default='raw',
+                        help="Write raw pixels to pipe, file and stdout sinks, or frames encoded by frame_codec (default: raw).")
+    parser.add_argument('--stats-interval', type=float, default=5.0, metavar='SECONDS',
+                        help="Seconds between the throughput reports of --headless, 0 for none.")
+    return parser.parse_known_args()
+
+def setup_recording(args, recording_settings):
+    """
+    Replays or records the captured frames, the command line takes precedence over the configuration.
+
+    Returns:
+        tuple: The (path, speed) of the replayed recording or None, and the path to record to or ''.
+    """
+    from utils import replay_recording
+    replay = None
+    replay_path = args.replay or recording_settings['replay_path']
+    if replay_path:
+        speed = recording_settings['replay_speed'] if args.replay_speed is None else args.replay_speed
+        replay = (replay_path, speed)
+        replay_recording(*replay)
+        print(f"Replaying {replay_path} at {speed}x" if speed > 0 else f"Replaying {replay_path} frame by frame")
+    return replay, args.record or recording_settings['record_path']
+
+def run_headless(args):
+    """
+    Streams the keyed frames of the first configured window to the sinks given on the command line,
+    without creating a QApplication, until interrupted or every sink closed.
+    """
+    if not args.sink:
+        sys.exit("--headless needs at least one --sink: shm:NAME, pipe:PATH, file:PATH or stdout.")
+    stdout = None
+    if 'stdout' in args.sink:
+        # Frames own the standard output, text output goes to stderr
+        stdout = sys.stdout.buffer
+        sys.stdout = sys.stderr
+
+    import signal
+    from config_loader import load_config, overlay_configs
+    from buffer_pool import BUFFER_POOL
+    from frame_sink import create_sink
+    from headless import HeadlessEngine
+    from utils import close_frame_sources, start_recording, stop_recording
+    from metrics import METRICS
+
+    config = load_config('config.yaml', None)
+    configs = overlay_configs(config)
+    if len(configs) > 1:
+        print("Headless mode streams the first window of window_settings only.")
+    BUFFER_POOL.budget = config['pipeline_settings']['memory_budget_mb'] << 20
+    _, record_path = setup_recording(args, config['recording_settings'])
+    if record_path:
+        start_recording(record_path)
+
+    try:
+        sinks = [create_sink(spec, args.backpressure, stdout, args.sink_codec) for spec in args.sink]
+    except (ValueError, OSError) as e:
+        sys.exit(f"Unable to open sink: {e}")
+    engine = HeadlessEngine(configs[0], sinks, args.stats_interval)
+    # Stop on SIGTERM as on Ctrl+C, which also interrupts a sink blocked on its consumer
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    metrics_server = None
+    metrics_port = config['metrics_settings']['endpoint_port']
+    if metrics_port:
+        from metrics import MetricsServer
+        metrics_server = MetricsServer(METRICS, metrics_port)
+        try:
+            metrics_server.start()
+        except OSError as e:
+            print(f"Unable to serve metrics on port {metrics_port}: {e}")
+            metrics_server = None
+
+    print(f"Streaming {configs[0]['window_settings']['title']} to {', '.join(sink.name for sink in sinks)}")
+    try:
+        engine.run()
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
+        close_frame_sources()
+        stop_recording()
 
 def main():
-    app = QApplication(sys.argv)
-    config = load_config('config.yaml', app)
-    transp_window = TransparentWindow(app, config)
-
-    def config_changed(path):
-        print(f"Configuration changed: {path}")
-        new_config = load_config('config.yaml', app)
-        transp_window.updateConfig(new_config)
-    
-    # Setup filesystem watcher
-    config_watcher = QFileSystemWatcher(['config.yaml'])
-    config_watcher.fileChanged.connect(config_changed)
+    args, qt_arguments = parse_arguments()
+    if args.headless:
+        run_headless(args)
+        return
+
+    # Modules are imported here rather than at the top, so the processes of the process pipeline,
+    # which import this file, do not load them, and the startup profile can time them
+    profile = StartupProfile(STARTED)
+    for name in HEAVY_MODULES:
+        profile.import_module(name)
+    with profile.phase('import application'):
+        from PyQt5.QtWidgets import QApplication
+        from transparent_window import TransparentWindow
+        from config_store import ConfigStore
+        from config_loader import overlay_configs
+        from capture_worker import CaptureGroup
+        from buffer_pool import BUFFER_POOL
+        from utils import close_frame_sources, start_recording, stop_recording
+        from metrics import METRICS
+
+    with profile.phase('create QApplication'):
+        app = QApplication(sys.argv[:1] + qt_arguments)
+    with profile.phase('load configuration'):
+        config_store = ConfigStore('config.yaml', app)
+    config = config_store.config
+    configs = overlay_configs(config)
+    BUFFER_POOL.budget = config['pipeline_settings']['memory_budget_mb'] << 20
+
+    replay, record_path = setup_recording(args, config['recording_settings'])
+
+    # Capture and key in separate processes if configured
+    process_pipeline = None
+    if config['pipeline_settings']['processes'] > 0:
+        if len(configs) > 1:
+            print("The process pipeline supports a single overlay, capturing in this process instead.")
+        else:
+            from process_pipeline import ProcessPipeline
+            process_pipeline = ProcessPipeline(config, config['pipeline_settings']['processes'], replay=replay)
+            process_pipeline.start()
+
+    if record_path:
+        if process_pipeline is not None:
+            print("Frames captured by the process pipeline cannot be recorded, set processes to 0 to record.")
+        else:
+            start_recording(record_path)
+
+    # Several overlays share one capture thread and worker pool
+    capture_group = CaptureGroup() if len(configs) > 1 else None
+    windows = []
+    with profile.phase('create overlays'):
+        for index, overlay_config in enumerate(configs):
+            overlay = index if capture_group is not None else None
+            windows.append(TransparentWindow(app, overlay_config, process_pipeline, config_store, capture_group, overlay))
+
+    if args.startup_profile is not None:
+        def first_frame_shown():
+            if profile.first_frame is not None:
+                return
+            profile.frame_shown()
+            print(profile.report())
+            if args.startup_profile:
+                profile.save(args.startup_profile)
+                print(f"Startup profile saved to {args.startup_profile}")
+
+        for window in windows:
+            window.firstFrameShown.connect(first_frame_shown)
+
+    def config_changed(new_config):
+        new_configs = overlay_configs(new_config)
+        BUFFER_POOL.budget = new_config['pipeline_settings']['memory_budget_mb'] << 20
+        if len(new_configs) != len(windows):
+            print("The number of overlays changed, restart the app to add or remove overlays.")
+        for window, overlay_config in zip(windows, new_configs):
+            window.updateConfig(overlay_config)
+        if process_pipeline is not None:
+            process_pipeline.update_config(new_configs[0])
+
+    # Apply external edits of the configuration file, and changes saved from the editor
+    config_store.configChanged.connect(config_changed)
+
+    # Serve the pipeline metrics on localhost if configured
+    metrics_port = config['metrics_settings']['endpoint_port']
+    if metrics_port:
+        from metrics import MetricsServer
+        metrics_server = MetricsServer(METRICS, metrics_port)
+        try:
+            metrics_server.start()
+            app.aboutToQuit.connect(metrics_server.stop)
+        except OSError as e:
+            print(f"Unable to serve metrics on port {metrics_port}: {e}")
+
+    if capture_group is not None:
+        capture_group.start()
+        app.aboutToQuit.connect(capture_group.stop)
+
+    # Write pending configuration changes and release the capture backends on exit
+    app.aboutToQuit.connect(config_store.flush)
+    app.aboutToQuit.connect(close_frame_sources)
+    app.aboutToQuit.connect(stop_recording)
+    if process_pipeline is not None:
+        app.aboutToQuit.connect(process_pipeline.stop)
 
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
+    if getattr(sys, 'frozen', False):
+        # Lets a frozen executable start the processes of the process pipeline
+        import multiprocessing
+        multiprocessing.freeze_support()
     main()
\ No newline at end of file
@@ -0,0 +1,87 @@
+import importlib
+import json
+import platform
+import time
+from contextlib import contextmanager
+
+# Imported one by one at startup, before the application modules, so the profile shows what each costs
+HEAVY_MODULES = ('PyQt5.QtWidgets', 'numpy', 'cv2', 'yaml')
+
+class StartupProfile:
+    """
+    Times the phases of starting the app, from run.py starting to the first frame on screen.
+
+    Phases are timed in order with `phase`; everything between them (e.g. module level code of
+    run.py) is only part of the time to the first frame. The interpreter's own startup, before
+    run.py runs, is not included.
+
+    Attributes:
+        started (float): time.perf_counter() when run.py started.
+        phases (list): The (name, seconds) of every timed phase, in order.
+        first_frame (float): Seconds from the start to the first frame displayed, or None.
+    """
+    def __init__(self, started=None):
+        self.started = time.perf_counter() if started is None else started
+        self.phases = []
+        self.first_frame = None
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the statements of a `with` block as the phase `name`.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def import_module(self, name):
+        """
+        Imports a module as the phase 'import <name>'. Modules imported before cost nothing.
+
+        Returns:
+            module: The imported module.
+        """
+        with self.phase(f"import {name}"):
+            return importlib.import_module(name)
+
+    def frame_shown(self):
+        """
+        Records the time of the first frame, later calls are ignored.
+        """
+        if self.first_frame is None:
+            self.first_frame = time.perf_counter() - self.started
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: The phases and the time to the first frame in milliseconds, with the Python version
+            and platform, ready to be stored as JSON and compared across versions.
+        """
+        return {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'phases_ms': {name: round(seconds * 1000, 1) for name, seconds in self.phases},
+            'first_frame_ms': None if self.first_frame is None else round(self.first_frame * 1000, 1),
+        }
+
+    def report(self):
+        """
+        Returns:
+            str: A table of the phases and the time to the first frame.
+        """
+        lines = ["Startup profile", f"{'phase':<32} {'ms':>8}"]
+        lines += [f"{name:<32} {seconds * 1000:>8.1f}" for name, seconds in self.phases]
+        if self.first_frame is None:
+            lines.append("No frame was shown.")
+        else:
+            lines.append(f"{'time to first frame':<32} {self.first_frame * 1000:>8.1f}")
+        return '\n'.join(lines)
+
+    def save(self, path):
+        """
+        Writes the profile to a JSON file.
+        """
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
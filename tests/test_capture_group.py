@@ -0,0 +1,68 @@
+import os
+from types import SimpleNamespace
+import numpy as np
+from PyQt5.QtCore import QSize
+from benchmark import SYNTHETIC_BACKEND, synthetic_frame, use_synthetic_frames
+from capture_worker import CaptureGroup, release_frame
+from change_detector import ChangeDetector
+from chroma_key import create_keyer
+from config_loader import CompiledConfig, load_config, overlay_configs
+from frame_scheduler import create_frame_scheduler
+from pipeline import FramePipeline
+from utils import close_frame_sources
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.yaml')
+VIEW_SIZE = (320, 180)
+
+def create_overlay():
+    config = overlay_configs(load_config(CONFIG_PATH, None))[0]
+    config['window_settings']['capture_backend'] = SYNTHETIC_BACKEND
+    config['window_settings']['capture_region'] = 'auto'
+    config['window_settings']['size'] = {'width': VIEW_SIZE[0], 'height': VIEW_SIZE[1]}
+    config['pipeline_settings'].update(mode='fused', change_detection=True, processes=0)
+    settings = CompiledConfig(config)
+    pipeline = FramePipeline(create_keyer(*settings.keyer[:2]),
+                             change_detector=ChangeDetector(settings.change_detection[1]))
+    return SimpleNamespace(settings=settings, pipeline=pipeline, scheduler=create_frame_scheduler(settings),
+                           size=lambda: QSize(*VIEW_SIZE))
+
+def shown_pixels(frame):
+    """Returns the pixels of a rendered frame's image."""
+    image = frame.image
+    bits = image.constBits()
+    bits.setsize(image.byteCount())
+    return np.frombuffer(bits, np.uint8).reshape(image.height(), image.bytesPerLine())[:, :image.width() * 4].copy()
+
+def test_overlay_given_a_shared_frame_follows_its_own_frames():
+    idle = synthetic_frame(640, 360)
+    blink = idle.copy()
+    blink[100:200, 200:300] = (0, 0, 255, 255)
+    # Tick 0: B alone (idle), tick 1: A and B (blink, keyed by A), tick 2: B alone (idle)
+    use_synthetic_frames([idle, blink, idle])
+    try:
+        group = CaptureGroup()
+        overlays = [create_overlay(), create_overlay()]
+        a, b = (group.add(overlay) for overlay in overlays)
+        shown = {}
+
+        def tick(due):
+            for index, member in enumerate(group._members):
+                member.next_at = 0.0 if index in due else float('inf')
+            group.tick()
+            for index in due:
+                frame = group.take(index)
+                if frame is not None:
+                    release_frame(shown.get(index))
+                    shown[index] = frame
+
+        tick([b])
+        idle_pixels = shown_pixels(shown[b])
+        tick([a, b])
+        assert shown[b].damage is None
+        assert not np.array_equal(shown_pixels(shown[b]), idle_pixels)
+        tick([b])
+        assert np.array_equal(shown_pixels(shown[b]), idle_pixels)
+        for frame in shown.values():
+            release_frame(frame)
+    finally:
+        close_frame_sources()
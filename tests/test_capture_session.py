@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from capture_image import CaptureSession, live_gdi_handles
+from fake_win32 import FakeWin32
+
+TITLE = 'VTube Studio'
+
+class FakeClock:
+    """A monotonic clock that only advances when told to."""
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def api():
+    return FakeWin32()
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+def create_session(api, clock, **kwargs):
+    return CaptureSession(TITLE, api.win32gui, api.win32ui, api.user32, clock=clock, gdi32=api.gdi32, **kwargs)
+
+def test_rebuilds_on_resize(api, clock):
+    window = api.add_window(TITLE, 640, 480)
+    session = create_session(api, clock)
+    bits, width, height = session.capture()
+    assert (width, height) == (640, 480)
+    session.capture()
+    assert session.rebuilds == 1
+
+    window.width, window.height = 800, 600
+    bits, width, height = session.capture()
+    assert (width, height) == (800, 600)
+    assert bits.shape == (600, 800, 4)
+    assert session.rebuilds == 2
+    assert session.lookups == 1
+    session.close()
+    assert api.live_objects == 0
+
+def test_rebuilds_on_invalid_handle(api, clock):
+    window = api.add_window(TITLE, 320, 240)
+    session = create_session(api, clock)
+    assert session.capture() is not None
+    first_hwnd = session.hwnd
+
+    # The window is recreated with another handle, e.g. after the application restarted
+    api.destroy_window(window)
+    api.add_window(TITLE, 320, 240, color=(255, 0, 0, 255))
+    bits, width, height = session.capture()
+    assert session.hwnd != first_hwnd
+    assert session.lookups == 2
+    assert session.rebuilds == 2
+    assert tuple(np.asarray(bits)[0, 0]) == (255, 0, 0, 255)
+    session.close()
+    assert api.live_objects == 0
+
+@pytest.mark.parametrize('minimized', [False, True])
+def test_backs_off_while_unavailable(api, clock, minimized):
+    window = api.add_window(TITLE, 320, 240)
+    if minimized:
+        window.minimized = True
+    else:
+        api.destroy_window(window)
+    session = create_session(api, clock)
+
+    delays = []
+    for _ in range(10):
+        assert session.capture() is None
+        delays.append(session.retry_delay)
+        due = clock.now + session.retry_delay
+        # Nothing is attempted before the retry is due
+        calls = dict(api.calls)
+        clock.now = due - session.retry_delay / 2
+        assert session.capture() is None
+        assert api.calls == calls
+        clock.now = due
+    assert delays == pytest.approx([0.1, 0.2, 0.4, 0.8, 1.6, 3.2, 5.0, 5.0, 5.0, 5.0])
+    assert session.unavailable_reason is not None
+
+    # Capturing resumes once the window is back, and the delay starts over
+    if minimized:
+        window.minimized = False
+    else:
+        api.add_window(TITLE, 320, 240)
+    assert session.capture() is not None
+    assert session.retry_delay == 0
+    assert session.unavailable_reason is None
+    session.close()
+
+def test_no_leaked_handles_after_many_grabs(api, clock):
+    window = api.add_window(TITLE, 640, 360)
+    session = create_session(api, clock)
+    live_before = live_gdi_handles()
+    for frame in range(600):
+        if frame % 100 == 50:
+            window.width, window.height = window.width + 16, window.height + 8
+        session.region = (10, 10, 200, 100) if frame % 3 == 0 else None
+        assert session.capture() is not None
+        assert session.handles <= 6
+    session.close()
+    assert session.handles == 0
+    assert session.leaked_handles == 0
+    assert api.live_objects == 0
+    assert api.bitmaps == {}
+    assert live_gdi_handles() == live_before
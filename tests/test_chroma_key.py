@@ -0,0 +1,58 @@
+import cv2
+import numpy as np
+import pytest
+from chroma_key import HSVKeyer, LUTKeyer
+from utils import apply_chroma_key
+
+# (lower, upper) HSV bounds, including the hue edges 0 and 179 and bounds that key nothing
+BOUNDS = [
+    ((50, 100, 100), (70, 255, 255)),
+    ((0, 0, 0), (179, 255, 255)),
+    ((0, 50, 50), (10, 255, 255)),
+    ((170, 50, 50), (179, 255, 255)),
+    ((0, 0, 0), (0, 255, 255)),
+    ((179, 0, 0), (179, 255, 255)),
+    ((35, 0, 200), (85, 40, 255)),
+    ((90, 0, 0), (80, 255, 255)),
+]
+
+def random_frame(seed, width=256, height=192):
+    """
+    Returns a BGR frame of random colors, with rows of pure red, green and gray around the hue
+    edges and the bounds of the saturation and value.
+    """
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    image[0] = (0, 0, 255)
+    image[1] = (0, 255, 0)
+    image[2] = (128, 128, 128)
+    image[3, :, 2] = 255
+    image[3, :, :2] = rng.integers(0, 3, size=(width, 2), dtype=np.uint8)
+    return image
+
+@pytest.fixture(scope='module')
+def lut_keyer():
+    # The table is rebuilt for every set of bounds, share the keyer to allocate it once
+    return LUTKeyer()
+
+@pytest.mark.parametrize('lower, upper', BOUNDS)
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_keyers_are_bit_identical(lut_keyer, seed, lower, upper):
+    hsv_lower, hsv_upper = np.array(lower, dtype=np.uint8), np.array(upper, dtype=np.uint8)
+    image = random_frame(seed)
+    bgra = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+
+    reference = apply_chroma_key(image.copy(), hsv_lower, hsv_upper)
+    hsv = HSVKeyer().alpha(bgra, hsv_lower, hsv_upper)
+    lut = lut_keyer.alpha(bgra, hsv_lower, hsv_upper)
+
+    assert np.array_equal(hsv, reference[:, :, 3])
+    assert np.array_equal(lut, reference[:, :, 3])
+    assert np.array_equal(apply_chroma_key(image.copy(), hsv_lower, hsv_upper, keyer=lut_keyer), reference)
+
+def test_lut_keyer_builds_the_table_once_per_bounds():
+    keyer = LUTKeyer()
+    image = cv2.cvtColor(random_frame(3), cv2.COLOR_BGR2BGRA)
+    for lower, upper in (BOUNDS[0], BOUNDS[0], BOUNDS[1], BOUNDS[1]):
+        keyer.alpha(image, np.array(lower, dtype=np.uint8), np.array(upper, dtype=np.uint8))
+    assert keyer.builds == 2
@@ -1,8 +1,16 @@
 from PyQt5.QtWidgets import QWidget, QLabel, QMessageBox
-from PyQt5.QtGui import QPixmap, QImage
-from PyQt5.QtCore import Qt, QTimer
-from utils import capture_and_process_target_window, updateConfigurationFile
-from config_editor import ConfigEditor
+from PyQt5.QtCore import Qt, QTimer, QSize, pyqtSignal
+import time
+from utils import updateConfigurationFile
+from pipeline import FramePipeline
+from chroma_key import close_keyer, configure_threads, create_keyer
+from change_detector import ChangeDetector
+from capture_worker import CaptureWorker, LatencyTracker, release_frame, render_frame
+from frame_scheduler import create_frame_scheduler
+from frame_view import FrameView
+from config_store import changed_sections
+from config_loader import CompiledConfig
+from metrics import METRICS
 
 class TransparentWindow(QWidget):
     """
@@ -10,42 +18,81 @@ class TransparentWindow(QWidget):
 
     Attributes:
         config (dict): Configuration settings for the window, including size, position, and update interval.
+        settings (CompiledConfig): The snapshot of `config` read by the frame loop, replaced as a whole
+            when the configuration changes.
+        shownFrame (RenderedFrame): The frame currently displayed, or None.
+        firstFrameShown (pyqtSignal): Emitted when the first frame is displayed.
     """
-    def __init__(self, app, config):
+    firstFrameShown = pyqtSignal()
+
+    def __init__(self, app, config, process_pipeline=None, config_store=None, capture_group=None, overlay=None):
         """
         Initialize the class with the given app and config.
         
         Parameters:
             app: The QApplication app instance
             config (dict): The configuration settings for the window.
+            process_pipeline (ProcessPipeline, optional): A started multi-process pipeline to display
+                frames from, instead of capturing in this process.
+            config_store (ConfigStore, optional): The store that persists and reloads the configuration.
+            capture_group (CaptureGroup, optional): The group that renders the frames of several overlays,
+                instead of a timer or worker thread of this window.
+            overlay (int, optional): The index of this overlay's entry when window_settings is a list.
         
         Returns:
             None
         """
         super().__init__()
         self.config = config
+        self.settings = CompiledConfig(config)
         self.app = app
+        configure_threads(*self.settings.keyer[2:])
+        self.pipeline = FramePipeline(create_keyer(*self.settings.keyer),
+                                      change_detector=self.createChangeDetector(*self.settings.change_detection))
+        self.latency = LatencyTracker()
+        self.shownFrame = None
+        self.scheduler = create_frame_scheduler(self.settings)
+        self.worker = None
+        self.processPipeline = process_pipeline
+        self.configStore = config_store
+        self.captureGroup = capture_group
+        self.groupIndex = None
+        self.overlay = overlay
         self.initUI()
         self.postInit(app)
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.updateImage)
-        self.timer.start(self.config['update_interval'])
+        if capture_group is not None:
+            self.groupIndex = capture_group.add(self)
+            capture_group.frameReady.connect(self.takeGroupFrame)
+        self.applyThreading()
+
+        # Let the scheduler know when the overlay is hidden or covered
+        self.visibilityTimer = QTimer(self)
+        self.visibilityTimer.timeout.connect(self.updateVisibility)
+        self.visibilityTimer.start(250)
 
     def initUI(self):
         """
         Initializes the user interface of the transparent window based on the provided configuration.
         """
-        self.label = QLabel(self)
+        self.view = FrameView(self)
         self.setAttribute(Qt.WA_TranslucentBackground)
-        self.label.setStyleSheet('background-color: transparent;')
+
+        # Metrics HUD, refreshed twice a second while shown
+        self.hud = QLabel(self)
+        self.hud.setStyleSheet('background-color: rgba(0, 0, 0, 160); color: white; font-family: monospace; padding: 4px;')
+        self.hud.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.hudTimer = QTimer(self)
+        self.hudTimer.timeout.connect(self.updateHud)
+        self.setHudVisible(self.config['metrics_settings']['hud'])
         self.setWindowFlags(Qt.FramelessWindowHint | Qt.WindowStaysOnTopHint)
 
         # Set initial size
-        window_settings = self.config['window_settings']
-        self.resize(window_settings['size']['width'], window_settings['size']['height'])
+        self.resize(*self.settings.size)
 
         self.show()
-        self.label.setGeometry(0, 0, self.width(), self.height())
+        self.view.setGeometry(0, 0, self.width(), self.height())
 
         # Immediately adjust position according to selected screen
         self.adjustPositionToNewScreen()
@@ -55,11 +102,14 @@ class TransparentWindow(QWidget):
         Initializes the instance after it has been created. It connects the screenRemoved signal of the app to the handleScreenRemoved method of the instance.
         """
         app.screenRemoved.connect(self.handleScreenRemoved)
+        app.aboutToQuit.connect(self.stopUpdates)
 
     def launchConfigEditor(self):
         """
         Launches the configuration editor window to allow users to modify settings.
         """
+        # Only needed when the editor is opened, so it is not imported at startup
+        from config_editor import ConfigEditor
         self.editor = ConfigEditor(self, self.app)
         self.editor.show()
 
@@ -83,85 +133,211 @@ class TransparentWindow(QWidget):
 
     def updateConfig(self, new_config):
         """
-        Updates the window's configuration and adjusts the window accordingly.
+        Updates the window's configuration and applies only the sections that changed.
 
         Args:
             new_config (dict): The new configuration settings to apply.
         """
+        changed = changed_sections(self.config, new_config)
         self.config = new_config
+        if not changed:
+            return
 
-        # Update the window geometry based on new configuration
-        window_settings = self.config['window_settings']
-        self.resize(window_settings['size']['width'], window_settings['size']['height'])
+        # Swap the snapshot the frame loop reads in one assignment, a worker thread sees either the old or the new one
+        previous, self.settings = self.settings, CompiledConfig(new_config)
 
-        # Recalculate and apply the new position relative to the possibly updated selected screen
-        self.adjustPositionToNewScreen()
+        if self.settings.keyer != previous.keyer:
+            # Switch the keyer if another chroma key method, mask scale or threading was selected
+            configure_threads(*self.settings.keyer[2:])
+            previous_keyer, self.pipeline.keyer = self.pipeline.keyer, create_keyer(*self.settings.keyer)
+            close_keyer(previous_keyer)
 
-        # Restart the timer with the new update interval
-        self.timer.stop()
-        self.timer.start(self.config['update_interval'])
+        if self.settings.change_detection != previous.change_detection:
+            # Recreate the change detector if it was toggled or its tile size changed
+            self.pipeline.change_detector = self.createChangeDetector(*self.settings.change_detection)
 
-        # Update QLabel geometry to match the new window size
-        self.label.setGeometry(0, 0, window_settings['size']['width'], window_settings['size']['height'])
+        if changed & {'window_settings', 'selected_screen'}:
+            # Update the window geometry, relative to the possibly updated selected screen
+            self.resize(*self.settings.size)
+            self.adjustPositionToNewScreen()
+            self.view.setGeometry(0, 0, *self.settings.size)
+
+        if changed & {'update_interval', 'pacing_settings', 'pipeline_settings'}:
+            # Restart the timer with the new pacing, or switch between timer and worker thread
+            self.scheduler = create_frame_scheduler(self.settings, self.scheduler)
+            self.applyThreading()
+
+        if 'metrics_settings' in changed:
+            self.setHudVisible(self.config['metrics_settings']['hud'])
 
         # Force the window and its contents to update
         self.update()
 
+    def createChangeDetector(self, enabled, tile_size):
+        """
+        Returns a change detector for the fused pipeline, or None if change detection is disabled.
+        """
+        return ChangeDetector(tile_size) if enabled else None
+
+    def applyThreading(self):
+        """
+        Starts frame updates on a background worker or on the GUI thread timer, as configured by
+        pipeline_settings.threaded, and stops the other one. With a process pipeline, the timer
+        only polls it for keyed frames. With a capture group, the group renders the frames.
+        """
+        if self.captureGroup is not None:
+            self.timer.stop()
+        elif self.processPipeline is not None:
+            self.timer.stop()
+            self.timer.setSingleShot(False)
+            self.timer.start(min(self.settings.update_interval, 15))
+        elif self.settings.threaded:
+            self.timer.stop()
+            if self.worker is None:
+                self.worker = CaptureWorker(self)
+                self.worker.frameReady.connect(self.takeFrame)
+                self.worker.start()
+        else:
+            if self.worker is not None:
+                self.worker.stop()
+                self.worker = None
+            # In adaptive mode updateImage restarts the timer with the scheduler's delay after every frame
+            self.timer.stop()
+            self.timer.setSingleShot(self.scheduler.mode == 'adaptive')
+            self.timer.start(int(self.scheduler.interval() * 1000))
+            # Show a frame as soon as the event loop runs instead of after the first interval
+            QTimer.singleShot(0, self.updateImage)
+
+    def stopUpdates(self):
+        """
+        Stops the timer, the worker thread and the keyer threads and reports the input-to-display latency.
+        """
+        self.timer.stop()
+        mode = 'threaded' if self.worker is not None else 'GUI thread'
+        if self.captureGroup is not None:
+            mode = f"capture group, overlay {self.groupIndex + 1}"
+        if self.processPipeline is not None:
+            mode = 'multi-process'
+            print(f"Frames dropped by the process pipeline: {self.processPipeline.dropped}")
+        if self.worker is not None:
+            self.worker.stop()
+            print(f"Frames dropped by the worker mailbox: {self.worker.mailbox.dropped}")
+            self.worker = None
+        close_keyer(self.pipeline.keyer)
+        print(f"Input-to-display latency ({mode}): {self.latency.summary()}")
+        if self.processPipeline is None:
+            print(f"Achieved frame rate ({self.scheduler.mode} pacing): {self.scheduler.achieved_fps:.1f} fps, "
+                  f"pipeline cost {self.scheduler.cost * 1000:.1f} ms per frame")
+
+    def setHudVisible(self, visible):
+        """
+        Shows or hides the metrics HUD.
+        """
+        if visible:
+            self.updateHud()
+            self.hud.show()
+            self.hud.raise_()
+            self.hudTimer.start(500)
+        else:
+            self.hudTimer.stop()
+            self.hud.hide()
+
+    def updateHud(self):
+        """
+        Refreshes the HUD with the current metrics, the achieved frame rate and the latency.
+        """
+        text = METRICS.summary()
+        if self.processPipeline is None:
+            text += f"\n{self.scheduler.achieved_fps:.1f} fps ({self.scheduler.mode})"
+        text += f"\nlatency: {self.latency.summary()}"
+        self.hud.setText(text)
+        self.hud.adjustSize()
+
+    def exportMetrics(self):
+        """
+        Writes the current metrics to metrics_settings.export_path.
+        """
+        path = self.config['metrics_settings']['export_path']
+        try:
+            METRICS.export(path)
+            print(f"Metrics exported to {path}")
+        except OSError as e:
+            print(f"Error exporting metrics: {e}")
+
+    def updateVisibility(self):
+        """
+        Tells the scheduler whether the overlay is visible, i.e. shown, not minimized and not fully covered.
+        """
+        handle = self.windowHandle()
+        self.scheduler.visible = (self.isVisible() and not self.isMinimized()
+                                  and (handle is None or handle.isExposed()))
+
     def updateImage(self):
         """
         Captures and processes an image according to the current configuration, then updates the window's display.
+        With a process pipeline, displays its newest keyed frame instead and restarts crashed processes.
         """
-        image = capture_and_process_target_window(self.config)
-        if image is not None:
-            height, width, channel = image.shape
-            bytesPerLine = 4 * width
-            qImg = QImage(image.data, width, height, bytesPerLine, QImage.Format_RGBA8888)
-            pixmap = QPixmap.fromImage(qImg)
-            
-            # Scale the pixmap to maintain aspect ratio
-            self.scalePixmapToLabel(pixmap)
+        if self.processPipeline is not None:
+            self.processPipeline.check_processes()
+            frame = self.processPipeline.latest(self.size())
+        else:
+            started = time.monotonic()
+            frame = render_frame(self.settings, self.pipeline, self.size())
+            self.scheduler.record(time.monotonic() - started, frame is not None)
+            if self.timer.isSingleShot():
+                self.timer.start(int(self.scheduler.delay(started) * 1000))
+        if frame is not None:
+            self.displayFrame(frame)
+
+    def takeFrame(self):
+        """
+        Displays the latest frame rendered by the worker thread, if one is waiting.
+        """
+        if self.worker is not None:
+            frame = self.worker.mailbox.take()
+            if frame is not None:
+                self.displayFrame(frame)
 
-            self.label.setAlignment(Qt.AlignCenter) # Center the label within the window
+    def takeGroupFrame(self, index):
+        """
+        Displays the latest frame the capture group rendered for this overlay, if `index` is this overlay's.
+        """
+        if index == self.groupIndex:
+            frame = self.captureGroup.take(index)
+            if frame is not None:
+                self.displayFrame(frame)
 
-    def resizeEvent(self, event):
+    def displayFrame(self, frame):
         """
-        Handle the resize event for the widget.
+        Paints a rendered frame and records its input-to-display latency. The buffer of the frame
+        shown before goes back to the pool.
 
         Args:
-            event: The resize event object.
-
-        Returns:
-            None
+            frame (RenderedFrame): The frame to display.
         """
-        super().resizeEvent(event)  # Call the superclass method
-        if self.label.pixmap() is not None:
-            self.scalePixmapToLabel(self.label.pixmap())  # Scale current pixmap to new window size
+        self.view.setFrame(frame.image, frame.damage, frame.box, frame.size)
+        self.latency.add(time.monotonic() - frame.captured_at)
+        previous, self.shownFrame = self.shownFrame, frame
+        if previous is None:
+            self.firstFrameShown.emit()
+        release_frame(previous)
 
-    def scalePixmapToLabel(self, pixmap):
+    def resizeEvent(self, event):
         """
-        Scale the given pixmap to fit the dimensions of the QLabel, while maintaining the aspect ratio. 
+        Handle the resize event for the widget.
 
         Args:
-            pixmap: The pixmap to be scaled
+            event: The resize event object.
 
         Returns:
             None
         """
-        if pixmap:
-            # Calculate the aspect ratio of the pixmap
-            aspect_ratio = pixmap.width() / pixmap.height()
-            new_width = self.width()
-            new_height = int(new_width / aspect_ratio)
-            if new_height > self.height():
-                new_height = self.height()
-                new_width = int(new_height * aspect_ratio)
-            
-            # Scale the pixmap to fill the new dimensions. Might crop parts of the image but will avoid black bars while keeping the aspect ratio.
-            scaled_pixmap = pixmap.scaled(self.size(), Qt.KeepAspectRatioByExpanding, Qt.SmoothTransformation)
-            
-            # Update the QLabel with the resized pixmap
-            self.label.setPixmap(scaled_pixmap)
-            self.label.resize(new_width, new_height)  # Adjust QLabel size to fit the scaled pixmap
+        super().resizeEvent(event)  # Call the superclass method
+        if self.worker is not None:
+            self.worker.target_size = QSize(self.size())
+        if self.groupIndex is not None:
+            self.captureGroup.setTargetSize(self.groupIndex, self.size())
+        self.view.setGeometry(0, 0, self.width(), self.height())
 
     def handleScreenRemoved(self, removed_screen):
         """
@@ -173,25 +349,29 @@ class TransparentWindow(QWidget):
         Returns:
             None
         """
-        self.editor = ConfigEditor(self)
-
         if self.config.get('selected_screen', '') == removed_screen.name():
             QMessageBox.warning(self, "Screen Removed", "The selected screen has been removed. Adjusting position.")
             primary_screen = self.app.primaryScreen()
             self.config['selected_screen'] = primary_screen.name()
-            
+            self.adjustPositionToNewScreen()
+
             # Save the updated configuration
-            self.editor.save_config()
+            updateConfigurationFile(self)
 
     def keyPressEvent(self, event):
         """
-        Handles hotkey presses for launching the configuration editor.
+        Handles hotkey presses: Ctrl+Q launches the configuration editor, Ctrl+M toggles the metrics HUD
+        and Ctrl+E exports the metrics.
 
         Args:
             event (QKeyEvent): The key press event.
         """
         if event.key() == Qt.Key_Q and (event.modifiers() & Qt.ControlModifier):
             self.launchConfigEditor()
+        elif event.key() == Qt.Key_M and (event.modifiers() & Qt.ControlModifier):
+            self.setHudVisible(not self.hud.isVisible())
+        elif event.key() == Qt.Key_E and (event.modifiers() & Qt.ControlModifier):
+            self.exportMetrics()
         else:
             super().keyPressEvent(event)
 
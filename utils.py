@@ -1,27 +1,172 @@
+import time
 import cv2
 import numpy as np
-import yaml
-from PyQt5.QtWidgets import QMessageBox
-from capture_image import capture_image
+from frame_source import create_frame_source
+from pipeline import ViewScaler
+from metrics import METRICS
 
-def capture_target_window(window_title):
+# Open frame sources, keyed by (backend, window title), reused across ticks
+_frame_sources = {}
+
+# Records every captured frame while recording, see start_recording
+_recorder = None
+
+# The (path, speed) of the recording every window is replayed from instead of captured, see replay_recording
+_replay = None
+
+# The FrameProxy of every window a chroma key preview watches, keyed by (backend, window title), see watch_frames
+_frame_proxies = {}
+
+def start_recording(path):
     """
-    Capture the specified window and return its image.
+    Records every frame captured through capture_target_frame to a file, see frame_recording.FrameRecorder.
+    """
+    global _recorder
+    from frame_recording import FrameRecorder
+    stop_recording()
+    _recorder = FrameRecorder(path)
+
+def stop_recording():
+    """Stops recording and closes the recording file."""
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.close()
+
+def replay_recording(path, speed=1.0):
+    """
+    Serves every window from a recording instead of capturing it, see frame_recording.ReplayFrameSource.
+    Frame sources opened before are closed.
+
+    Args:
+        path (str): The recording file, or None to capture the windows again.
+        speed (float): The replay rate relative to the recording, 0 to serve a new frame on every capture.
+    """
+    global _replay
+    close_frame_sources()
+    _replay = None if path is None else (path, speed)
+
+def watch_frames(window_title, backend, proxy):
+    """
+    Hands every frame captured of a window through capture_target_frame to a proxy, until unwatch_frames.
+
+    Args:
+        window_title (str): The title of the window.
+        backend (str): The capture backend the window is captured with.
+        proxy (FrameProxy): Takes the frames, see chroma_preview.FrameProxy.
+    """
+    _frame_proxies[(backend, window_title)] = proxy
+
+def unwatch_frames(window_title, backend, proxy):
+    """Stops handing the frames of a window to a proxy, see watch_frames."""
+    if _frame_proxies.get((backend, window_title)) is proxy:
+        del _frame_proxies[(backend, window_title)]
+
+def get_frame_source(window_title, backend='auto', region=None):
+    """
+    Return the frame source capturing the given window, creating and opening it on first use.
 
     Args:
         window_title (str): The title of the window to capture.
+        backend (str): The capture backend to use, see frame_source.FRAME_SOURCES.
+        region (tuple, optional): The (x, y, width, height) rectangle of the client area to capture.
 
     Returns:
-        ndarray: The captured image as an OpenCV image (BGR format).
+        FrameSource: The open frame source.
+    """
+    key = (backend, window_title)
+    source = _frame_sources.get(key)
+    if source is None:
+        if _replay is not None:
+            from frame_recording import ReplayFrameSource
+            source = ReplayFrameSource(window_title, *_replay)
+        else:
+            source = create_frame_source(window_title, backend)
+        source.open()
+        _frame_sources[key] = source
+    source.region = region
+    return source
+
+def close_frame_source(window_title, backend='auto'):
+    """Close and forget the frame source of the given window, so the next capture reopens it."""
+    source = _frame_sources.pop((backend, window_title), None)
+    if source is not None:
+        source.close()
+
+def close_frame_sources():
+    """Close every frame source opened through get_frame_source."""
+    while _frame_sources:
+        _, source = _frame_sources.popitem()
+        source.close()
+
+def capture_target_frame(window_title, backend='auto', region=None):
     """
+    Capture the specified window and return the raw frame delivered by the capture backend.
+
+    Args:
+        window_title (str): The title of the window to capture.
+        backend (str): The capture backend to use, see frame_source.FRAME_SOURCES.
+        region (tuple, optional): The (x, y, width, height) rectangle of the client area to capture.
+
+    Returns:
+        Frame or None: The captured frame, or None if the window cannot be captured.
+    """
+    started = time.perf_counter()
     try:
-        image = capture_image(window_title)
-        return cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+        # None while the backend is waiting for the window to become available again
+        frame = get_frame_source(window_title, backend, region).grab()
     except Exception as e:
         print(f"Error capturing window: {e}")
+        close_frame_source(window_title, backend)
         return None
+    if frame is not None:
+        METRICS.record('capture', time.perf_counter() - started)
+        share_frame(window_title, backend, frame)
+    return frame
+
+def share_frame(window_title, backend, frame):
+    """
+    Hands a captured frame to the recorder and the preview watching the window, if any.
+
+    Their errors are reported without failing the capture, the frame source stays open.
+    """
+    try:
+        recorder = _recorder
+        if recorder is not None:
+            recorder.write(frame)
+        proxy = _frame_proxies.get((backend, window_title))
+        if proxy is not None:
+            proxy.update(frame)
+    except Exception as e:
+        print(f"Error recording or previewing a frame: {e}")
 
-def apply_chroma_key(image, hsv_lower, hsv_upper):
+def capture_target_window(window_title, backend='auto', region=None):
+    """
+    Capture the specified window and return its image.
+
+    Args:
+        window_title (str): The title of the window to capture.
+        backend (str): The capture backend to use, see frame_source.FRAME_SOURCES.
+        region (tuple, optional): The (x, y, width, height) rectangle of the client area to capture.
+
+    Returns:
+        ndarray: The captured image as an OpenCV image (BGR format).
+    """
+    frame = capture_target_frame(window_title, backend, region)
+    if frame is None:
+        return None
+    return frame_to_image(frame)
+
+def frame_to_image(frame):
+    """
+    Copies a captured frame into an OpenCV image (BGR format).
+    """
+    started = time.perf_counter()
+    image = cv2.cvtColor(frame.data, cv2.COLOR_BGRA2BGR)
+    METRICS.record('convert', time.perf_counter() - started)
+    return image
+
+def apply_chroma_key(image, hsv_lower, hsv_upper, keyer=None):
     """
     Apply a chroma key effect to an image.
 
@@ -32,10 +177,18 @@ def apply_chroma_key(image, hsv_lower, hsv_upper):
         image (ndarray): The original image in BGR format.
         hsv_lower (ndarray): The lower bound of the HSV values to be made transparent.
         hsv_upper (ndarray): The upper bound of the HSV values to be made transparent.
+        keyer (optional): Computes the alpha channel instead of the inline HSV conversion below. Create
+            it once with chroma_key.create_keyer, which also wraps it for a reduced mask scale, and
+            reuse it, its tables and buffers are kept between frames.
 
     Returns:
         ndarray: The modified image with the specified color range made transparent.
     """
+    if keyer is not None:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+        image[:, :, 3] = keyer.alpha(image, hsv_lower, hsv_upper)
+        return image
+
     # Convert BGR to HSV
     hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
 
@@ -51,39 +204,61 @@ def apply_chroma_key(image, hsv_lower, hsv_upper):
 
     return image
 
-def capture_and_process_target_window(config):
+def capture_and_process_target_window(settings, pipeline=None, view_size=None, frame=None, keyer=None):
     """
     Capture and process an image from a specified window.
 
     This function captures an image from a specified window, then applies a chroma key effect to it
-    using predefined HSV bounds for the target color.
+    using the HSV bounds for the target color from the `chroma_key_settings` of the configuration.
 
-    The global variables `window_title`, `hsv_lower_hue`, `hsv_lower_saturation`, `hsv_lower_value`,
-    `hsv_upper_hue`, `hsv_upper_saturation`, and `hsv_upper_value` are used for configuration.
+    Args:
+        settings (CompiledConfig): The compiled application configuration.
+        pipeline (FramePipeline, optional): When given, the frame is keyed by the fused pipeline straight
+            from the capture buffer, and the result is premultiplied BGRA owned by the pipeline.
+        view_size (tuple, optional): The (width, height) of the overlay. When given, the image is cropped to
+            the part the overlay shows and downscaled to the size it is shown at before it is keyed.
+        frame (Frame, optional): An already captured frame of the window to process instead of capturing one.
+        keyer (optional): The keyer of the legacy path, created by chroma_key.create_keyer from `settings.keyer`
+            and reused across frames. Without it, the reference HSV conversion of apply_chroma_key is used.
 
     Returns:
         ndarray or None: The processed image if successful, or None if the window cannot be captured.
     """
-    window_title = config['window_settings']['title']
-
     # Capture the window with the $window_title title
-    captured_image = capture_target_window(window_title)
+    if frame is None:
+        frame = capture_target_frame(settings.title, settings.backend, settings.region)
+    if pipeline is not None or frame is None:
+        captured = frame
+    else:
+        captured = frame_to_image(frame)
 
-    if captured_image is not None:
-        # Define the lower and upper bounds of the target color in HSV
-        hsv_lower = np.array([config['chroma_key_settings']['hsv_lower']['h'], 
-                          config['chroma_key_settings']['hsv_lower']['s'], 
-                          config['chroma_key_settings']['hsv_lower']['v']], dtype=np.uint8)
-        hsv_upper = np.array([config['chroma_key_settings']['hsv_upper']['h'], 
-                          config['chroma_key_settings']['hsv_upper']['s'], 
-                          config['chroma_key_settings']['hsv_upper']['v']], dtype=np.uint8)
+    if captured is not None:
+        hsv_lower, hsv_upper = settings.hsv_lower, settings.hsv_upper
 
         # Apply chroma key effect
-        return apply_chroma_key(captured_image, hsv_lower, hsv_upper)
+        if pipeline is not None:
+            return pipeline.process(captured, hsv_lower, hsv_upper, view_size)
+        scaler = ViewScaler()
+        if view_size is not None:
+            started = time.perf_counter()
+            captured = scaler.scale(captured, *view_size)
+            METRICS.record('convert', time.perf_counter() - started)
+        started = time.perf_counter()
+        keyed = apply_chroma_key(captured, hsv_lower, hsv_upper, keyer=keyer)
+        METRICS.record('key', time.perf_counter() - started)
+        # apply_chroma_key returns a new image, the scaled pixels are not needed anymore
+        scaler.release()
+        return keyed
+    METRICS.count('capture_unavailable')
     return None
 
 def updateConfigurationFile(self):
-        """Directly update the configuration file with the current config."""
+        """Update the configuration file with the current config, through the config store if there is one."""
+        config_store = getattr(self, 'configStore', None)
+        if config_store is not None:
+            config_store.save(self.config, getattr(self, 'overlay', None))
+            return
+        import yaml
         with open('config.yaml', 'w') as file:
             yaml.dump(self.config, file, sort_keys=False)
 
@@ -97,6 +272,8 @@ def is_valid_update_interval(self, interval_str):
     Returns:
         bool: True if the input is valid, False otherwise.
     """
+    # Imported here, so the pipeline processes capturing through this module do not load Qt widgets
+    from PyQt5.QtWidgets import QMessageBox
     try:
         interval = int(interval_str)
         # Define the acceptable range for your update interval here
@@ -110,6 +287,48 @@ def is_valid_update_interval(self, interval_str):
         QMessageBox.warning(self, "Invalid Input", "Update interval must be a valid integer.")
         return False
     
+def parse_capture_region(region_str):
+    """
+    Parses a capture region typed as "auto" or "x, y, width, height".
+
+    Args:
+        region_str (str): The input string to parse.
+
+    Returns:
+        str or dict: 'auto', or a dict with the x, y, width and height of the region.
+
+    Raises:
+        ValueError: If the input is neither "auto" nor four integers with a positive width and height.
+    """
+    if region_str.strip().lower() == 'auto':
+        return 'auto'
+    values = [int(value) for value in region_str.split(',')]
+    if len(values) != 4:
+        raise ValueError("A capture region needs exactly four values.")
+    x, y, width, height = values
+    if x < 0 or y < 0 or width <= 0 or height <= 0:
+        raise ValueError("A capture region needs a non-negative position and a positive size.")
+    return {'x': x, 'y': y, 'width': width, 'height': height}
+
+def is_valid_capture_region(self, region_str):
+    """
+    Validates the capture region input.
+
+    Args:
+        region_str (str): The input string to validate.
+
+    Returns:
+        bool: True if the input is valid, False otherwise.
+    """
+    from PyQt5.QtWidgets import QMessageBox
+    try:
+        parse_capture_region(region_str)
+        return True
+    except ValueError:
+        QMessageBox.warning(self, "Invalid Input", "Capture region must be 'auto' or 'x, y, width, height' "
+                                                   "with a non-negative position and a positive size.")
+        return False
+
 def is_valid_position(self, x, y, selected_screen_name=None):
     """
     Check if the given position is valid, and adjust it if necessary to fit within the screen's bounds.
@@ -122,6 +341,7 @@ def is_valid_position(self, x, y, selected_screen_name=None):
     Returns:
         tuple: The adjusted x and y coordinates if they fall outside the selected screen's bounds; otherwise, the original x and y coordinates.
     """
+    from PyQt5.QtWidgets import QMessageBox
     try:
         x = int(x)
         y = int(y)